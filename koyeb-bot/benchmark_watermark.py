@@ -0,0 +1,215 @@
+"""
+WATERMARK BENCHMARK
+===================
+Measure what add_image_watermark / add_text_watermark cost per image size.
+
+A synthetic, seeded image corpus (thumbnail to ~10MP) is generated in memory,
+then every combination of watermark kind (opaque logo, alpha logo, text),
+position and opacity is run. Reported per size + kind:
+    images/s, p50/p99 latency, peak RSS, input and output bytes
+
+Each size + kind runs in a fresh process, so its peak RSS is its own and not the
+high-water mark of every case before it ("rss +MB" is the growth over the process
+baseline after setup). Per-case rows (--per-case) share their group's process
+and show no RSS.
+
+Requirements:
+    pip install -r requirements.txt
+
+Usage:
+    python benchmark_watermark.py
+    python benchmark_watermark.py --quick
+    python benchmark_watermark.py --sizes 2mp,10mp --positions auto,bottom-right --per-case
+    python benchmark_watermark.py --json bench.json
+"""
+
+import argparse
+import io
+import json
+import multiprocessing
+import random
+import resource
+import statistics
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageDraw, ImageFilter
+
+from main import AUTO_POSITIONS, add_image_watermark, add_text_watermark
+
+SIZES = {
+    "thumb": (320, 240),
+    "hd": (1280, 720),
+    "2mp": (1920, 1080),
+    "6mp": (3000, 2000),
+    "10mp": (3872, 2592),
+}
+KINDS = ["logo-opaque", "logo-alpha", "text"]
+POSITIONS = ["top-left", "top-right", "bottom-left", "bottom-right", "center"] + AUTO_POSITIONS
+OPACITIES = [64, 128, 255]
+WATERMARK_TEXT = "@MyChannel"
+SEED = 1234
+
+
+def make_photo(size, seed=SEED):
+    """Build a deterministic photo-like JPEG (gradient + shapes + blur)"""
+    rng = random.Random(f"{seed}-{size}")
+    w, h = size
+    image = Image.linear_gradient("L").resize((w, h)).convert("RGB")
+    draw = ImageDraw.Draw(image)
+    for _ in range(150):
+        x, y = rng.randrange(w), rng.randrange(h)
+        rw, rh = rng.randrange(w // 20 + 1, w // 4 + 2), rng.randrange(h // 20 + 1, h // 4 + 2)
+        color = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+        if rng.random() < 0.5:
+            draw.ellipse([x, y, x + rw, y + rh], fill=color)
+        else:
+            draw.rectangle([x, y, x + rw, y + rh], fill=color)
+    image = image.filter(ImageFilter.GaussianBlur(1))
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=90)
+    return output.getvalue()
+
+
+def make_logo(alpha):
+    """Build a 400x200 PNG logo, fully opaque or with a transparent background"""
+    logo = Image.new("RGBA", (400, 200), (0, 0, 0, 0) if alpha else (20, 90, 200, 255))
+    draw = ImageDraw.Draw(logo)
+    draw.ellipse([20, 20, 180, 180], fill=(255, 200, 0, 255))
+    draw.rectangle([200, 60, 380, 140], fill=(255, 255, 255, 200 if alpha else 255))
+    output = io.BytesIO()
+    logo.save(output, format="PNG")
+    return output.getvalue()
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS reports bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def run_case(image_bytes, kind, logos, position, opacity):
+    """Watermark one image once; returns (seconds, output_bytes)"""
+    start = time.perf_counter()
+    if kind == "text":
+        output = add_text_watermark(image_bytes, WATERMARK_TEXT, position, opacity)
+    else:
+        output = add_image_watermark(image_bytes, logos[kind], position, opacity, 20)
+    elapsed = time.perf_counter() - start
+    if output is None:
+        raise RuntimeError(f"watermark failed ({kind}, {position}, {opacity})")
+    return elapsed, len(output)
+
+
+def summarize(label, timings, output_sizes, input_size, rss=None):
+    """Build a result row from raw timings; rss is (peak MB, growth MB) of the group's process"""
+    total = sum(timings)
+    return {
+        "case": label,
+        "samples": len(timings),
+        "images_per_s": round(len(timings) / total, 2) if total else 0,
+        "p50_ms": round(percentile(timings, 50) * 1000, 1),
+        "p99_ms": round(percentile(timings, 99) * 1000, 1),
+        "peak_rss_mb": round(rss[0], 1) if rss else None,
+        "rss_growth_mb": round(rss[1], 1) if rss else None,
+        "input_bytes": input_size,
+        "output_bytes": int(statistics.mean(output_sizes)),
+    }
+
+
+def print_row(row):
+    def rss(value):
+        return "-" if value is None else value
+    print(
+        f"{row['case']:<44} {row['samples']:>5} {row['images_per_s']:>9} "
+        f"{row['p50_ms']:>9} {row['p99_ms']:>9} {rss(row['peak_rss_mb']):>9} {rss(row['rss_growth_mb']):>9} "
+        f"{row['input_bytes']:>10} {row['output_bytes']:>10}"
+    )
+
+
+def run_group(size_name, kind, positions, opacities, iterations, per_case):
+    """Benchmark one size + kind (in its own process); returns its rows, group row last"""
+    image_bytes = make_photo(SIZES[size_name])
+    logos = {"logo-opaque": make_logo(alpha=False), "logo-alpha": make_logo(alpha=True)}
+    baseline = peak_rss_mb()
+
+    # Warm-up (font loading, decoder init) is not measured
+    run_case(image_bytes, kind, logos, positions[0], opacities[0])
+
+    rows, timings, output_sizes = [], [], []
+    for position in positions:
+        for opacity in opacities:
+            case_timings, case_sizes = [], []
+            for _ in range(iterations):
+                elapsed, out_size = run_case(image_bytes, kind, logos, position, opacity)
+                case_timings.append(elapsed)
+                case_sizes.append(out_size)
+            timings.extend(case_timings)
+            output_sizes.extend(case_sizes)
+            if per_case:
+                rows.append(summarize(f"  {size_name}/{kind}/{position}/{opacity}", case_timings, case_sizes, len(image_bytes)))
+
+    peak = peak_rss_mb()
+    rows.append(summarize(f"{size_name}/{kind}", timings, output_sizes, len(image_bytes), (peak, peak - baseline)))
+    return rows
+
+
+def parse_list(value, allowed):
+    items = [v.strip() for v in value.split(",") if v.strip()]
+    unknown = [v for v in items if v not in allowed]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown value(s): {', '.join(unknown)} (choose from {', '.join(allowed)})")
+    return items
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark watermark engine on a synthetic image corpus")
+    parser.add_argument("--sizes", type=lambda v: parse_list(v, list(SIZES)), default=list(SIZES))
+    parser.add_argument("--kinds", type=lambda v: parse_list(v, KINDS), default=KINDS)
+    parser.add_argument("--positions", type=lambda v: parse_list(v, POSITIONS), default=POSITIONS)
+    parser.add_argument("--opacities", type=lambda v: [int(x) for x in v.split(",") if x.strip()], default=OPACITIES)
+    parser.add_argument("--iterations", type=int, default=2, help="Runs per case (default: 2)")
+    parser.add_argument("--quick", action="store_true", help="thumb + 2mp, bottom-right/auto, opacity 128")
+    parser.add_argument("--per-case", action="store_true", help="Also print one row per position/opacity")
+    parser.add_argument("--json", help="Write all result rows to this file")
+    args = parser.parse_args()
+
+    if args.quick:
+        args.sizes, args.positions, args.opacities = ["thumb", "2mp"], ["bottom-right", "auto"], [128]
+
+    print("=" * 120)
+    print(f"Watermark benchmark | sizes={','.join(args.sizes)} kinds={','.join(args.kinds)} "
+          f"positions={len(args.positions)} opacities={args.opacities} iterations={args.iterations}")
+    print("=" * 120)
+    print(f"{'case':<44} {'n':>5} {'img/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'rss MB':>9} {'rss +MB':>9} {'in B':>10} {'out B':>10}")
+
+    rows = []
+    # One fresh (spawned, not forked) process per group: ru_maxrss is per process and never goes down
+    context = multiprocessing.get_context("spawn")
+    for size_name in args.sizes:
+        for kind in args.kinds:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                group_rows = pool.submit(
+                    run_group, size_name, kind, args.positions, args.opacities, args.iterations, args.per_case
+                ).result()
+            for row in group_rows:
+                rows.append(row)
+                print_row(row)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent=2)
+        print(f"📁 Results saved to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
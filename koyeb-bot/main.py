@@ -2,11 +2,23 @@
 import os
 import re
 import asyncio
+import heapq
+import itertools
 import time
 import io
+from collections import OrderedDict, deque
+import math
+import mimetypes
 import signal
 import sys
-from datetime import datetime
+import unicodedata
+from urllib.parse import urlsplit
+from datetime import datetime, timedelta
+try:
+    from re import _parser as sre_parse  # Python 3.11+ (the Dockerfile pins 3.11)
+except ImportError:
+    import sre_parse  # Python < 3.11
+import aiohttp
 from flask import Flask, request, jsonify
 from pyrogram import Client, filters, idle
 
@@ -20,16 +32,16 @@ except Exception:
 # Backward/forward compatibility: some builds may reference filters.supergroup
 if not hasattr(filters, "supergroup"):
     filters.supergroup = filters.group
-from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from pyrogram.enums import ChatType, ChatMemberStatus
-from pyrogram.errors import FloodWait, SlowmodeWait, ChatAdminRequired, ChannelPrivate, MessageNotModified
+from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto, InputMediaVideo, InputMediaDocument, InputMediaAudio
+from pyrogram.enums import ChatType, ChatMemberStatus, ChatMembersFilter, MessageEntityType
+from pyrogram.errors import FloodWait, SlowmodeWait, ChatAdminRequired, ChannelPrivate, MessageNotModified, ChatForwardsRestricted, UserNotParticipant
 
 # Chat type helper - filters.group covers both groups and supergroups in Pyrogram 2.x
 GROUP_CHAT = filters.group
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument, UpdateOne
 from dotenv import load_dotenv
 import threading
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw, ImageFont, ImageStat, JpegImagePlugin
 
 # Build marker (changes on each code update) to verify Koyeb is running the latest image
 BUILD_MARKER = "2025-12-24T22:20:00Z"
@@ -58,23 +70,210 @@ warnings_col = db["user_warnings"] if db is not None else None
 user_channels_col = db["user_channels"] if db is not None else None
 force_sub_col = db["force_subscribe"] if db is not None else None
 referrals_col = db["referrals"] if db is not None else None
+referral_counts_col = db["referral_counts"] if db is not None else None  # {referrer_id, count} kept with $inc
 bot_settings_col = db["bot_settings"] if db is not None else None
 group_forcejoin_col = db["group_forcejoin"] if db is not None else None  # Force join config per group
+auto_delete_col = db["auto_delete_queue"] if db is not None else None  # Scheduled message deletions (survive restarts)
+
+# ============ STATE STORE ============
+# Per-chat / per-user state is kept in bounded LRU stores instead of plain dicts, so memory stays
+# flat however many groups the bot is added to. Entries idle for longer than their TTL expire;
+# chat config and warnings are reloaded from Mongo on the next access.
+STATE_MAX_CHATS = int(os.getenv("STATE_MAX_CHATS", "5000"))  # Per-chat configs kept in memory
+STATE_MAX_USERS = int(os.getenv("STATE_MAX_USERS", "20000"))  # Per-user / per-(chat, user) entries kept in memory
+STATE_CHAT_TTL = int(os.getenv("STATE_CHAT_TTL", "21600"))  # Seconds an unused chat config stays cached
+STATE_USER_TTL = int(os.getenv("STATE_USER_TTL", "3600"))  # Seconds an unused wizard/warning entry is kept
+STATE_STORES = []  # Every StateStore, for /state metrics
+
+
+class _StateEntry:
+    __slots__ = ("value", "touched")
+
+    def __init__(self, value, touched):
+        self.value = value
+        self.touched = touched
+
+
+class StateStore:
+    """Dict-like LRU store with an idle TTL and optional load-on-miss.
+    
+    Past max_size the least recently used entry is evicted; entries unused for ttl seconds expire.
+    Entries for which keep(value) is true are never evicted. With a loader, store[key] on a miss
+    loads the value (e.g. from Mongo) instead of raising KeyError; get() never loads.
+    With sliding=False the TTL counts from when the value was stored, not from its last use.
+    """
+    __slots__ = ("name", "max_size", "ttl", "sliding", "loader", "keep", "on_evict", "metrics", "_entries")
+
+    def __init__(self, name, max_size, ttl=None, loader=None, keep=None, on_evict=None, sliding=True):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sliding = sliding
+        self.loader = loader
+        self.keep = keep
+        self.on_evict = on_evict
+        self.metrics = {"hits": 0, "misses": 0, "loads": 0, "evictions": 0, "expired": 0}
+        self._entries = OrderedDict()
+        STATE_STORES.append(self)
+
+    def _expired(self, entry, now):
+        return self.ttl is not None and now - entry.touched > self.ttl and not (self.keep and self.keep(entry.value))
+
+    def _drop(self, key, metric=None):
+        entry = self._entries.pop(key)
+        if metric:
+            self.metrics[metric] += 1
+        if self.on_evict:
+            self.on_evict(key, entry.value)
+
+    def _live(self, key):
+        """Entry for key (refreshed and marked most recently used), or None if missing/expired"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        now = time.time()
+        if self._expired(entry, now):
+            self._drop(key, "expired")
+            return None
+        if self.sliding:
+            entry.touched = now
+        self._entries.move_to_end(key)
+        return entry
+
+    def _shrink(self):
+        """Expire idle entries (oldest first), then evict least recently used ones past max_size"""
+        # Both scans start at the least recently used end and stop early, so an insert stays O(1)
+        if self.ttl is not None:
+            now = time.time()
+            expired = []
+            for key, entry in self._entries.items():
+                if now - entry.touched <= self.ttl:
+                    break
+                if self._expired(entry, now):
+                    expired.append(key)
+            for key in expired:
+                self._drop(key, "expired")
+        excess = len(self._entries) - self.max_size
+        if excess > 0:
+            victims = []
+            for key, entry in self._entries.items():
+                if len(victims) >= excess:
+                    break
+                if not (self.keep and self.keep(entry.value)):
+                    victims.append(key)
+            for key in victims:
+                self._drop(key, "evictions")
+
+    def __contains__(self, key):
+        return self._live(key) is not None
+
+    def __getitem__(self, key):
+        entry = self._live(key)
+        if entry is not None:
+            self.metrics["hits"] += 1
+            return entry.value
+        self.metrics["misses"] += 1
+        if self.loader is None:
+            raise KeyError(key)
+        value = self.loader(key)
+        self.metrics["loads"] += 1
+        self[key] = value
+        return value
+
+    def get(self, key, default=None):
+        entry = self._live(key)
+        if entry is None:
+            self.metrics["misses"] += 1
+            return default
+        self.metrics["hits"] += 1
+        return entry.value
+
+    def __setitem__(self, key, value):
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry.value = value
+            entry.touched = time.time()
+            self._entries.move_to_end(key)
+            return
+        self._entries[key] = _StateEntry(value, time.time())
+        self._shrink()
+
+    def setdefault(self, key, default):
+        entry = self._live(key)
+        if entry is not None:
+            self.metrics["hits"] += 1
+            return entry.value
+        self.metrics["misses"] += 1
+        self[key] = default
+        return default
+
+    def __delitem__(self, key):
+        if key not in self._entries:
+            raise KeyError(key)
+        self._drop(key)
+
+    def pop(self, key, *default):
+        entry = self._entries.get(key)
+        if entry is None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        self._drop(key)
+        return entry.value
+
+    def clear(self):
+        for key in list(self._entries):
+            self._drop(key)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(list(self._entries))
+
+    def stats(self):
+        return {"name": self.name, "size": len(self._entries), "max_size": self.max_size, "ttl": self.ttl, **self.metrics}
+
+
+def state_store_metrics():
+    """Size and hit/miss/eviction counters of every state store"""
+    return [store.stats() for store in STATE_STORES]
+
+
+def _drop_chat_caches(chat_id, _config):
+    """Derived per-chat caches go with an evicted chat config (rebuilt on next message)"""
+    group_pipeline_stages.pop(chat_id, None)
+    chat_rule_matchers.pop(chat_id, None)
+
+
+def _load_warning_count(key):
+    """Warning count for (chat_id, user_id) from the database"""
+    if warnings_col is None:
+        return 0
+    chat_id, user_id = key
+    saved = warnings_col.find_one({"chat_id": chat_id, "user_id": user_id})
+    return saved.get("count", 0) if saved else 0
+
 
 # Force join config per group: {chat_id: {"channel_id": "", "channel_name": "", "invite_link": ""}}
-group_forcejoin_config = {}
+group_forcejoin_config = StateStore(
+    "group_forcejoin_config", STATE_MAX_CHATS, STATE_CHAT_TTL,
+    loader=lambda chat_id: load_group_forcejoin(chat_id), on_evict=_drop_chat_caches
+)
 
 # Public access control
 public_access_enabled = False  # Default: only admins can use bot
 
 # User state for channel input
-user_channel_state = {}  # {user_id: "waiting_add_channel"}
+user_channel_state = StateStore("user_channel_state", STATE_MAX_USERS, STATE_USER_TTL)  # {user_id: "waiting_add_channel"}
 
 # Forward wizard state
-forward_wizard_state = {}  # {user_id: {"state": "...", "source_channel": "", "source_title": "", "skip_number": 0, "last_message_id": 0}}
+forward_wizard_state = StateStore("forward_wizard_state", STATE_MAX_USERS, STATE_USER_TTL)  # {user_id: {"state": "...", "source_channel": "", "source_title": "", "skip_number": 0, "last_message_id": 0}}
 
-# Active forwarding progress per user
-user_forward_progress = {}  # {user_id: {progress data...}}
+# Active forwarding progress per user (running jobs are never evicted)
+user_forward_progress = StateStore(
+    "user_forward_progress", STATE_MAX_USERS, STATE_CHAT_TTL, keep=lambda progress: progress.get("is_active")
+)  # {user_id: {progress data...}}
 
 # Force subscribe channels list (loaded from DB)
 force_subscribe_channels = []  # [{"channel_id": "", "channel_name": "", "invite_link": ""}]
@@ -151,7 +350,9 @@ current_progress = {
 }
 
 # Auto-approve state
-auto_approve_channels = set()  # Set of channel IDs with auto-approve enabled
+auto_approve_channels = set()  # Numeric chat IDs with auto-approve enabled (join requests match on chat.id only)
+auto_approve_index = {}  # {chat_id: {"channel": input as typed, "title": "", "username": ""}}
+auto_approve_unresolved = set()  # Saved inputs that could not be resolved to a chat ID yet
 auto_approve_stats = {"approved": 0, "failed": 0}
 
 # Logo/Watermark state
@@ -159,25 +360,60 @@ logo_config = {
     "enabled": False,
     "logo_file_id": None,  # Telegram file_id of logo image
     "text": None,  # Text watermark
-    "position": "bottom-right",  # Position: top-left, top-right, bottom-left, bottom-right, center
+    "position": "bottom-right",  # Position: top-left, top-right, bottom-left, bottom-right, center, auto, auto-contrast
     "opacity": 128,  # 0-255
     "size": 20  # Percentage of image size
 }
-logo_stats = {"watermarked": 0, "failed": 0}
+logo_stats = {"watermarked": 0, "failed": 0, "bytes_in": 0, "bytes_out": 0}
+logo_cache = {"file_id": None, "bytes": None}  # Downloaded logo, reused until the logo changes
+
+# Watermark JPEG encoder settings
+WATERMARK_JPEG_MAX_QUALITY = int(os.getenv("WATERMARK_JPEG_MAX_QUALITY", "90"))  # Never re-encode above this
+WATERMARK_JPEG_PROGRESSIVE = os.getenv("WATERMARK_JPEG_PROGRESSIVE", "").lower() in ("1", "true", "yes")
+# Standard (IJG) luminance quantization table, used to estimate a source JPEG's quality
+STD_LUMA_QTABLE = [
+    16, 11, 10, 16, 24, 40, 51, 61, 12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56, 14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77, 24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101, 72, 92, 95, 98, 112, 100, 103, 99
+]
 
-# Content Moderation state
-moderation_config = {}  # {chat_id: {block_forward, block_links, block_badwords, block_mentions, auto_delete_2min, enabled}}
-moderation_stats = {"deleted_forward": 0, "deleted_links": 0, "deleted_badwords": 0, "deleted_mentions": 0, "warnings": 0, "bans": 0, "auto_deleted": 0}
-user_warnings = {}  # {(chat_id, user_id): warning_count}
+# Auto watermark placement
+AUTO_POSITIONS = ["auto", "auto-contrast"]  # auto = least busy corner, auto-contrast = corner with most contrast
+AUTO_ANALYSIS_SIZE = 96  # Longest side (px) of the downscaled luminance map used for analysis
+AUTO_POSITION_CACHE_MAX = 1000
+auto_position_cache = {}  # {(media_group_id, mode): position} so a whole album uses the same corner
+
+# Protected-content fallback (sources where copy_message is refused)
+PROTECTED_MAX_INFLIGHT = int(os.getenv("PROTECTED_MAX_INFLIGHT", "4"))  # Max files downloading/uploading at once
+STREAM_CHUNK_SIZE = 1024 * 1024  # Pyrogram stream_media chunk size (1 MB)
+protected_sources = set()  # Source chats that refused copy_message (noforwards)
+protected_stats = {"reuploaded": 0, "failed": 0}
 
-# Auto-delete message queue: {chat_id: [(message_id, timestamp), ...]}
-auto_delete_queue = {}
+# Content Moderation state
+moderation_config = StateStore(
+    "moderation_config", STATE_MAX_CHATS, STATE_CHAT_TTL,
+    loader=lambda chat_id: load_moderation_config(chat_id), on_evict=_drop_chat_caches
+)  # {chat_id: {block_forward, block_links, block_badwords, block_mentions, block_duplicates, auto_delete_2min, enabled, rules, shadow_mode}}
+moderation_stats = {"deleted_forward": 0, "deleted_links": 0, "deleted_badwords": 0, "deleted_mentions": 0, "deleted_duplicates": 0, "deleted_rules": 0, "warnings": 0, "bans": 0, "auto_deleted": 0}
+user_warnings = StateStore("user_warnings", STATE_MAX_USERS, STATE_USER_TTL, loader=_load_warning_count)  # {(chat_id, user_id): warning_count}
+
+# Group message pipeline: {chat_id: ((stage, config), ...)} resolved once from moderation + force join config.
+# An empty tuple means nothing is enabled and the message is left alone.
+group_pipeline_stages = {}
+
+# Auto-delete scheduler: heap of (due_at, chat_id, message_id, counted), persisted in auto_delete_col
+# counted=True for /autodelete2min deletions (shown in moderation_stats["auto_deleted"])
+auto_delete_queue = []
+auto_delete_pending_writes = []  # Entries scheduled since the last DB flush
+auto_delete_task = None  # Background scheduler task
+AUTO_DELETE_BATCH = 100  # delete_messages accepts up to 100 IDs per call
 MAX_WARNINGS = 3  # Auto-ban after this many warnings
 
 # Bad words list for content filtering (Hindi + English inappropriate/sexual words)
 BAD_WORDS = [
     # English sexual words
-    "sex", "xxx", "porn", "nude", "naked", "fuck", "bitch", "ass", "dick", "pussy",
+    "sex", "xxx", "porn", "nude", "naked", "fuck", "bitch", "ass", "asshole", "dick", "pussy",
     "boobs", "tits", "cock", "cum", "horny", "slut", "whore", "sexy", "adult",
     "vagina", "penis", "orgasm", "masturbat", "blowjob", "handjob", "dildo",
     "nipple", "erotic", "seduce", "onlyfans", "xvideos", "pornhub", "xnxx",
@@ -191,6 +427,16 @@ BAD_WORDS = [
     "bhadwa", "bhadwe", "bsdk", "mc", "bc", "mkc", "bkc"
 ]
 
+# Entries that only match as whole words (they also appear inside innocent words:
+# "class", "document", "sussex", "island", "salad", "analysis", "peacock", ...)
+BAD_WORDS_WHOLE_WORD = {
+    "sex", "ass", "cum", "cock", "dick", "tits", "adult", "anal", "69", "item", "land", "sala",
+    "maal", "boor", "bund", "dalal", "dalla", "pataka", "mc", "bc", "mkc", "bkc", "muth", "chod", "loda"
+}
+
+# Leetspeak / look-alike folding applied before matching ("s3x", "p0rn", "$lut")
+LEET_TABLE = str.maketrans({"0": "o", "1": "i", "3": "e", "4": "a", "5": "s", "7": "t", "@": "a", "$": "s"})
+
 # Pyrogram clients - Multiple user accounts for speed
 user_clients = []  # List of (name, client) tuples
 bot_client = None   # Bot for commands/UI
@@ -245,93 +491,772 @@ def save_public_access(enabled):
         )
 
 
+# ============ SETTINGS CACHE ============
+# Chat settings (moderation, force join) and bot_config are bulk-loaded at startup with one query per
+# collection, so hot handlers read them from memory. Every save stamps updated_at with the database
+# server's clock ($currentDate, so instance clock skew doesn't matter); settings_sync_worker polls for
+# documents stamped after the newest one seen minus SETTINGS_SYNC_OVERLAP (a save stamped earlier but
+# committed later is still picked up), so a change saved by another instance shows up within
+# SETTINGS_POLL_INTERVAL seconds. Re-read documents that match the cache are skipped.
+SETTINGS_POLL_INTERVAL = int(os.getenv("SETTINGS_POLL_INTERVAL", "30"))
+SETTINGS_SYNC_OVERLAP = 60  # Seconds re-read behind the newest updated_at seen
+settings_warm = False  # True once warm_settings_cache ran: unknown chats have no saved settings
+settings_known_chats = {"moderation": set(), "forcejoin": set()}  # chat_ids that have a saved document
+settings_synced_at = {"moderation": None, "forcejoin": None, "bot_config": None}  # newest updated_at seen
+bot_config_cache = None  # bot_config document (source/dest channel)
+settings_sync_task = None  # Background task polling for settings changed elsewhere
+
+
+def default_moderation_config():
+    """Moderation config for a chat with nothing saved"""
+    return {"enabled": False, "block_forward": False, "block_links": False, "block_badwords": False, "block_mentions": False, "block_duplicates": False, "auto_delete_2min": False, "rules": {}, "shadow_mode": False}
+
+
+def moderation_config_from_doc(saved):
+    """Moderation config dict from a group_moderation document"""
+    return {
+        "enabled": saved.get("enabled", False),
+        "block_forward": saved.get("block_forward", False),
+        "block_links": saved.get("block_links", False),
+        "block_badwords": saved.get("block_badwords", False),
+        "block_mentions": saved.get("block_mentions", False),
+        "block_duplicates": saved.get("block_duplicates", False),
+        "auto_delete_2min": saved.get("auto_delete_2min", False),
+        "rules": saved.get("rules", {}),
+        "shadow_mode": saved.get("shadow_mode", False)
+    }
+
+
+def default_forcejoin_config():
+    """Force join config for a chat with nothing saved"""
+    return {"enabled": False, "channel_id": None, "channel_name": "", "invite_link": ""}
+
+
+def forcejoin_config_from_doc(saved):
+    """Force join config dict from a group_forcejoin document"""
+    return {
+        "enabled": saved.get("enabled", False),
+        "channel_id": saved.get("channel_id"),
+        "channel_name": saved.get("channel_name", "Channel"),
+        "invite_link": saved.get("invite_link", "")
+    }
+
+
 def load_moderation_config(chat_id):
     """Load moderation config for a chat from database"""
     global moderation_config
-    if moderation_col is not None:
+    # After warm-up only chats known to have a document need a query (e.g. evicted from memory)
+    if moderation_col is not None and (not settings_warm or chat_id in settings_known_chats["moderation"]):
         saved = moderation_col.find_one({"chat_id": chat_id})
         if saved:
-            moderation_config[chat_id] = {
-                "enabled": saved.get("enabled", False),
-                "block_forward": saved.get("block_forward", False),
-                "block_links": saved.get("block_links", False),
-                "block_badwords": saved.get("block_badwords", False),
-                "block_mentions": saved.get("block_mentions", False),
-                "auto_delete_2min": saved.get("auto_delete_2min", False)
-            }
+            moderation_config[chat_id] = moderation_config_from_doc(saved)
             return moderation_config[chat_id]
-    return {"enabled": False, "block_forward": False, "block_links": False, "block_badwords": False, "block_mentions": False, "auto_delete_2min": False}
+    return default_moderation_config()
 
 
 def save_moderation_config(chat_id):
     """Save moderation config for a chat to database"""
+    group_pipeline_stages.pop(chat_id, None)
+    chat_rule_matchers.pop(chat_id, None)
     if moderation_col is not None and chat_id in moderation_config:
+        settings_known_chats["moderation"].add(chat_id)
         moderation_col.update_one(
             {"chat_id": chat_id},
             {"$set": {
                 **moderation_config[chat_id],
-                "chat_id": chat_id,
-                "updated_at": datetime.utcnow()
-            }},
+                "chat_id": chat_id
+            }, "$currentDate": {"updated_at": True}},
+            upsert=True
+        )
+
+
+def load_group_forcejoin(chat_id):
+    """Load force join config for a group from database"""
+    global group_forcejoin_config
+    if group_forcejoin_col is not None and (not settings_warm or chat_id in settings_known_chats["forcejoin"]):
+        saved = group_forcejoin_col.find_one({"chat_id": chat_id})
+        if saved:
+            group_forcejoin_config[chat_id] = forcejoin_config_from_doc(saved)
+            return group_forcejoin_config[chat_id]
+    return default_forcejoin_config()
+
+
+def save_group_forcejoin(chat_id):
+    """Save force join config for a group to database"""
+    group_pipeline_stages.pop(chat_id, None)
+    if group_forcejoin_col is not None and chat_id in group_forcejoin_config:
+        settings_known_chats["forcejoin"].add(chat_id)
+        group_forcejoin_col.update_one(
+            {"chat_id": chat_id},
+            {"$set": {
+                **group_forcejoin_config[chat_id],
+                "chat_id": chat_id
+            }, "$currentDate": {"updated_at": True}},
             upsert=True
         )
 
 
+def _settings_sources():
+    """(name, collection, store, from_doc) for every per-chat settings collection"""
+    return (
+        ("moderation", moderation_col, moderation_config, moderation_config_from_doc),
+        ("forcejoin", group_forcejoin_col, group_forcejoin_config, forcejoin_config_from_doc),
+    )
+
+
+def apply_settings_docs(name, store, from_doc, docs):
+    """Put (re)loaded settings documents into the cache; returns how many changed it"""
+    applied = 0
+    for saved in docs:
+        chat_id = saved.get("chat_id")
+        if chat_id is None:
+            continue
+        settings_known_chats[name].add(chat_id)
+        stamp = saved.get("updated_at")
+        if stamp is not None and (settings_synced_at[name] is None or stamp > settings_synced_at[name]):
+            settings_synced_at[name] = stamp
+        config = from_doc(saved)
+        if store.get(chat_id) == config:
+            continue  # Already cached (our own save, or re-read in the overlap window)
+        store[chat_id] = config
+        _drop_chat_caches(chat_id, None)
+        applied += 1
+    return applied
+
+
+def ensure_settings_indexes():
+    """updated_at indexes, so settings_sync_worker's polls don't scan the settings collections"""
+    if db is None:
+        return
+    try:
+        for _name, col, _store, _from_doc in _settings_sources():
+            col.create_index("updated_at")
+        config_col.create_index("updated_at")
+    except Exception as e:
+        print(f"⚠️ Settings index creation failed: {e}")
+
+
+def warm_settings_cache():
+    """Bulk-load all chat settings and bot_config (one query per collection)"""
+    global settings_warm, bot_config_cache
+    if db is None:
+        return
+    try:
+        counts = []
+        for name, col, store, from_doc in _settings_sources():
+            # Oldest first, so the most recently changed chats stay in memory if there are too many
+            docs = col.find({}).sort("updated_at", 1)
+            counts.append(f"{apply_settings_docs(name, store, from_doc, docs)} {name}")
+        bot_config_cache = config_col.find_one({}) or {}
+        settings_synced_at["bot_config"] = bot_config_cache.get("updated_at")
+        settings_warm = True
+        print(f"⚙️ Settings cache warm: {', '.join(counts)}")
+    except Exception as e:
+        print(f"⚠️ Settings warm-up failed (falling back to per-chat loads): {e}")
+
+
+def fetch_settings_changes():
+    """Documents saved since the last sync (plus the overlap window), per collection (runs in a worker thread)"""
+    def query(name):
+        since = settings_synced_at[name]
+        if since is None:
+            return {"updated_at": {"$exists": True}}
+        return {"updated_at": {"$gt": since - timedelta(seconds=SETTINGS_SYNC_OVERLAP)}}
+    
+    changes = {}
+    for name, col, _store, _from_doc in _settings_sources():
+        changes[name] = list(col.find(query(name)))
+    changes["bot_config"] = config_col.find_one(query("bot_config"))
+    return changes
+
+
+async def settings_sync_worker():
+    """Poll for settings saved by other instances and refresh the cache"""
+    global bot_config_cache
+    while True:
+        await asyncio.sleep(SETTINGS_POLL_INTERVAL)
+        if db is None or not settings_warm:
+            continue
+        try:
+            changes = await asyncio.to_thread(fetch_settings_changes)
+            for name, _col, store, from_doc in _settings_sources():
+                applied = apply_settings_docs(name, store, from_doc, changes[name])
+                if applied:
+                    print(f"⚙️ {applied} {name} setting(s) changed elsewhere")
+            if changes["bot_config"]:
+                bot_config_cache = changes["bot_config"]
+                stamp = bot_config_cache.get("updated_at")
+                if stamp is not None and (settings_synced_at["bot_config"] is None or stamp > settings_synced_at["bot_config"]):
+                    settings_synced_at["bot_config"] = stamp
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"⚠️ Settings sync error: {e}")
+
+
+# ============ COPY-PASTE SPAM FINGERPRINTS ============
+# Per chat, recent messages are fingerprinted (64-bit simhash of normalized 4-character shingles,
+# or the media file_unique_id) and indexed by eight 8-bit bands of the simhash. Two fingerprints
+# within DUP_MAX_DISTANCE (< 8) bits always share a band, so a lookup only compares a few candidates.
+DUP_WINDOW = int(os.getenv("DUP_WINDOW", "300"))  # Seconds a fingerprint is remembered
+DUP_MAX_PER_CHAT = 500  # Fingerprints kept per chat (oldest evicted first)
+DUP_MAX_DISTANCE = 7  # Max differing simhash bits for a near-duplicate (unrelated texts differ by ~32)
+DUP_MIN_CHARS = 20  # Shorter texts ("hi", "ok", "thanks") are not fingerprinted
+DUP_MEDIA_KINDS = ("photo", "video", "document", "audio", "voice")  # Stickers/GIFs are shared legitimately
+SIMHASH_MASK = (1 << 64) - 1
+# A chat quiet for DUP_WINDOW seconds has nothing left to compare against, so its store expires
+duplicate_store = StateStore("duplicate_store", STATE_MAX_CHATS, DUP_WINDOW)  # {chat_id: {"entries": deque[(ts, user_id, fingerprint, keys)], "index": {key: [entry, ...]}}}
+
+
+def simhash(text):
+    """64-bit simhash of a text's 4-character shingles (punctuation/emoji/case ignored), or None"""
+    normalized = " ".join(re.findall(r"\w+", normalize_moderation_text(text)))
+    if len(normalized) < DUP_MIN_CHARS:
+        return None
+    shingles = {normalized[i:i + 4] for i in range(len(normalized) - 3)}
+    
+    # Column-wise bit counts over the 64-char binary strings (zip/count run in C)
+    rows = [format(hash(shingle) & SIMHASH_MASK, "064b") for shingle in shingles]
+    half = len(rows) / 2
+    return int("".join("1" if column.count("1") > half else "0" for column in zip(*rows)), 2)
+
+
+def _evict_fingerprint(store, entry):
+    """Remove an entry from a chat's band/media index"""
+    for key in entry[3]:
+        bucket = store["index"].get(key)
+        if bucket is not None:
+            bucket.remove(entry)
+            if not bucket:
+                del store["index"][key]
+
+
+def is_duplicate_spam(chat_id, user_id, text=None, media_unique_id=None):
+    """Record a message's fingerprint; True if another user sent the same/near-same content recently"""
+    fingerprint = simhash(text) if text else None
+    if fingerprint is None and not media_unique_id:
+        return False
+    
+    now = time.time()
+    store = duplicate_store.setdefault(chat_id, {"entries": deque(), "index": {}})
+    entries = store["entries"]
+    while entries and (entries[0][0] <= now - DUP_WINDOW or len(entries) >= DUP_MAX_PER_CHAT):
+        _evict_fingerprint(store, entries.popleft())
+    
+    keys = []
+    if media_unique_id:
+        keys.append(("media", media_unique_id))
+    if fingerprint is not None:
+        keys.extend((band, fingerprint >> (8 * band) & 0xFF) for band in range(8))
+    
+    flagged = False
+    for key in keys:
+        for seen_at, seen_user, seen_fp, _ in store["index"].get(key, ()):
+            if seen_user == user_id:
+                continue
+            if key[0] == "media" or (seen_fp is not None and (seen_fp ^ fingerprint).bit_count() <= DUP_MAX_DISTANCE):
+                flagged = True
+                break
+        if flagged:
+            break
+    
+    entry = (now, user_id, fingerprint, tuple(keys))
+    entries.append(entry)
+    for key in keys:
+        store["index"].setdefault(key, []).append(entry)
+    return flagged
+
+
+def get_media_unique_id(message):
+    """file_unique_id of a message's photo/video/document/audio/voice, or None"""
+    for kind in DUP_MEDIA_KINDS:
+        media = getattr(message, kind, None)
+        if media is not None:
+            return media.file_unique_id
+    return None
+
+
+# ============ CUSTOM MODERATION RULES ============
+# Per-chat rules added by group admins (/addrule), stored in moderation_config[chat_id]["rules"]:
+#   words: blocked words/phrases      regexes: blocked patterns      allowed_domains: exempt from /blocklinks
+#   blocked_media: media kinds        max_caption: max caption length (0 = off)
+# Each chat's rules are compiled once (one automaton for all words, one alternation for all
+# regexes) and cached in chat_rule_matchers until save_moderation_config changes them.
+RULE_TYPES = {"word": "words", "regex": "regexes", "domain": "allowed_domains", "media": "blocked_media", "maxcaption": "max_caption"}
+RULE_MEDIA_KINDS = ("photo", "video", "document", "audio", "voice", "animation", "video_note", "sticker")
+MAX_RULES_PER_TYPE = 50
+MAX_RULE_REGEX_LENGTH = 200
+RULE_REGEX_SCAN_CHARS = 1000  # regexes only see the first N characters of a message
+chat_rule_matchers = {}  # {chat_id: compiled matcher or None if the chat has no rules}
+
+
+def has_custom_rules(rules):
+    """True if a rules dict has anything to enforce"""
+    return bool(rules) and any(rules.get(key) for key in RULE_TYPES.values())
+
+
+# Regex safety check (on the sre parse tree): rejects backreferences, quantified groups that contain
+# an open-ended quantifier or an alternation ((a+)+, (a|ab)*), and open-ended quantifiers next to
+# each other over overlapping characters (\d+\w+, .*.*). Character sets are compared on a sample
+# alphabet (Latin, Cyrillic, Arabic digits, whitespace, emoji).
+_REGEX_REPEATS = {sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, getattr(sre_parse, "POSSESSIVE_REPEAT", None)}
+_REGEX_GROUPREFS = {sre_parse.GROUPREF, sre_parse.GROUPREF_EXISTS, getattr(sre_parse, "GROUPREF_IGNORE", None)}
+_REGEX_ZERO_WIDTH = {sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT}
+_REGEX_SAMPLE_CHARS = "".join(map(chr, range(0x300))) + "абвгдеёжзАБВЖЯя٠١٢٣ \u00a0\u2003😀🔥"
+
+
+def _regex_char_matches(op, av, char):
+    """Whether a single-character node (LITERAL, IN, ANY, ...) can match char (case-insensitively)"""
+    variants = {c for c in (char, char.lower(), char.upper()) if len(c) == 1}
+    if op == sre_parse.LITERAL:
+        return chr(av) in variants or chr(av).lower() in variants
+    if op == sre_parse.NOT_LITERAL:
+        return not (chr(av) in variants or chr(av).lower() in variants)
+    if op == sre_parse.ANY:
+        return char != "\n"
+    if op == sre_parse.IN:
+        negate = bool(av) and av[0][0] == sre_parse.NEGATE
+        matched = any(_regex_set_item_matches(item_op, item_av, char, variants) for item_op, item_av in av[negate:])
+        return matched != negate
+    return True  # Anything else: assume it can match
+
+
+def _regex_set_item_matches(op, av, char, variants):
+    """One member of a [...] set against a character and its case variants"""
+    if op == sre_parse.LITERAL:
+        return chr(av) in variants
+    if op == sre_parse.RANGE:
+        return any(av[0] <= ord(c) <= av[1] for c in variants)
+    if op == sre_parse.CATEGORY:
+        tests = {
+            sre_parse.CATEGORY_DIGIT: char.isdecimal(), sre_parse.CATEGORY_NOT_DIGIT: not char.isdecimal(),
+            sre_parse.CATEGORY_SPACE: char.isspace(), sre_parse.CATEGORY_NOT_SPACE: not char.isspace(),
+            sre_parse.CATEGORY_WORD: char.isalnum() or char == "_",
+            sre_parse.CATEGORY_NOT_WORD: not (char.isalnum() or char == "_"),
+        }
+        return tests.get(av, True)
+    return True
+
+
+def _regex_charset(parsed):
+    """Sample characters any node of a parsed pattern can match"""
+    chars = set()
+    for op, av in parsed:
+        if op in _REGEX_REPEATS:
+            chars |= _regex_charset(av[2])
+        elif op == sre_parse.SUBPATTERN:
+            chars |= _regex_charset(av[3])
+        elif op == sre_parse.BRANCH:
+            for branch in av[1]:
+                chars |= _regex_charset(branch)
+        elif op not in _REGEX_ZERO_WIDTH:
+            chars.update(c for c in _REGEX_SAMPLE_CHARS if _regex_char_matches(op, av, c))
+    return chars
+
+
+def _regex_sequence(parsed):
+    """A pattern's top-level nodes with plain (unquantified) groups inlined"""
+    for op, av in parsed:
+        if op == sre_parse.SUBPATTERN:
+            yield from _regex_sequence(av[3])
+        else:
+            yield op, av
+
+
+def _check_regex_nodes(parsed):
+    """Raise ValueError if a parsed pattern can backtrack catastrophically"""
+    open_chars = set()  # characters of open-ended quantifiers that only empty-matching nodes separate from here
+    for op, av in _regex_sequence(parsed):
+        if op in _REGEX_GROUPREFS:
+            raise ValueError("backreferences are not allowed")
+        if op in _REGEX_REPEATS:
+            low, high, sub = av
+            inner = list(_regex_nodes(sub))
+            if high > 1 and any(
+                (o in _REGEX_REPEATS and a[1] == sre_parse.MAXREPEAT) or o == sre_parse.BRANCH for o, a in inner
+            ):
+                raise ValueError("a repeated group must not contain +, *, {n,} or | (like (a+)+ or (a|ab)*)")
+            _check_regex_nodes(sub)
+            if high == sre_parse.MAXREPEAT:
+                chars = _regex_charset(sub)
+                if open_chars & chars:
+                    raise ValueError("open-ended quantifiers next to each other must not match the same characters (like \\d+\\w+ or .*.*)")
+                open_chars = open_chars | chars if low == 0 else chars
+            elif low > 0:
+                open_chars = set()
+            continue
+        if op == sre_parse.BRANCH:
+            for branch in av[1]:
+                _check_regex_nodes(branch)
+        elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            _check_regex_nodes(av[1])
+        elif op == getattr(sre_parse, "ATOMIC_GROUP", None):
+            _check_regex_nodes(av)
+        if op not in _REGEX_ZERO_WIDTH:
+            open_chars = set()
+
+
+def _regex_nodes(parsed):
+    """All (op, av) nodes of a parsed pattern, depth first"""
+    for op, av in parsed:
+        yield op, av
+        if op in _REGEX_REPEATS:
+            yield from _regex_nodes(av[2])
+        elif op == sre_parse.BRANCH:
+            for branch in av[1]:
+                yield from _regex_nodes(branch)
+        elif op == sre_parse.SUBPATTERN:
+            yield from _regex_nodes(av[3])
+        elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            yield from _regex_nodes(av[1])
+        elif op == getattr(sre_parse, "ATOMIC_GROUP", None):
+            yield from _regex_nodes(av)
+
+
+def check_rule_regex(pattern):
+    """Reject patterns that can backtrack catastrophically. Returns an error message or None"""
+    try:
+        _check_regex_nodes(sre_parse.parse(pattern, re.IGNORECASE))
+    except re.error as e:
+        return f"Invalid regex: {e}"
+    except ValueError as e:
+        return f"Unsafe regex: {e}"
+    return None
+
+
+def compile_rule_regexes(patterns):
+    """Combine rule regexes into one pattern; group r<i> tells which rule matched"""
+    if not patterns:
+        return None
+    return re.compile("|".join(f"(?P<r{i}>{pattern})" for i, pattern in enumerate(patterns)), re.IGNORECASE)
+
+
+def compile_chat_rules(rules):
+    """Compile a chat's custom rules into a single matcher, or None if there are none"""
+    if not has_custom_rules(rules):
+        return None
+    words = rules.get("words") or []
+    # Rules saved before the safety check (or by hand) are re-checked; unsafe ones are skipped
+    regexes = []
+    for pattern in rules.get("regexes") or []:
+        error = check_rule_regex(pattern)
+        if error:
+            print(f"⚠️ Custom rule regex ignored ({error}): {pattern}")
+        else:
+            regexes.append(pattern)
+    try:
+        regex = compile_rule_regexes(regexes)
+    except re.error as e:
+        print(f"⚠️ Invalid custom rule regex ignored: {e}")
+        regex, regexes = None, []
+    return {
+        # Short words only match as whole words ("mc" must not hit "mcdonalds"); folded like the text
+        "words": build_word_automaton(words, [w for w in words if len(w) <= 3], fold_leet=True) if words else None,
+        # Folded key -> word as the admin typed it (for rule ids in stats)
+        "word_names": {normalize_moderation_text(w): w for w in words},
+        "regex": regex,
+        "regex_sources": regexes,
+        "allowed_domains": tuple(d.lower() for d in rules.get("allowed_domains") or []),
+        "blocked_media": frozenset(rules.get("blocked_media") or []),
+        "max_caption": int(rules.get("max_caption") or 0),
+    }
+
+
+def get_chat_rule_matcher(chat_id, config):
+    """Cached compiled rules for a chat"""
+    if chat_id not in chat_rule_matchers:
+        chat_rule_matchers[chat_id] = compile_chat_rules(config.get("rules"))
+    return chat_rule_matchers[chat_id]
+
+
+def extract_link_domains(text, entities):
+    """Hostnames of all links in a message (url / text_link entities, regex fallback)"""
+    urls = []
+    if entities:
+        encoded = None
+        for entity in entities:
+            if entity.type == MessageEntityType.TEXT_LINK:
+                urls.append(entity.url)
+            elif entity.type == MessageEntityType.URL:
+                # Entity offsets are in UTF-16 code units
+                encoded = encoded or text.encode("utf-16-le")
+                urls.append(encoded[entity.offset * 2:(entity.offset + entity.length) * 2].decode("utf-16-le"))
+    else:
+        urls = [m.group("link") for m in LINK_MENTION_PATTERN.finditer(text or "") if m.lastgroup == "link"]
+    
+    domains = set()
+    for url in urls:
+        try:
+            host = urlsplit(url if "://" in url else "http://" + url).hostname or ""
+        except ValueError:
+            host = ""
+        domains.add(host[4:] if host.startswith("www.") else host)
+    return domains
+
+
+def is_domain_allowed(domain, allowed_domains):
+    """domain equals or is a subdomain of an allowed domain"""
+    return any(domain == allowed or domain.endswith("." + allowed) for allowed in allowed_domains)
+
+
+def match_chat_rules(matcher, message, text, normalized):
+    """Check a message against compiled custom rules. Returns (rule_id, reason) or None"""
+    if matcher["blocked_media"]:
+        kind, _ = get_message_media(message)
+        if kind in matcher["blocked_media"]:
+            return f"media:{kind}", f"{kind.replace('_', ' ').title()} not allowed"
+    
+    if matcher["max_caption"] and message.caption and len(message.caption) > matcher["max_caption"]:
+        return "maxcaption", f"Caption longer than {matcher['max_caption']} characters"
+    
+    if text and matcher["words"] is not None:
+        hits = find_words(matcher["words"], normalized, first_only=True)
+        if hits:
+            return f"word:{matcher['word_names'].get(hits[0][0], hits[0][0])}", "Blocked word"
+    
+    if text and matcher["regex"] is not None:
+        match = matcher["regex"].search(text[:RULE_REGEX_SCAN_CHARS])
+        if match:
+            return f"regex:{matcher['regex_sources'][int(match.lastgroup[1:])]}", "Blocked pattern"
+    return None
+
+
+# ============ SHADOW MODE / RULE STATS ============
+# Every moderation rule evaluation is recorded per chat and per rule. With /shadowmode on, rules
+# are evaluated and recorded but nothing is deleted; admins reply /falsepositive to a flagged
+# message so /rulestats can show an estimated false positive rate before enforcing for real.
+SHADOW_FLAGGED_MAX = int(os.getenv("SHADOW_FLAGGED_MAX", "200"))  # flagged messages remembered per chat
+chat_rule_stats = StateStore("chat_rule_stats", STATE_MAX_CHATS, STATE_CHAT_TTL)  # {chat_id: {"messages": n, "eval_time": s, "rules": {rule_id: {"evaluated", "hits", "false_positives", "eval_time"}}}}
+shadow_flagged = StateStore("shadow_flagged", STATE_MAX_CHATS, STATE_CHAT_TTL)  # {chat_id: {message_id: [rule_id, ...]}} (insertion-ordered, oldest evicted)
+
+
+def get_chat_rule_stats(chat_id):
+    """Stats record for a chat, created on first use"""
+    return chat_rule_stats.setdefault(chat_id, {"messages": 0, "eval_time": 0.0, "rules": {}})
+
+
+def record_rule_eval(chat_id, rule_id, elapsed, hit):
+    """Count one evaluation of a rule (and its time); hit=True also counts a hit"""
+    stats = get_chat_rule_stats(chat_id)
+    rule = stats["rules"].get(rule_id)
+    if rule is None:
+        rule = stats["rules"][rule_id] = {"evaluated": 0, "hits": 0, "false_positives": 0, "eval_time": 0.0}
+    rule["evaluated"] += 1
+    rule["eval_time"] += elapsed
+    if hit:
+        rule["hits"] += 1
+
+
+def record_rule_hit(chat_id, rule_id):
+    """Count a hit for a rule that is evaluated as part of another (custom rules share one matcher)"""
+    rules = get_chat_rule_stats(chat_id)["rules"]
+    rule = rules.get(rule_id)
+    if rule is None:
+        rule = rules[rule_id] = {"evaluated": 0, "hits": 0, "false_positives": 0, "eval_time": 0.0}
+    rule["hits"] += 1
+
+
+def record_shadow_flag(chat_id, message_id, rule_id):
+    """Remember which rules flagged a message that shadow mode left in place"""
+    flagged = shadow_flagged.setdefault(chat_id, {})
+    if message_id not in flagged:
+        if len(flagged) >= SHADOW_FLAGGED_MAX:
+            flagged.pop(next(iter(flagged)))
+        flagged[message_id] = []
+    flagged[message_id].append(rule_id)
+
+
+def mark_false_positive(chat_id, message_id):
+    """Count a flagged message as a false positive for each rule that hit it. Returns the rule ids"""
+    rule_ids = shadow_flagged.get(chat_id, {}).pop(message_id, None)
+    if not rule_ids:
+        return []
+    rules = get_chat_rule_stats(chat_id)["rules"]
+    for rule_id in rule_ids:
+        if rule_id in rules:
+            rules[rule_id]["false_positives"] += 1
+    return rule_ids
+
+
+def format_rule_stats(chat_id):
+    """Per-rule report for /rulestats"""
+    stats = chat_rule_stats.get(chat_id)
+    if not stats or not stats["messages"]:
+        return "📊 No messages evaluated yet."
+    
+    avg_ms = stats["eval_time"] / stats["messages"] * 1000
+    lines = [
+        "📊 **Rule Stats**\n",
+        f"Messages checked: {stats['messages']} (avg {avg_ms:.2f} ms)\n",
+    ]
+    for rule_id, rule in sorted(stats["rules"].items(), key=lambda item: -item[1]["hits"]):
+        line = f"• `{rule_id}` - {rule['hits']} hits"
+        if rule["hits"]:
+            fp_rate = rule["false_positives"] / rule["hits"] * 100
+            line += f", {rule['false_positives']} false ({fp_rate:.0f}%)"
+        if rule["evaluated"]:
+            line += f", {rule['eval_time'] / rule['evaluated'] * 1_000_000:.0f} µs"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+# /command or /command@BotUsername at the start of a message
+COMMAND_PATTERN = re.compile(r"/([A-Za-z0-9_]+)(?:@[A-Za-z0-9_]+)?(?:\s|$)")
+
+# Commands that skip the group message pipeline (moderation / force join / auto-delete)
+PIPELINE_EXEMPT_COMMANDS = {
+    "setforcejoin", "removeforcejoin", "forcejoininfo", "enablemod", "disablemod", "blockforward",
+    "blocklinks", "blockbadwords", "blockmention", "blockduplicates", "autodelete2min", "modstatus", "warnings", "resetwarnings",
+    "addrule", "delrule", "rules", "shadowmode", "rulestats", "falsepositive"
+}
+
+# Link/mention scanner: Telegram's parsed entities first, one precompiled regex as fallback
+LINK_MENTION_PATTERN = re.compile(
+    r"(?P<link>https?://\S+|(?:t\.me|telegram\.me)/[a-zA-Z0-9_]+)|(?P<mention>@[a-zA-Z0-9_]{3,})",
+    re.IGNORECASE
+)
+LINK_ENTITY_TYPES = {MessageEntityType.URL, MessageEntityType.TEXT_LINK}  # TEXT_LINK = hidden link behind text
+MENTION_ENTITY_TYPES = {MessageEntityType.MENTION}
+
+
+def scan_links_and_mentions(text, entities=None):
+    """Return (has_link, has_mention) for a message text/caption.
+    
+    Uses Telegram's entities (url, text_link, mention) when present, which also catches
+    hidden text links; otherwise falls back to a single regex pass over the text.
+    """
+    if entities:
+        has_link = any(e.type in LINK_ENTITY_TYPES for e in entities)
+        has_mention = any(e.type in MENTION_ENTITY_TYPES for e in entities)
+        return has_link, has_mention
+    
+    has_link = has_mention = False
+    for match in LINK_MENTION_PATTERN.finditer(text or ""):
+        if match.lastgroup == "link":
+            has_link = True
+        else:
+            has_mention = True
+        if has_link and has_mention:
+            break
+    return has_link, has_mention
+
+
 def contains_link(text):
     """Check if text contains any URL/link (not @mentions)"""
-    import re
-    url_pattern = r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+'
-    tg_pattern = r'(?:t\.me|telegram\.me)/[a-zA-Z0-9_]+'
-    
-    if re.search(url_pattern, text, re.IGNORECASE):
-        return True
-    if re.search(tg_pattern, text, re.IGNORECASE):
-        return True
-    return False
+    return scan_links_and_mentions(text)[0]
 
 
 def contains_mention(text):
     """Check if text contains @username mentions"""
-    import re
-    # Match @username pattern (at least 3 characters after @)
-    mention_pattern = r'@[a-zA-Z0-9_]{3,}'
-    return bool(re.search(mention_pattern, text))
+    return scan_links_and_mentions(text)[1]
+
+
+def normalize_moderation_text(text, fold_leet=True):
+    """Fold text for matching: casefold, NFKD (fancy/bold letters), strip accents, leetspeak"""
+    text = unicodedata.normalize("NFKD", text.casefold())
+    text = "".join(ch for ch in text if unicodedata.category(ch) != "Mn")
+    if fold_leet:
+        text = text.translate(LEET_TABLE)
+    return text
+
+
+def build_word_automaton(words, whole_words=(), fold_leet=False):
+    """Compile words into an Aho-Corasick automaton.
+    
+    fold_leet=True folds the words like the scanned text ("1xbet" -> "ixbet"), so words
+    containing digits/symbols can still match. Returns {"goto": [{char: state}], "fail": [state], "out": [[(word, whole_word)]]},
+    so every occurrence of every word is found in a single pass over the text.
+    """
+    goto, fail, out = [{}], [0], [[]]
+    
+    # Trie of all (normalized) words
+    for word in dict.fromkeys(words):
+        key = normalize_moderation_text(word, fold_leet=fold_leet)
+        if not key:
+            continue
+        state = 0
+        for ch in key:
+            if ch not in goto[state]:
+                goto.append({})
+                fail.append(0)
+                out.append([])
+                goto[state][ch] = len(goto) - 1
+            state = goto[state][ch]
+        out[state].append((key, word in whole_words))
+    
+    # Failure links (breadth-first); outputs of the fail state are inherited
+    queue = list(goto[0].values())
+    while queue:
+        state = queue.pop(0)
+        for ch, nxt in goto[state].items():
+            queue.append(nxt)
+            f = fail[state]
+            while f and ch not in goto[f]:
+                f = fail[f]
+            fail[nxt] = goto[f][ch] if state and ch in goto[f] else 0
+            out[nxt] = out[nxt] + out[fail[nxt]]
+    
+    return {"goto": goto, "fail": fail, "out": out}
+
+
+def find_words(automaton, text, first_only=False):
+    """Return [(word, start, end)] for every automaton hit in the (already normalized) text.
+    
+    Whole-word entries only count when not surrounded by letters/digits.
+    """
+    goto, fail, out = automaton["goto"], automaton["fail"], automaton["out"]
+    hits = []
+    state = 0
+    for i, ch in enumerate(text):
+        while state and ch not in goto[state]:
+            state = fail[state]
+        state = goto[state].get(ch, 0)
+        for word, whole_word in out[state]:
+            start = i - len(word) + 1
+            if whole_word and (
+                (start > 0 and text[start - 1].isalnum()) or
+                (i + 1 < len(text) and text[i + 1].isalnum())
+            ):
+                continue
+            hits.append((word, start, i + 1))
+            if first_only:
+                return hits
+    return hits
+
+
+BAD_WORDS_AUTOMATON = build_word_automaton(BAD_WORDS, BAD_WORDS_WHOLE_WORD)
 
 
 def contains_bad_words(text):
-    """Check if text contains inappropriate words"""
-    text_lower = text.lower()
-    for word in BAD_WORDS:
-        if word in text_lower:
-            return True
-    return False
+    """Check if text contains inappropriate words (one pass, boundary-aware, leetspeak-folded)"""
+    return bool(find_words(BAD_WORDS_AUTOMATON, normalize_moderation_text(text), first_only=True))
 
 
 def get_config():
-    """Get bot configuration from database"""
-    if config_col is not None:
-        return config_col.find_one({}) or {}
-    return {}
+    """Get bot configuration (cached; loaded from database on first use)"""
+    global bot_config_cache
+    if bot_config_cache is None and config_col is not None:
+        bot_config_cache = config_col.find_one({}) or {}
+    return bot_config_cache or {}
 
 
 def save_config(source_channel, dest_channel):
     """Save bot configuration to database"""
+    global bot_config_cache
+    updates = {
+        "source_channel": source_channel,
+        "dest_channel": dest_channel
+    }
+    bot_config_cache = {**(bot_config_cache or {}), **updates}
     if config_col is not None:
-        config_col.update_one(
-            {},
-            {"$set": {
-                "source_channel": source_channel,
-                "dest_channel": dest_channel,
-                "updated_at": datetime.utcnow()
-            }},
-            upsert=True
-        )
+        config_col.update_one({}, {"$set": updates, "$currentDate": {"updated_at": True}}, upsert=True)
 
 
 def load_force_subscribe():
     """Load force subscribe channels from database AND environment variables"""
     global force_subscribe_channels
     force_subscribe_channels = []
+    force_sub_verified.clear()
     
     # Load from database first
     if force_sub_col is not None:
@@ -399,6 +1324,8 @@ def load_force_subscribe():
 def add_force_subscribe(channel_id, channel_name, invite_link):
     """Add a force subscribe channel"""
     global force_subscribe_channels
+    # A new channel means previously verified users must be checked again
+    force_sub_verified.clear()
     if force_sub_col is not None:
         # Check if already exists
         existing = force_sub_col.find_one({"channel_id": str(channel_id)})
@@ -435,31 +1362,174 @@ def remove_force_subscribe(channel_id):
     return True
 
 
-async def check_user_joined(client, user_id):
-    """Check if user has joined all force subscribe channels"""
+# Users who passed all force subscribe checks recently (dropped FORCE_SUB_VERIFIED_TTL seconds after passing)
+FORCE_SUB_VERIFIED_TTL = int(os.getenv("FORCE_SUB_VERIFIED_TTL", "120"))
+force_sub_verified = StateStore(
+    "force_sub_verified", STATE_MAX_USERS, FORCE_SUB_VERIFIED_TTL, sliding=False
+)  # {user_id: True}
+
+
+def _force_sub_chat_ref(channel_id):
+    """Channel id as stored -> value accepted by get_chat_member"""
+    return int(channel_id) if channel_id.startswith("-") else channel_id
+
+
+async def check_user_joined(client, user_id, recheck=False):
+    """Check if user has joined all force subscribe channels.
+    
+    All channels are checked concurrently; a passing user is remembered for
+    FORCE_SUB_VERIFIED_TTL seconds. recheck=True re-asks channels cached as not joined.
+    """
     if not force_subscribe_channels:
         return True, []
     
-    not_joined = []
-    for channel in force_subscribe_channels:
+    if user_id in force_sub_verified:
+        return True, []
+    
+    channels = list(force_subscribe_channels)
+    results = await asyncio.gather(*[
+        is_channel_member(client, _force_sub_chat_ref(channel["channel_id"]), user_id, recheck_negative=recheck)
+        for channel in channels
+    ])
+    not_joined = [channel for channel, joined in zip(channels, results) if not joined]
+    
+    if not not_joined:
+        force_sub_verified[user_id] = True
+    return len(not_joined) == 0, not_joined
+
+
+# ============ GROUP ADMIN CACHE ============
+# Admin set per group, loaded with one administrators-filtered listing instead of
+# one get_chat_member call per message. Refreshed after ADMIN_CACHE_TTL seconds and
+# kept in sync by chat_member_updated events.
+ADMIN_CACHE_TTL = int(os.getenv("ADMIN_CACHE_TTL", "600"))
+group_admin_cache = StateStore("group_admin_cache", STATE_MAX_CHATS, STATE_CHAT_TTL)  # {chat_id: {"admins": set(user_ids) or None if listing failed, "loaded_at": timestamp}}
+group_admin_locks = StateStore(
+    "group_admin_locks", STATE_MAX_CHATS, STATE_CHAT_TTL, keep=lambda lock: lock.locked()
+)  # {chat_id: asyncio.Lock} - one listing per chat at a time
+ADMIN_STATUSES = (ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER)
+
+
+async def get_group_admins(client, chat_id):
+    """Return the cached admin id set for a group (None if the admin list can't be read)"""
+    entry = group_admin_cache.get(chat_id)
+    if entry and time.time() - entry["loaded_at"] < ADMIN_CACHE_TTL:
+        return entry["admins"]
+    
+    lock = group_admin_locks.setdefault(chat_id, asyncio.Lock())
+    async with lock:
+        # Another task may have loaded it while we waited
+        entry = group_admin_cache.get(chat_id)
+        if entry and time.time() - entry["loaded_at"] < ADMIN_CACHE_TTL:
+            return entry["admins"]
+        
+        admins = set()
         try:
-            channel_id = channel["channel_id"]
-            # Try to get chat member status
-            if channel_id.startswith("-"):
-                chat_id = int(channel_id)
-            elif channel_id.startswith("@"):
-                chat_id = channel_id
-            else:
-                chat_id = channel_id
-            
-            member = await client.get_chat_member(chat_id, user_id)
-            if member.status in ["left", "kicked", "banned"]:
-                not_joined.append(channel)
+            async for member in client.get_chat_members(chat_id, filter=ChatMembersFilter.ADMINISTRATORS):
+                if member.user:
+                    admins.add(member.user.id)
+        except FloodWait as e:
+            print(f"⏳ Admin list FloodWait {e.value}s for {chat_id}, using previous list")
+            # Keep the previous list (or "unknown") until the wait is over, so later messages don't retry
+            admins = entry["admins"] if entry else None
+            group_admin_cache[chat_id] = {"admins": admins, "loaded_at": time.time() - ADMIN_CACHE_TTL + e.value}
+            return admins
         except Exception as e:
-            # If we can't check, assume not joined
-            not_joined.append(channel)
+            print(f"⚠️ Admin list load failed for {chat_id}: {e}")
+            admins = None
+        
+        group_admin_cache[chat_id] = {"admins": admins, "loaded_at": time.time()}
+        return admins
+
+
+async def is_chat_admin(client, chat_id, user_id):
+    """Check if user is admin/owner of a group. Returns True/False, or None if it can't be verified"""
+    admins = await get_group_admins(client, chat_id)
+    if admins is not None:
+        return user_id in admins
     
-    return len(not_joined) == 0, not_joined
+    # Admin list not readable in this chat - fall back to a single member lookup
+    try:
+        member = await client.get_chat_member(chat_id, user_id)
+        return member.status in ADMIN_STATUSES
+    except Exception as e:
+        print(f"⚠️ get_chat_member failed: {e}")
+        return None
+
+
+def update_group_admin_cache(chat_id, user_id, is_admin_now):
+    """Apply a chat_member_updated change to the cached admin set"""
+    entry = group_admin_cache.get(chat_id)
+    if not entry or entry["admins"] is None:
+        return
+    if is_admin_now:
+        entry["admins"].add(user_id)
+    else:
+        entry["admins"].discard(user_id)
+
+
+# ============ CHANNEL MEMBERSHIP CACHE ============
+# (channel, user) -> joined? Positive answers are trusted for longer than negative ones
+# so a user who just joined isn't blocked for long. Concurrent lookups for the same key
+# share one get_chat_member call, and join/leave updates overwrite entries directly.
+# Failed lookups (FloodWait, no access to the channel, ...) are not cached.
+MEMBERSHIP_POSITIVE_TTL = int(os.getenv("MEMBERSHIP_POSITIVE_TTL", "600"))
+MEMBERSHIP_NEGATIVE_TTL = int(os.getenv("MEMBERSHIP_NEGATIVE_TTL", "30"))
+MEMBERSHIP_CACHE_MAX = 50000
+membership_cache = StateStore(
+    "membership_cache", MEMBERSHIP_CACHE_MAX, MEMBERSHIP_POSITIVE_TTL, sliding=False
+)  # {(chat_key, user_id): {"joined": bool, "expires": timestamp}}
+membership_inflight = {}  # {(chat_key, user_id): asyncio.Task} - singleflight lookups
+
+
+def membership_chat_key(chat_ref):
+    """Normalize a channel reference (-100.. id, @username, username) into a cache key"""
+    if isinstance(chat_ref, int):
+        return chat_ref
+    ref = str(chat_ref).strip()
+    if ref.lstrip("-").isdigit():
+        return int(ref)
+    return ref.lstrip("@").lower()
+
+
+def set_membership(chat_ref, user_id, joined):
+    """Store a membership answer with the TTL for its polarity"""
+    ttl = MEMBERSHIP_POSITIVE_TTL if joined else MEMBERSHIP_NEGATIVE_TTL
+    membership_cache[(membership_chat_key(chat_ref), user_id)] = {"joined": joined, "expires": time.time() + ttl}
+
+
+async def _load_membership(client, chat_ref, user_id):
+    """Ask Telegram whether user is in chat and cache the answer"""
+    try:
+        member = await client.get_chat_member(chat_ref, user_id)
+        joined = member.status not in (ChatMemberStatus.LEFT, ChatMemberStatus.BANNED)
+    except UserNotParticipant:
+        joined = False
+    except Exception as e:
+        # Can't check right now: treat as not joined, but ask again next time
+        print(f"⚠️ Membership check failed for {user_id} in {chat_ref}: {e}")
+        return False
+    set_membership(chat_ref, user_id, joined)
+    return joined
+
+
+async def is_channel_member(client, chat_ref, user_id, recheck_negative=False):
+    """Check if user has joined a channel/group, served from cache when possible.
+    
+    recheck_negative=True ignores a cached "not joined" (used by "I've Joined" buttons).
+    """
+    key = (membership_chat_key(chat_ref), user_id)
+    entry = membership_cache.get(key)
+    if entry and entry["expires"] > time.time() and (entry["joined"] or not recheck_negative):
+        return entry["joined"]
+    
+    task = membership_inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_load_membership(client, chat_ref, user_id))
+        membership_inflight[key] = task
+        task.add_done_callback(lambda _: membership_inflight.pop(key, None))
+    # shield: a cancelled caller must not cancel the lookup other callers are waiting on
+    return await asyncio.shield(task)
 
 
 def is_admin(user_id):
@@ -477,11 +1547,83 @@ async def safe_edit_message(message, text, reply_markup=None):
         print(f"Error editing message: {e}")
 
 
+def _load_referral_count(user_id):
+    """Referral count of a user from the counter collection"""
+    if referral_counts_col is None:
+        return 0
+    doc = referral_counts_col.find_one({"referrer_id": user_id})
+    return doc.get("count", 0) if doc else 0
+
+
+# Referral counts per referrer (cached; misses read one counter document). The TTL runs from load
+# time, so referrals counted by another instance show up within REFERRAL_COUNT_TTL seconds.
+REFERRAL_COUNT_TTL = int(os.getenv("REFERRAL_COUNT_TTL", "60"))
+REFERRAL_RECONCILE_INTERVAL = int(os.getenv("REFERRAL_RECONCILE_INTERVAL", "300"))  # Seconds between counter catch-ups
+REFERRAL_RECONCILE_GRACE = 60  # Seconds add_referral has to count a new referral itself before the catch-up may
+referral_counts = StateStore(
+    "referral_counts", STATE_MAX_USERS, REFERRAL_COUNT_TTL, loader=_load_referral_count, sliding=False
+)
+referral_reconcile_task = None  # Background counter catch-up
+
+
+def ensure_referral_indexes():
+    """Indexes for counter lookups and for finding uncounted referrals"""
+    if referrals_col is None or referral_counts_col is None:
+        return
+    try:
+        referral_counts_col.create_index("referrer_id", unique=True)
+        referrals_col.create_index("user_id")
+        # Uncounted referrals are found by counted (missing or False) and age
+        referrals_col.create_index([("counted", 1), ("referred_at", 1)])
+    except Exception as e:
+        print(f"⚠️ Referral index creation failed: {e}")
+
+
+def count_uncounted_referrals():
+    """Add referrals not yet in a counter (older data, or inserted by an older bot version) to the counters.
+    
+    Each referral is claimed by setting counted=True, and a counter grows by exactly the number of
+    documents this call claimed, so concurrent instances never count a referral twice. Referrals
+    younger than REFERRAL_RECONCILE_GRACE are left to the add_referral call that is counting them.
+    Returns the number of referrals added.
+    """
+    if referrals_col is None or referral_counts_col is None:
+        return 0
+    # {"$in": [None, False]} also matches a missing field and, unlike $exists: False, uses the index
+    uncounted = {
+        "counted": {"$in": [None, False]},
+        "referred_at": {"$lt": datetime.utcnow() - timedelta(seconds=REFERRAL_RECONCILE_GRACE)},
+    }
+    added = 0
+    for row in referrals_col.aggregate([{"$match": uncounted}, {"$group": {"_id": "$referrer_id"}}]):
+        referrer_id = row["_id"]
+        claimed = referrals_col.update_many({"referrer_id": referrer_id, **uncounted}, {"$set": {"counted": True}})
+        if claimed.modified_count:
+            referral_counts_col.update_one(
+                {"referrer_id": referrer_id}, {"$inc": {"count": claimed.modified_count}}, upsert=True
+            )
+            referral_counts.pop(referrer_id, None)
+            added += claimed.modified_count
+    return added
+
+
+async def referral_reconcile_worker():
+    """Periodically fold referrals saved without a counter update into the counters"""
+    while True:
+        try:
+            added = await asyncio.to_thread(count_uncounted_referrals)
+            if added:
+                print(f"📊 Added {added} uncounted referral(s) to the counters")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"⚠️ Referral counter catch-up failed: {e}")
+        await asyncio.sleep(REFERRAL_RECONCILE_INTERVAL)
+
+
 def get_referral_count(user_id):
-    """Get number of users referred by this user"""
-    if referrals_col is not None:
-        return referrals_col.count_documents({"referrer_id": user_id})
-    return 0
+    """Get number of users referred by this user (cached counter, no scan of referrals)"""
+    return referral_counts[user_id]
 
 
 def get_user_referrer(user_id):
@@ -508,8 +1650,21 @@ def add_referral(user_id, referrer_id):
         referrals_col.insert_one({
             "user_id": user_id,
             "referrer_id": referrer_id,
-            "referred_at": datetime.utcnow()
+            "referred_at": datetime.utcnow(),
+            "counted": False,
         })
+        
+        # Keep the referrer's counter (and its cached value) in step, then flag the referral as
+        # counted. If this stops halfway, count_uncounted_referrals adds it after the grace period.
+        if referral_counts_col is not None:
+            doc = referral_counts_col.find_one_and_update(
+                {"referrer_id": referrer_id},
+                {"$inc": {"count": 1}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            referral_counts[referrer_id] = doc.get("count", 0)
+            referrals_col.update_one({"user_id": user_id}, {"$set": {"counted": True}})
         return True
     return False
 
@@ -657,11 +1812,100 @@ def get_watermark_position(base_size, watermark_size, position):
     return positions.get(position, positions["bottom-right"])
 
 
-def add_image_watermark(image_bytes, logo_bytes, position="bottom-right", opacity=128, size_percent=20):
+def get_jpeg_settings(source_image):
+    """Pick encoder settings that match the source JPEG's quality (capped) and subsampling"""
+    settings = {"quality": WATERMARK_JPEG_MAX_QUALITY, "subsampling": -1}
+    qtables = getattr(source_image, "quantization", None)
+    if source_image.format == "JPEG" and qtables and 0 in qtables:
+        # IJG scaling: quality 50 = standard table, lower tables = higher quality
+        scale = sum(qtables[0]) * 100 / sum(STD_LUMA_QTABLE)
+        estimated = (200 - scale) / 2 if scale <= 100 else 5000 / scale
+        settings["quality"] = max(1, min(WATERMARK_JPEG_MAX_QUALITY, round(estimated)))
+        settings["subsampling"] = JpegImagePlugin.get_sampling(source_image)
+    return settings
+
+
+def encode_jpeg(image, settings):
+    """Encode an RGB image as JPEG with optimized Huffman tables"""
+    output = io.BytesIO()
+    options = {
+        "format": "JPEG",
+        "quality": settings["quality"],
+        "optimize": True,
+        "progressive": WATERMARK_JPEG_PROGRESSIVE
+    }
+    if settings["subsampling"] >= 0:
+        options["subsampling"] = settings["subsampling"]
+    image.save(output, **options)
+    return output.getvalue()
+
+
+def pick_auto_position(base_image, watermark_size, mode="auto", watermark_luma=255):
+    """Pick a corner for the watermark from a downscaled luminance map.
+    
+    "auto" picks the least busy corner (lowest luminance variance), "auto-contrast"
+    the corner whose mean luminance differs most from the watermark's.
+    """
+    base_w, base_h = base_image.size
+    wm_w, wm_h = watermark_size
+    padding = 10
+    
+    # Downscale first (cheap box filter), then convert to luminance
+    scale = min(1.0, AUTO_ANALYSIS_SIZE / max(base_w, base_h))
+    small_w, small_h = max(1, int(base_w * scale)), max(1, int(base_h * scale))
+    if scale < 1.0:
+        luma = base_image.resize((small_w, small_h), Image.Resampling.BOX).convert("L")
+    else:
+        luma = base_image.convert("L")
+    
+    # Corner tiles cover the area the watermark would occupy
+    tile_w = min(small_w, max(1, math.ceil((wm_w + padding) * scale)))
+    tile_h = min(small_h, max(1, math.ceil((wm_h + padding) * scale)))
+    tiles = {
+        "top-left": (0, 0, tile_w, tile_h),
+        "top-right": (small_w - tile_w, 0, small_w, tile_h),
+        "bottom-left": (0, small_h - tile_h, tile_w, small_h),
+        "bottom-right": (small_w - tile_w, small_h - tile_h, small_w, small_h),
+    }
+    
+    best_position, best_score = "bottom-right", None
+    for position, box in tiles.items():
+        stat = ImageStat.Stat(luma.crop(box))
+        if mode == "auto-contrast":
+            score = abs(stat.mean[0] - watermark_luma)
+        else:
+            score = -stat.var[0]
+        if best_score is None or score > best_score:
+            best_position, best_score = position, score
+    return best_position
+
+
+def resolve_watermark_position(base_image, watermark_size, position, watermark_luma=255, album_id=None):
+    """Turn an "auto" position into a concrete corner (cached per album)"""
+    if position not in AUTO_POSITIONS:
+        return position
+    
+    cache_key = (album_id, position)
+    if album_id and cache_key in auto_position_cache:
+        return auto_position_cache[cache_key]
+    
+    picked = pick_auto_position(base_image, watermark_size, position, watermark_luma)
+    
+    if album_id:
+        auto_position_cache[cache_key] = picked
+        # Drop the oldest album when the cache is full (dicts keep insertion order)
+        if len(auto_position_cache) > AUTO_POSITION_CACHE_MAX:
+            auto_position_cache.pop(next(iter(auto_position_cache)))
+    return picked
+
+
+def add_image_watermark(image_bytes, logo_bytes, position="bottom-right", opacity=128, size_percent=20, album_id=None):
     """Add image logo watermark to an image"""
     try:
-        # Open base image
-        base_image = Image.open(io.BytesIO(image_bytes)).convert("RGBA")
+        # Open base image (keep the source's JPEG settings for re-encoding)
+        source_image = Image.open(io.BytesIO(image_bytes))
+        jpeg_settings = get_jpeg_settings(source_image)
+        base_image = source_image.convert("RGBA")
         logo = Image.open(io.BytesIO(logo_bytes)).convert("RGBA")
         
         # Calculate logo size (percentage of base image)
@@ -676,32 +1920,30 @@ def add_image_watermark(image_bytes, logo_bytes, position="bottom-right", opacit
             alpha = alpha.point(lambda p: int(p * opacity / 255))
             logo.putalpha(alpha)
         
-        # Get position
+        # Get position (auto modes compare corners against the logo's own brightness)
+        if position in AUTO_POSITIONS:
+            logo_luma = ImageStat.Stat(logo.convert("L"), mask=logo.split()[3]).mean[0] if logo.getbbox() else 255
+            position = resolve_watermark_position(base_image, logo.size, position, logo_luma, album_id)
         pos = get_watermark_position(base_image.size, logo.size, position)
         
         # Paste logo
         base_image.paste(logo, pos, logo)
         
         # Convert back to RGB for JPEG
-        output = io.BytesIO()
-        if base_image.mode == 'RGBA':
-            rgb_image = Image.new('RGB', base_image.size, (255, 255, 255))
-            rgb_image.paste(base_image, mask=base_image.split()[3])
-            rgb_image.save(output, format='JPEG', quality=95)
-        else:
-            base_image.save(output, format='JPEG', quality=95)
-        
-        output.seek(0)
-        return output.getvalue()
+        rgb_image = Image.new('RGB', base_image.size, (255, 255, 255))
+        rgb_image.paste(base_image, mask=base_image.split()[3])
+        return encode_jpeg(rgb_image, jpeg_settings)
     except Exception as e:
         print(f"Error adding image watermark: {e}")
         return None
 
 
-def add_text_watermark(image_bytes, text, position="bottom-right", opacity=128):
+def add_text_watermark(image_bytes, text, position="bottom-right", opacity=128, album_id=None):
     """Add text watermark to an image"""
     try:
-        base_image = Image.open(io.BytesIO(image_bytes)).convert("RGBA")
+        source_image = Image.open(io.BytesIO(image_bytes))
+        jpeg_settings = get_jpeg_settings(source_image)
+        base_image = source_image.convert("RGBA")
         
         # Create text layer
         txt_layer = Image.new('RGBA', base_image.size, (255, 255, 255, 0))
@@ -718,7 +1960,8 @@ def add_text_watermark(image_bytes, text, position="bottom-right", opacity=128):
         bbox = draw.textbbox((0, 0), text, font=font)
         text_w, text_h = bbox[2] - bbox[0], bbox[3] - bbox[1]
         
-        # Get position
+        # Get position (text is drawn white, so contrast is measured against white)
+        position = resolve_watermark_position(base_image, (text_w, text_h), position, 255, album_id)
         pos = get_watermark_position(base_image.size, (text_w, text_h), position)
         
         # Draw text with shadow
@@ -730,63 +1973,120 @@ def add_text_watermark(image_bytes, text, position="bottom-right", opacity=128):
         result = Image.alpha_composite(base_image, txt_layer)
         
         # Convert to RGB for JPEG
-        output = io.BytesIO()
         rgb_image = Image.new('RGB', result.size, (255, 255, 255))
         rgb_image.paste(result, mask=result.split()[3])
-        rgb_image.save(output, format='JPEG', quality=95)
-        output.seek(0)
-        return output.getvalue()
+        return encode_jpeg(rgb_image, jpeg_settings)
     except Exception as e:
         print(f"Error adding text watermark: {e}")
         return None
 
 
-async def forward_single_message(dest_channel, source_channel, msg_id):
-    """Forward a single message using rotating clients with optional watermark"""
-    global logo_stats
+async def get_logo_bytes(client):
+    """Get the logo image bytes, downloading only when the logo file_id changes"""
+    file_id = logo_config.get("logo_file_id")
+    if logo_cache["file_id"] != file_id or logo_cache["bytes"] is None:
+        logo_bytes = await client.download_media(file_id, in_memory=True)
+        logo_cache["file_id"] = file_id
+        logo_cache["bytes"] = logo_bytes.getvalue() if logo_bytes else None
+    return logo_cache["bytes"]
+
+
+async def watermark_photo_bytes(client, photo_bytes, album_id=None):
+    """Apply the configured logo/text watermark to photo bytes (returns None on failure)"""
+    watermarked = None
+    
+    # Apply image logo watermark (image work runs in a thread so photos can be processed in parallel)
+    if logo_config.get("logo_file_id"):
+        try:
+            logo_bytes = await get_logo_bytes(client)
+            if logo_bytes:
+                watermarked = await asyncio.to_thread(
+                    add_image_watermark,
+                    photo_bytes,
+                    logo_bytes,
+                    logo_config.get("position", "bottom-right"),
+                    logo_config.get("opacity", 128),
+                    logo_config.get("size", 20),
+                    album_id
+                )
+        except Exception as e:
+            print(f"Error downloading logo: {e}")
+    
+    # Apply text watermark if no image logo or as additional
+    if logo_config.get("text"):
+        source_bytes = watermarked if watermarked else photo_bytes
+        watermarked = await asyncio.to_thread(
+            add_text_watermark,
+            source_bytes,
+            logo_config["text"],
+            logo_config.get("position", "bottom-right"),
+            logo_config.get("opacity", 128),
+            album_id
+        )
+    
+    # Track upload bytes saved (negative if watermarking grew the file)
+    if watermarked:
+        logo_stats["bytes_in"] += len(photo_bytes)
+        logo_stats["bytes_out"] += len(watermarked)
+        saved = len(photo_bytes) - len(watermarked)
+        print(f"🖼️ Watermark job: {len(photo_bytes)} → {len(watermarked)} bytes ({saved:+d} saved)")
+    
+    return watermarked
+
+
+def is_watermark_active():
+    """Check if watermarking is enabled and has a logo or text set"""
+    return bool(logo_config.get("enabled") and (logo_config.get("logo_file_id") or logo_config.get("text")))
+
+
+def is_protected_content_error(error):
+    """Check if an error means the source chat has protected content (no forwarding/copying)"""
+    if isinstance(error, ChatForwardsRestricted):
+        return True
+    text = str(error).upper()
+    return "CHAT_FORWARDS_RESTRICTED" in text or "NOFORWARDS" in text
+
+
+async def forward_single_message(dest_channel, source_channel, msg_id, album_sent=None, id_range=None):
+    """Forward a single message using rotating clients with optional watermark.
+    
+    A watermarked album is sent whole (only its members within id_range); the later member ids
+    it covered are added to the job's album_sent set so the caller doesn't send them again.
+    """
+    global logo_stats
     
     client = get_next_client()
     if not client:
         return False, "No client available"
     
+    # Protected sources can't be copied - caller re-uploads them in a batch
+    if source_channel in protected_sources:
+        return False, "protected"
+    
     try:
         # Check if watermarking is enabled
-        if logo_config.get("enabled") and (logo_config.get("logo_file_id") or logo_config.get("text")):
+        if is_watermark_active():
             # Get the message to check if it's a photo
             try:
                 message = await client.get_messages(source_channel, msg_id)
                 
+                # Albums are watermarked together and sent back as one media group
+                if message and message.media_group_id and album_sent is not None:
+                    album_ids = await forward_album_watermarked(client, dest_channel, source_channel, message, id_range)
+                    if album_ids:
+                        for album_msg_id in album_ids:
+                            if album_msg_id != msg_id:
+                                mark_message_forwarded(source_channel, dest_channel, album_msg_id)
+                                if album_msg_id > msg_id:
+                                    album_sent.add(album_msg_id)
+                        return True, None
+                
                 if message and message.photo:
                     # Download the photo
                     photo_bytes = await client.download_media(message, in_memory=True)
                     
                     if photo_bytes:
-                        watermarked = None
-                        
-                        # Apply image logo watermark
-                        if logo_config.get("logo_file_id"):
-                            try:
-                                logo_bytes = await client.download_media(logo_config["logo_file_id"], in_memory=True)
-                                if logo_bytes:
-                                    watermarked = add_image_watermark(
-                                        photo_bytes.getvalue(),
-                                        logo_bytes.getvalue(),
-                                        logo_config.get("position", "bottom-right"),
-                                        logo_config.get("opacity", 128),
-                                        logo_config.get("size", 20)
-                                    )
-                            except Exception as e:
-                                print(f"Error downloading logo: {e}")
-                        
-                        # Apply text watermark if no image logo or as additional
-                        if logo_config.get("text"):
-                            source_bytes = watermarked if watermarked else photo_bytes.getvalue()
-                            watermarked = add_text_watermark(
-                                source_bytes,
-                                logo_config["text"],
-                                logo_config.get("position", "bottom-right"),
-                                logo_config.get("opacity", 128)
-                            )
+                        watermarked = await watermark_photo_bytes(client, photo_bytes.getvalue(), message.media_group_id)
                         
                         if watermarked:
                             # Send watermarked photo
@@ -813,9 +2113,221 @@ async def forward_single_message(dest_channel, source_channel, msg_id):
     except FloodWait as e:
         return False, f"flood:{e.value}"
     except Exception as e:
+        if is_protected_content_error(e):
+            protected_sources.add(source_channel)
+            print(f"🔒 {source_channel} has protected content - switching to download/re-upload")
+            return False, "protected"
         return False, str(e)
 
 
+async def forward_album_watermarked(client, dest_channel, source_channel, message, id_range=None):
+    """Watermark an album's photos in parallel and send it back as one media group.
+    
+    Only members with ids inside id_range (first, last) are sent. Returns the source message ids
+    that were sent, or None to fall back to per-message forwarding (no photos in the album, fewer
+    than two members in range, or part of it already sent).
+    """
+    global logo_stats
+    
+    members = await client.get_media_group(source_channel, message.id)
+    if id_range:
+        members = [m for m in members if id_range[0] <= m.id <= id_range[1]]
+    if len(members) < 2 or not any(m.photo for m in members):
+        return None
+    if any(is_message_forwarded(source_channel, m.id) for m in members):
+        return None
+    
+    async def prepare(member):
+        if member.photo:
+            photo_bytes = await client.download_media(member, in_memory=True)
+            watermarked = None
+            if photo_bytes:
+                watermarked = await watermark_photo_bytes(client, photo_bytes.getvalue(), member.media_group_id)
+            if watermarked:
+                logo_stats["watermarked"] += 1
+                return InputMediaPhoto(io.BytesIO(watermarked))
+            logo_stats["failed"] += 1
+            return InputMediaPhoto(member.photo.file_id)
+        if member.video:
+            return InputMediaVideo(member.video.file_id)
+        if member.audio:
+            return InputMediaAudio(member.audio.file_id)
+        if member.document:
+            return InputMediaDocument(member.document.file_id)
+        return None
+    
+    # First member alone so an "auto" position is picked once and cached for the album
+    media = [await prepare(members[0])]
+    media += await asyncio.gather(*[prepare(m) for m in members[1:]])
+    media = [m for m in media if m is not None]
+    
+    # Keep the album's caption on the first item
+    caption_msg = next((m for m in members if m.caption), None)
+    if caption_msg:
+        media[0].caption = caption_msg.caption
+        media[0].caption_entities = caption_msg.caption_entities
+    
+    await client.send_media_group(dest_channel, media)
+    return [m.id for m in members]
+
+
+def get_message_media(message):
+    """Return (kind, media) for the downloadable media in a message, or (None, None)"""
+    for kind in ("photo", "video", "document", "audio", "voice", "animation", "video_note", "sticker"):
+        media = getattr(message, kind, None)
+        if media is not None:
+            return kind, media
+    return None, None
+
+
+async def download_media_parallel(client, source_channel, msg_id, message):
+    """Download a message's media into memory, splitting its chunks across user accounts"""
+    kind, media = get_message_media(message)
+    file_size = getattr(media, "file_size", 0) or 0
+    total_chunks = max(1, math.ceil(file_size / STREAM_CHUNK_SIZE))
+    
+    # The account that fetched the message goes first, then the rest (one range per account)
+    clients = [client] + [c for _, c in user_clients if c is not client]
+    clients = clients[:total_chunks]
+    chunks_per_client = math.ceil(total_chunks / len(clients))
+    
+    async def fetch_range(range_client, offset):
+        # Each account resolves the message itself so its file reference is valid
+        if range_client is client:
+            range_message = message
+        else:
+            range_message = await range_client.get_messages(source_channel, msg_id)
+        parts = []
+        async for chunk in range_client.stream_media(range_message, offset=offset, limit=chunks_per_client):
+            parts.append(chunk)
+        return b"".join(parts)
+    
+    ranges = await asyncio.gather(*[
+        fetch_range(c, idx * chunks_per_client)
+        for idx, c in enumerate(clients)
+        if idx * chunks_per_client < total_chunks
+    ])
+    
+    data = io.BytesIO(b"".join(ranges))
+    file_name = getattr(media, "file_name", None)
+    if not file_name:
+        ext = mimetypes.guess_extension(getattr(media, "mime_type", None) or "") or (".jpg" if kind == "photo" else "")
+        file_name = f"{kind}_{msg_id}{ext}"
+    data.name = file_name
+    return data
+
+
+async def send_reuploaded_message(client, dest_channel, message, data):
+    """Send a downloaded message to the destination as a new post"""
+    kind, media = get_message_media(message)
+    caption = message.caption or ""
+    entities = message.caption_entities
+    
+    if kind is None:
+        if not message.text:
+            raise Exception("Unsupported message type")
+        return await client.send_message(
+            dest_channel, message.text, entities=message.entities,
+            disable_web_page_preview=message.web_page is None
+        )
+    if kind == "photo":
+        return await client.send_photo(dest_channel, data, caption=caption, caption_entities=entities)
+    if kind == "video":
+        return await client.send_video(
+            dest_channel, data, caption=caption, caption_entities=entities,
+            duration=media.duration or 0, width=media.width or 0, height=media.height or 0,
+            file_name=data.name, supports_streaming=True
+        )
+    if kind == "animation":
+        return await client.send_animation(
+            dest_channel, data, caption=caption, caption_entities=entities,
+            duration=media.duration or 0, width=media.width or 0, height=media.height or 0,
+            file_name=data.name
+        )
+    if kind == "audio":
+        return await client.send_audio(
+            dest_channel, data, caption=caption, caption_entities=entities,
+            duration=media.duration or 0, performer=media.performer, title=media.title,
+            file_name=data.name
+        )
+    if kind == "voice":
+        return await client.send_voice(dest_channel, data, caption=caption, caption_entities=entities, duration=media.duration or 0)
+    if kind == "video_note":
+        return await client.send_video_note(dest_channel, data, duration=media.duration or 0, length=media.length or 1)
+    if kind == "sticker":
+        return await client.send_sticker(dest_channel, data)
+    return await client.send_document(dest_channel, data, caption=caption, caption_entities=entities, file_name=data.name)
+
+
+async def reupload_protected_messages(dest_channel, source_channel, msg_ids):
+    """Mirror protected-content messages by downloading and re-uploading them.
+    
+    Downloads run in parallel (each file split across accounts) with at most
+    PROTECTED_MAX_INFLIGHT files in flight, while uploads go out in message order
+    on rotating accounts. Returns {msg_id: (success, error)}.
+    """
+    global protected_stats, logo_stats
+    
+    results = {}
+    if not user_clients:
+        return {msg_id: (False, "No client available") for msg_id in msg_ids}
+    
+    # A slot is held from download start until the upload finishes (bounds memory too)
+    slots = asyncio.Semaphore(max(1, PROTECTED_MAX_INFLIGHT))
+    
+    async def fetch(msg_id):
+        await slots.acquire()
+        client = get_next_client()
+        message = await client.get_messages(source_channel, msg_id)
+        if not message or message.empty:
+            return message, None
+        kind, _ = get_message_media(message)
+        if kind is None:
+            return message, None
+        data = await download_media_parallel(client, source_channel, msg_id, message)
+        if kind == "photo" and is_watermark_active():
+            watermarked = await watermark_photo_bytes(client, data.getvalue(), message.media_group_id)
+            if watermarked:
+                data = io.BytesIO(watermarked)
+                data.name = f"photo_{msg_id}.jpg"
+                logo_stats["watermarked"] += 1
+            else:
+                logo_stats["failed"] += 1
+        return message, data
+    
+    # Tasks acquire slots in creation order, so awaiting them in order can't deadlock
+    tasks = [asyncio.create_task(fetch(msg_id)) for msg_id in msg_ids]
+    
+    for msg_id, task in zip(msg_ids, tasks):
+        try:
+            message, data = await task
+            if not message or message.empty:
+                results[msg_id] = (False, "Message not found")
+                continue
+            
+            try:
+                await send_reuploaded_message(get_next_client(), dest_channel, message, data)
+            except FloodWait as e:
+                print(f"⚠️ FloodWait on re-upload: sleeping {e.value}s")
+                await asyncio.sleep(e.value)
+                if data is not None:
+                    data.seek(0)
+                await send_reuploaded_message(get_next_client(), dest_channel, message, data)
+            
+            protected_stats["reuploaded"] += 1
+            results[msg_id] = (True, None)
+        except FloodWait as e:
+            protected_stats["failed"] += 1
+            results[msg_id] = (False, f"flood:{e.value}")
+        except Exception as e:
+            protected_stats["failed"] += 1
+            results[msg_id] = (False, str(e))
+        finally:
+            slots.release()
+    
+    return results
+
+
 async def forward_messages(source_channel, dest_channel, start_id, end_id, is_resume=False):
     """Forward messages using multiple MTProto accounts - ULTRA FAST!"""
     global is_forwarding, stop_requested, current_progress
@@ -853,6 +2365,7 @@ async def forward_messages(source_channel, dest_channel, start_id, end_id, is_re
     current_id = current_progress["current_id"] if is_resume else start_id
     batch_start_time = time.time()
     batch_count = 0
+    album_sent = set()  # Later album member ids this job already sent with the album's first member
     
     # Larger batch size with multiple accounts
     effective_batch_size = BATCH_SIZE * num_accounts
@@ -865,11 +2378,20 @@ async def forward_messages(source_channel, dest_channel, start_id, end_id, is_re
         while current_id <= end_id and not stop_requested:
             # Process larger batch with multiple accounts
             batch_ids = list(range(current_id, min(current_id + effective_batch_size, end_id + 1)))
+            protected_ids = []  # Protected-content messages, re-uploaded after the loop
             
             for msg_id in batch_ids:
                 if stop_requested:
                     break
                 
+                # Already sent together with its album
+                if msg_id in album_sent:
+                    album_sent.discard(msg_id)
+                    current_progress["success_count"] += 1
+                    current_progress["current_id"] = msg_id
+                    batch_count += 1
+                    continue
+                
                 # Check if already forwarded
                 if is_message_forwarded(source_channel, msg_id):
                     current_progress["skipped_count"] += 1
@@ -877,12 +2399,19 @@ async def forward_messages(source_channel, dest_channel, start_id, end_id, is_re
                     continue
                 
                 # Try to forward using rotating clients
-                success, error = await forward_single_message(dest_channel, source_channel, msg_id)
+                success, error = await forward_single_message(
+                    dest_channel, source_channel, msg_id, album_sent, (start_id, end_id)
+                )
                 
                 if success:
                     current_progress["success_count"] += 1
                     mark_message_forwarded(source_channel, dest_channel, msg_id)
                     batch_count += 1
+                elif error == "protected":
+                    # Download + re-upload this one with the rest of the batch
+                    protected_ids.append(msg_id)
+                    current_progress["current_id"] = msg_id
+                    continue
                 elif error and error.startswith("flood:"):
                     # Handle rate limit
                     wait_time = int(error.split(":")[1])
@@ -892,7 +2421,9 @@ async def forward_messages(source_channel, dest_channel, start_id, end_id, is_re
                     await asyncio.sleep(wait_time)
                     
                     # Retry with next client
-                    retry_success, _ = await forward_single_message(dest_channel, source_channel, msg_id)
+                    retry_success, _ = await forward_single_message(
+                        dest_channel, source_channel, msg_id, album_sent, (start_id, end_id)
+                    )
                     if retry_success:
                         current_progress["success_count"] += 1
                         mark_message_forwarded(source_channel, dest_channel, msg_id)
@@ -912,6 +2443,24 @@ async def forward_messages(source_channel, dest_channel, start_id, end_id, is_re
                 # Very small delay between messages (multiple accounts handle load)
                 await asyncio.sleep(DELAY_BETWEEN_MESSAGES)
             
+            # Protected source: mirror the batch via parallel download/re-upload
+            if protected_ids and not stop_requested:
+                results = await reupload_protected_messages(dest_channel, source_channel, protected_ids)
+                for msg_id in protected_ids:
+                    ok, error = results.get(msg_id, (False, "No result"))
+                    error_lower = error.lower() if error else ""
+                    if ok:
+                        current_progress["success_count"] += 1
+                        mark_message_forwarded(source_channel, dest_channel, msg_id)
+                        batch_count += 1
+                    elif "not found" in error_lower or "empty" in error_lower or "deleted" in error_lower:
+                        current_progress["skipped_count"] += 1
+                    else:
+                        if error_lower.startswith("flood:"):
+                            current_progress["rate_limit_hits"] += 1
+                        print(f"❌ Re-upload error {msg_id}: {error}")
+                        current_progress["failed_count"] += 1
+            
             # Calculate speed
             elapsed = time.time() - batch_start_time
             if elapsed > 0:
@@ -1017,12 +2566,25 @@ async def wizard_forward_messages(user_id, source_channel, dest_channel, skip_nu
                         current_id += 1
                         continue
                 
-                # Try to copy message
-                await client.copy_message(
-                    chat_id=dest_channel,
-                    from_chat_id=source_channel,
-                    message_id=current_id
-                )
+                # Try to copy message (protected sources are downloaded and re-uploaded instead)
+                if source_channel not in protected_sources:
+                    try:
+                        await client.copy_message(
+                            chat_id=dest_channel,
+                            from_chat_id=source_channel,
+                            message_id=current_id
+                        )
+                    except Exception as e:
+                        if not is_protected_content_error(e):
+                            raise
+                        protected_sources.add(source_channel)
+                        print(f"🔒 {source_channel} has protected content - switching to download/re-upload")
+                
+                if source_channel in protected_sources:
+                    results = await reupload_protected_messages(dest_channel, source_channel, [current_id])
+                    ok, error = results[current_id]
+                    if not ok:
+                        raise Exception(error)
                 
                 progress["success_fwd"] = progress.get("success_fwd", 0) + 1
                 mark_message_forwarded(source_channel, dest_channel, current_id)
@@ -1060,18 +2622,17 @@ async def wizard_forward_messages(user_id, source_channel, dest_channel, skip_nu
             update_counter += 1
             if update_counter >= 5:
                 update_counter = 0
-                try:
-                    cancel_keyboard = InlineKeyboardMarkup([
-                        [InlineKeyboardButton("• CANCEL", callback_data="cancel_fwd_active")]
-                    ])
-                    await bot_client.edit_message_text(
-                        chat_id=progress.get("chat_id"),
-                        message_id=progress.get("status_message_id"),
-                        text=format_forward_status(user_id),
-                        reply_markup=cancel_keyboard
-                    )
-                except:
-                    pass
+                cancel_keyboard = InlineKeyboardMarkup([
+                    [InlineKeyboardButton("• CANCEL", callback_data="cancel_fwd_active")]
+                ])
+                # Only the latest pending status edit is kept; stale ones expire
+                outbox_edit(
+                    progress.get("chat_id"),
+                    progress.get("status_message_id"),
+                    format_forward_status(user_id),
+                    ttl=30,
+                    reply_markup=cancel_keyboard
+                )
             
             # Small delay between messages
             await asyncio.sleep(0.3)
@@ -1082,14 +2643,11 @@ async def wizard_forward_messages(user_id, source_channel, dest_channel, skip_nu
         progress["is_active"] = False
         progress["eta"] = "Done!"
         
-        try:
-            await bot_client.edit_message_text(
-                chat_id=progress.get("chat_id"),
-                message_id=progress.get("status_message_id"),
-                text=format_forward_status(user_id)
-            )
-        except:
-            pass
+        outbox_edit(
+            progress.get("chat_id"),
+            progress.get("status_message_id"),
+            format_forward_status(user_id)
+        )
         
     except Exception as e:
         print(f"Wizard forward error: {e}")
@@ -1169,11 +2727,7 @@ async def init_clients():
         return ("AUTH_KEY_DUPLICATED" in s) or ("406" in s and "DUPLIC" in s.upper())
 
     # Load auto-approve channels from database
-    if autoapprove_col is not None:
-        enabled_channels = autoapprove_col.find({"enabled": True})
-        for doc in enabled_channels:
-            auto_approve_channels.add(doc["channel"])
-        print(f"📥 Loaded {len(auto_approve_channels)} auto-approve channels")
+    load_auto_approve_channels()
 
     # Load logo config from database
     load_logo_config()
@@ -1255,11 +2809,12 @@ def register_bot_handlers():
             pass
         # Don't reply here - let command handlers do their job
 
-    def _is_cmd(text: str, cmd: str) -> bool:
-        """Match /cmd or /cmd@BotUsername in any chat."""
+    def _parse_cmd(text: str):
+        """Return the lowercase command name of /cmd or /cmd@BotUsername, or None."""
         if not text:
-            return False
-        return re.match(rf"^/{cmd}(?:@[A-Za-z0-9_]+)?(?:\s|$)", text.strip(), re.IGNORECASE) is not None
+            return None
+        match = COMMAND_PATTERN.match(text.lstrip())
+        return match.group(1).lower() if match else None
 
     # ============ GROUP COMMAND HELPER FUNCTIONS ============
     
@@ -1273,15 +2828,8 @@ def register_bot_handlers():
         
         if message.sender_chat and message.sender_chat.id == chat_id:
             is_group_admin = True
-        elif user_id:
-            try:
-                member = await client.get_chat_member(chat_id, user_id)
-                # Handle both string and enum status
-                status_str = str(member.status).lower()
-                if "admin" in status_str or "creator" in status_str or "owner" in status_str:
-                    is_group_admin = True
-            except Exception as e:
-                print(f"⚠️ get_chat_member failed: {e}")
+        elif user_id and not is_bot_admin:
+            is_group_admin = bool(await is_chat_admin(client, chat_id, user_id))
         
         return (is_bot_admin or is_group_admin, user_id)
 
@@ -1292,14 +2840,18 @@ def register_bot_handlers():
         Uses group=-10 and filters.all to catch everything including commands.
         """
         text = getattr(message, "text", None) or getattr(message, "caption", None) or ""
-        if not text:
-            return  # No text/caption, let other handlers process
-        
         chat_id = message.chat.id
         is_group = message.chat.type in [ChatType.GROUP, ChatType.SUPERGROUP]
         
+        # Parse the command once; plain group messages go straight to the pipeline
+        command = _parse_cmd(text)
+        if command is None:
+            if is_group:
+                await run_group_pipeline(client, message)
+            return  # Let other handlers process
+        
         # Debug command - works everywhere
-        if _is_cmd(text, "debug"):
+        if command == "debug":
             debug_info = (
                 f"🔍 **Debug Info**\n\n"
                 f"Chat ID: `{chat_id}`\n"
@@ -1315,17 +2867,17 @@ def register_bot_handlers():
 
         # ===== PRIVATE + GROUP COMMANDS =====
         
-        if _is_cmd(text, "start"):
+        if command == "start":
             await handle_start(client, message)
             message.stop_propagation()
             return
 
-        if _is_cmd(text, "ping"):
+        if command == "ping":
             await message.reply("✅ Pong")
             message.stop_propagation()
             return
 
-        if _is_cmd(text, "whoami"):
+        if command == "whoami":
             try:
                 me = await client.get_me()
                 uname = getattr(me, "username", "") or ""
@@ -1343,7 +2895,7 @@ def register_bot_handlers():
             return
         
         # /enablemod
-        if _is_cmd(text, "enablemod"):
+        if command == "enablemod":
             is_admin, user_id = await check_group_admin(client, message)
             if not is_admin:
                 await message.reply(f"❌ Only admins can enable moderation!\nDebug: user_id={user_id}")
@@ -1368,7 +2920,7 @@ def register_bot_handlers():
             return
         
         # /disablemod
-        if _is_cmd(text, "disablemod"):
+        if command == "disablemod":
             is_admin, user_id = await check_group_admin(client, message)
             if not is_admin:
                 await message.reply("❌ Only admins can disable moderation!")
@@ -1385,7 +2937,7 @@ def register_bot_handlers():
             return
         
         # /blockforward
-        if _is_cmd(text, "blockforward"):
+        if command == "blockforward":
             is_admin, user_id = await check_group_admin(client, message)
             if not is_admin:
                 await message.reply("❌ Only admins can change this!")
@@ -1405,7 +2957,7 @@ def register_bot_handlers():
             return
         
         # /blocklinks
-        if _is_cmd(text, "blocklinks"):
+        if command == "blocklinks":
             is_admin, user_id = await check_group_admin(client, message)
             if not is_admin:
                 await message.reply("❌ Only admins can change this!")
@@ -1425,7 +2977,7 @@ def register_bot_handlers():
             return
         
         # /blockbadwords
-        if _is_cmd(text, "blockbadwords"):
+        if command == "blockbadwords":
             is_admin, user_id = await check_group_admin(client, message)
             if not is_admin:
                 await message.reply("❌ Only admins can change this!")
@@ -1444,8 +2996,179 @@ def register_bot_handlers():
             message.stop_propagation()
             return
         
+        # /blockduplicates
+        if command == "blockduplicates":
+            is_admin, user_id = await check_group_admin(client, message)
+            if not is_admin:
+                await message.reply("❌ Only admins can change this!")
+                message.stop_propagation()
+                return
+            
+            if chat_id not in moderation_config:
+                moderation_config[chat_id] = load_moderation_config(chat_id)
+            current = moderation_config[chat_id].get("block_duplicates", False)
+            moderation_config[chat_id]["block_duplicates"] = not current
+            moderation_config[chat_id]["enabled"] = True
+            save_moderation_config(chat_id)
+            
+            status = "🟢 ON" if not current else "🔴 OFF"
+            await message.reply(f"📋 **Block Copy-Paste Spam:** {status}")
+            message.stop_propagation()
+            return
+        
+        # /addrule, /delrule - custom moderation rules
+        if command in ("addrule", "delrule"):
+            is_admin, user_id = await check_group_admin(client, message)
+            if not is_admin:
+                await message.reply("❌ Only admins can change rules!")
+                message.stop_propagation()
+                return
+            
+            parts = text.split(maxsplit=2)
+            rule_type = parts[1].lower() if len(parts) > 1 else ""
+            value = parts[2].strip() if len(parts) > 2 else ""
+            if rule_type not in RULE_TYPES or not value:
+                await message.reply(
+                    f"❌ Usage: `/{command} <type> <value>`\n\n"
+                    "• `word casino` - block a word/phrase\n"
+                    "• `regex free\\s+money` - block a pattern\n"
+                    "• `domain youtube.com` - allow links to a domain (with /blocklinks)\n"
+                    f"• `media sticker` - block a media type ({', '.join(RULE_MEDIA_KINDS)})\n"
+                    "• `maxcaption 300` - max caption length (0 = off)"
+                )
+                message.stop_propagation()
+                return
+            
+            if chat_id not in moderation_config:
+                moderation_config[chat_id] = load_moderation_config(chat_id)
+            rules = moderation_config[chat_id].setdefault("rules", {})
+            key = RULE_TYPES[rule_type]
+            
+            error = None
+            if rule_type == "maxcaption":
+                if not value.isdigit():
+                    error = "maxcaption needs a number"
+                else:
+                    rules[key] = int(value) if command == "addrule" else 0
+            else:
+                if rule_type in ("word", "domain", "media"):
+                    value = value.lower()
+                if rule_type == "domain":
+                    value = value.split("://")[-1].split("/")[0].removeprefix("www.")
+                current = list(rules.get(key) or [])
+                if command == "delrule":
+                    if value not in current:
+                        error = f"No {rule_type} rule `{value}`"
+                    current = [v for v in current if v != value]
+                elif rule_type == "media" and value not in RULE_MEDIA_KINDS:
+                    error = f"Unknown media type. Use one of: {', '.join(RULE_MEDIA_KINDS)}"
+                elif len(current) >= MAX_RULES_PER_TYPE:
+                    error = f"Max {MAX_RULES_PER_TYPE} {rule_type} rules per group"
+                elif rule_type == "regex" and len(value) > MAX_RULE_REGEX_LENGTH:
+                    error = f"Regex too long (max {MAX_RULE_REGEX_LENGTH} characters)"
+                elif value not in current:
+                    error = check_rule_regex(value) if rule_type == "regex" else None
+                    if not error:
+                        current.append(value)
+                if rule_type == "regex" and not error:
+                    try:
+                        compile_rule_regexes(current)
+                    except re.error as e:
+                        error = f"Invalid regex: {e}"
+                if not error:
+                    rules[key] = current
+            
+            if error:
+                await message.reply(f"❌ {error}")
+                message.stop_propagation()
+                return
+            
+            moderation_config[chat_id]["enabled"] = True
+            save_moderation_config(chat_id)
+            action = "added" if command == "addrule" else "removed"
+            await message.reply(f"✅ Rule {action}: **{rule_type}** `{value}`\n\nUse /rules to see all rules.")
+            message.stop_propagation()
+            return
+        
+        # /rules
+        if command == "rules":
+            if chat_id not in moderation_config:
+                moderation_config[chat_id] = load_moderation_config(chat_id)
+            rules = moderation_config[chat_id].get("rules") or {}
+            if not has_custom_rules(rules):
+                await message.reply("ℹ️ No custom rules.\n\nAdd one with `/addrule word casino`")
+            else:
+                lines = ["📜 **Custom Rules**\n"]
+                for rule_type, key in RULE_TYPES.items():
+                    values = rules.get(key)
+                    if values:
+                        shown = values if isinstance(values, int) else ", ".join(f"`{v}`" for v in values)
+                        lines.append(f"**{rule_type}:** {shown}")
+                await message.reply("\n".join(lines))
+            message.stop_propagation()
+            return
+        
+        # /shadowmode - evaluate rules without deleting anything
+        if command == "shadowmode":
+            is_admin, user_id = await check_group_admin(client, message)
+            if not is_admin:
+                await message.reply("❌ Only admins can change this!")
+                message.stop_propagation()
+                return
+            
+            if chat_id not in moderation_config:
+                moderation_config[chat_id] = load_moderation_config(chat_id)
+            current = moderation_config[chat_id].get("shadow_mode", False)
+            moderation_config[chat_id]["shadow_mode"] = not current
+            save_moderation_config(chat_id)
+            
+            if not current:
+                await message.reply(
+                    "👻 **Shadow Mode:** 🟢 ON\n\n"
+                    "Rules are checked and recorded, but nothing is deleted and nobody is warned.\n"
+                    "Reply /falsepositive to a message that should not have been flagged.\n"
+                    "Use /rulestats to see hits, false positives and timing per rule."
+                )
+            else:
+                await message.reply("👻 **Shadow Mode:** 🔴 OFF\n\nRules are enforced again.")
+            message.stop_propagation()
+            return
+        
+        # /falsepositive - reply to a message shadow mode flagged by mistake
+        if command == "falsepositive":
+            is_admin, user_id = await check_group_admin(client, message)
+            if not is_admin:
+                await message.reply("❌ Only admins can report false positives!")
+                message.stop_propagation()
+                return
+            
+            if not message.reply_to_message:
+                await message.reply("❌ Reply to a flagged message with /falsepositive")
+                message.stop_propagation()
+                return
+            
+            rule_ids = mark_false_positive(chat_id, message.reply_to_message.id)
+            if rule_ids:
+                await message.reply(f"✅ Counted as false positive for: {', '.join(f'`{r}`' for r in rule_ids)}")
+            else:
+                await message.reply("ℹ️ That message was not flagged by shadow mode (or is too old).")
+            message.stop_propagation()
+            return
+        
+        # /rulestats
+        if command == "rulestats":
+            is_admin, user_id = await check_group_admin(client, message)
+            if not is_admin:
+                await message.reply("❌ Only admins can view rule stats!")
+                message.stop_propagation()
+                return
+            
+            await message.reply(format_rule_stats(chat_id))
+            message.stop_propagation()
+            return
+        
         # /blockmention
-        if _is_cmd(text, "blockmention"):
+        if command == "blockmention":
             is_admin, user_id = await check_group_admin(client, message)
             if not is_admin:
                 await message.reply("❌ Only admins can change this!")
@@ -1454,8 +3177,8 @@ def register_bot_handlers():
             
             if chat_id not in moderation_config:
                 moderation_config[chat_id] = load_moderation_config(chat_id)
-            current = moderation_config[chat_id].get("block_mention", False)
-            moderation_config[chat_id]["block_mention"] = not current
+            current = moderation_config[chat_id].get("block_mentions", False)
+            moderation_config[chat_id]["block_mentions"] = not current
             moderation_config[chat_id]["enabled"] = True
             save_moderation_config(chat_id)
             
@@ -1465,7 +3188,7 @@ def register_bot_handlers():
             return
         
         # /autodelete2min
-        if _is_cmd(text, "autodelete2min"):
+        if command == "autodelete2min":
             is_admin, user_id = await check_group_admin(client, message)
             if not is_admin:
                 await message.reply("❌ Only admins can change this!")
@@ -1485,7 +3208,7 @@ def register_bot_handlers():
             return
         
         # /modstatus
-        if _is_cmd(text, "modstatus"):
+        if command == "modstatus":
             if chat_id not in moderation_config:
                 moderation_config[chat_id] = load_moderation_config(chat_id)
             cfg = moderation_config[chat_id]
@@ -1496,14 +3219,16 @@ def register_bot_handlers():
                 f"**Block Forwards:** {'🟢 ON' if cfg.get('block_forward') else '🔴 OFF'}\n"
                 f"**Block Links:** {'🟢 ON' if cfg.get('block_links') else '🔴 OFF'}\n"
                 f"**Block Bad Words:** {'🟢 ON' if cfg.get('block_badwords') else '🔴 OFF'}\n"
-                f"**Block Mentions:** {'🟢 ON' if cfg.get('block_mention') else '🔴 OFF'}\n"
+                f"**Block Mentions:** {'🟢 ON' if cfg.get('block_mentions') else '🔴 OFF'}\n"
+                f"**Block Copy-Paste Spam:** {'🟢 ON' if cfg.get('block_duplicates') else '🔴 OFF'}\n"
+                f"**Shadow Mode:** {'👻 ON' if cfg.get('shadow_mode') else '🔴 OFF'}\n"
                 f"**Auto-Delete 2min:** {'🟢 ON' if cfg.get('auto_delete_2min') else '🔴 OFF'}"
             )
             message.stop_propagation()
             return
         
         # /setforcejoin
-        if _is_cmd(text, "setforcejoin"):
+        if command == "setforcejoin":
             is_admin, user_id = await check_group_admin(client, message)
             if not is_admin:
                 await message.reply("❌ Only group admins can set force join!")
@@ -1531,18 +3256,13 @@ def register_bot_handlers():
                 invite_link = channel_info.invite_link or f"https://t.me/{channel_input.replace('@', '')}"
                 
                 config = {
+                    "enabled": True,
                     "channel_id": channel_id,
                     "channel_name": channel_name,
                     "invite_link": invite_link
                 }
                 group_forcejoin_config[chat_id] = config
-                
-                if group_forcejoin_col:
-                    group_forcejoin_col.update_one(
-                        {"chat_id": chat_id},
-                        {"$set": config},
-                        upsert=True
-                    )
+                save_group_forcejoin(chat_id)
                 
                 await message.reply(
                     f"✅ **Force Join Set!**\n\n"
@@ -1557,27 +3277,27 @@ def register_bot_handlers():
             return
         
         # /removeforcejoin
-        if _is_cmd(text, "removeforcejoin"):
+        if command == "removeforcejoin":
             is_admin, user_id = await check_group_admin(client, message)
             if not is_admin:
                 await message.reply("❌ Only group admins can remove force join!")
                 message.stop_propagation()
                 return
             
-            if chat_id in group_forcejoin_config:
-                del group_forcejoin_config[chat_id]
-            
-            if group_forcejoin_col:
-                group_forcejoin_col.delete_one({"chat_id": chat_id})
+            # A disabled (not deleted) document lets other instances pick up the change
+            group_forcejoin_config[chat_id] = default_forcejoin_config()
+            save_group_forcejoin(chat_id)
             
             await message.reply("✅ **Force Join Removed!**\n\nUsers can now send messages without joining.")
             message.stop_propagation()
             return
         
         # /forcejoininfo
-        if _is_cmd(text, "forcejoininfo"):
+        if command == "forcejoininfo":
+            if chat_id not in group_forcejoin_config:
+                group_forcejoin_config[chat_id] = load_group_forcejoin(chat_id)
             config = group_forcejoin_config.get(chat_id)
-            if config:
+            if config and config.get("channel_id"):
                 await message.reply(
                     f"🔐 **Force Join Info**\n\n"
                     f"Channel: {config.get('channel_name', 'Unknown')}\n"
@@ -1588,6 +3308,10 @@ def register_bot_handlers():
             message.stop_propagation()
             return
 
+        # Other commands in groups still go through the pipeline (except the exempt moderation commands)
+        if command not in PIPELINE_EXEMPT_COMMANDS:
+            await run_group_pipeline(client, message)
+
         # For all other messages/commands, do NOT stop propagation so other handlers can process them
 
 
@@ -1866,161 +3590,83 @@ def register_bot_handlers():
             f"/removeforcesub - Remove channel"
         )
     
-    @bot_client.on_callback_query()
-    async def callback_handler(client, callback_query):
-        data = callback_query.data
+    # ============ CALLBACK QUERY ROUTES ============
+    
+    # Helper function to verify user requirements
+    async def verify_user_access(callback_query, client):
+        """Check if user has completed force subscribe and referral requirements"""
+        user_id = callback_query.from_user.id
         
-        # Handle force subscribe verification
-        if data == "check_joined":
-            user_id = callback_query.from_user.id
+        # Admins bypass all checks
+        if is_admin(user_id):
+            return True
+        
+        # Check force subscribe
+        if force_subscribe_channels:
             is_joined, not_joined = await check_user_joined(client, user_id)
-            
-            if is_joined:
-                # Check if admin (bypass referral)
-                if is_admin(user_id):
-                    num_accounts = len(user_clients)
-                    expected_speed = num_accounts * 30 if num_accounts else 0
-                    
-                    keyboard = InlineKeyboardMarkup([
-                        [
-                            InlineKeyboardButton("📤 Forward", callback_data="forward"),
-                            InlineKeyboardButton("📢 Channel", callback_data="channel")
-                        ],
-                        [
-                            InlineKeyboardButton("🔍 Filters", callback_data="filters_menu"),
-                            InlineKeyboardButton("🛡️ Moderation", callback_data="moderation")
-                        ],
-                        [
-                            InlineKeyboardButton("🆘 @Admin", callback_data="admin"),
-                            InlineKeyboardButton("📥 Join Request", callback_data="join_request")
-                        ],
-                        [
-                            InlineKeyboardButton("📁 File Logo", callback_data="file_logo"),
-                            InlineKeyboardButton("👥 Referral", callback_data="my_referral")
-                        ],
-                        [
-                            InlineKeyboardButton("❓ Help", callback_data="help")
-                        ]
-                    ])
-                    
-                    # Only show account info to admins
-                    if user_id in ADMIN_IDS:
-                        msg_text = (
-                            f"✅ **Verification Successful!**\n\n"
-                            f"🚀 **Telegram Forwarder Bot**\n\n"
-                            f"👥 Active accounts: {num_accounts}\n"
-                            f"⚡ Expected speed: ~{expected_speed}/min\n\n"
-                            f"Select an option below:"
-                        )
-                    else:
-                        msg_text = (
-                            f"✅ **Verification Successful!**\n\n"
-                            f"🚀 **Telegram Forwarder Bot**\n\n"
-                            f"Select an option below:"
-                        )
-                    
-                    await safe_edit_message(
-                        callback_query.message,
-                        msg_text,
-                        reply_markup=keyboard
-                    )
-                    await callback_query.answer()
-                    return
-                
-                # Check referral requirement
-                ref_count = get_referral_count(user_id)
-                if ref_count < REQUIRED_REFERRALS:
-                    bot_info = await client.get_me()
-                    ref_link = get_referral_link(bot_info.username, user_id)
-                    remaining = REQUIRED_REFERRALS - ref_count
-                    
-                    await safe_edit_message(
-                        callback_query.message,
-                        f"✅ **Channels Joined!**\n\n"
-                        f"👥 **Referral Required!**\n\n"
-                        f"You need to invite **{REQUIRED_REFERRALS} users** to use this bot.\n\n"
-                        f"✅ Your referrals: **{ref_count}/{REQUIRED_REFERRALS}**\n"
-                        f"❌ Remaining: **{remaining}**\n\n"
-                        f"📤 **Your Referral Link:**\n`{ref_link}`\n\n"
-                        f"Share this link with friends!",
-                        reply_markup=InlineKeyboardMarkup([
-                            [InlineKeyboardButton("🔄 Check Again", callback_data="check_referrals")]
-                        ])
-                    )
-                    await callback_query.answer()
-                    return
-                
-                # User passed all checks - show main menu
-                num_accounts = len(user_clients)
-                expected_speed = num_accounts * 30 if num_accounts else 0
-                
-                keyboard = InlineKeyboardMarkup([
-                    [
-                        InlineKeyboardButton("📤 Forward", callback_data="forward"),
-                        InlineKeyboardButton("📢 Channel", callback_data="channel")
-                    ],
-                    [
-                        InlineKeyboardButton("🔍 Filters", callback_data="filters_menu"),
-                        InlineKeyboardButton("🛡️ Moderation", callback_data="moderation")
-                    ],
-                    [
-                        InlineKeyboardButton("🆘 @Admin", callback_data="admin"),
-                        InlineKeyboardButton("📥 Join Request", callback_data="join_request")
-                    ],
-                    [
-                        InlineKeyboardButton("📁 File Logo", callback_data="file_logo"),
-                        InlineKeyboardButton("👥 Referral", callback_data="my_referral")
-                    ],
-                    [
-                        InlineKeyboardButton("❓ Help", callback_data="help")
-                    ]
-                ])
-                
-                # Only show account info to admins
-                if user_id in ADMIN_IDS:
-                    msg_text = (
-                        f"✅ **Verification Successful!**\n\n"
-                        f"🚀 **Telegram Forwarder Bot**\n\n"
-                        f"👥 Active accounts: {num_accounts}\n"
-                        f"⚡ Expected speed: ~{expected_speed}/min\n\n"
-                        f"Select an option below:"
-                    )
-                else:
-                    msg_text = (
-                        f"✅ **Verification Successful!**\n\n"
-                        f"🚀 **Telegram Forwarder Bot**\n\n"
-                        f"Select an option below:"
-                    )
-                
-                await safe_edit_message(
-                    callback_query.message,
-                    msg_text,
-                    reply_markup=keyboard
-                )
-            else:
-                # Still not joined
-                buttons = []
-                for channel in not_joined:
-                    link = channel.get("invite_link") or f"https://t.me/{channel['channel_id'].replace('@', '').replace('-', '')}"
-                    buttons.append([InlineKeyboardButton(f"📢 Join {channel['channel_name']}", url=link)])
-                
-                buttons.append([InlineKeyboardButton("✅ Joined All - Verify", callback_data="check_joined")])
+            if not is_joined:
+                buttons = []
+                for channel in not_joined:
+                    link = channel.get("invite_link") or f"https://t.me/{channel['channel_id'].replace('@', '').replace('-', '')}"
+                    buttons.append([InlineKeyboardButton(f"📢 Join {channel['channel_name']}", url=link)])
+                buttons.append([InlineKeyboardButton("✅ Joined All - Verify", callback_data="check_joined")])
                 
                 await safe_edit_message(
                     callback_query.message,
-                    "❌ **Not Joined Yet!**\n\n"
+                    "🔐 **Join Required!**\n\n"
                     f"You still need to join **{len(not_joined)}** channel(s):\n\n"
-                    "👇 Click below to join, then click **Verify** again:",
+                    "👇 Click below to join, then click **Verify**:",
                     reply_markup=InlineKeyboardMarkup(buttons)
                 )
-            
-            await callback_query.answer()
-            return
+                await callback_query.answer("❌ Please join all channels first!", show_alert=True)
+                return False
         
-        if data == "check_referrals":
-            user_id = callback_query.from_user.id
+        # Check referral requirement
+        ref_count = get_referral_count(user_id)
+        if ref_count < REQUIRED_REFERRALS:
+            bot_info = await client.get_me()
+            ref_link = get_referral_link(bot_info.username, user_id)
+            remaining = REQUIRED_REFERRALS - ref_count
             
-            # Check if admin
+            await safe_edit_message(
+                callback_query.message,
+                f"👥 **Referral Required!**\n\n"
+                f"You need to invite **{REQUIRED_REFERRALS} users** to use this bot.\n\n"
+                f"✅ Your referrals: **{ref_count}/{REQUIRED_REFERRALS}**\n"
+                f"❌ Remaining: **{remaining}**\n\n"
+                f"📤 **Your Referral Link:**\n`{ref_link}`\n\n"
+                f"Share this link with friends!",
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton("🔄 Check Again", callback_data="check_referrals")]
+                ])
+            )
+            await callback_query.answer("❌ Complete referrals first!", show_alert=True)
+            return False
+        
+        return True
+    
+    async def require_access(client, callback_query, ctx):
+        """Route middleware: force subscribe + referral gate, checked once per callback"""
+        if "access" not in ctx:
+            ctx["access"] = await verify_user_access(callback_query, client)
+        return ctx["access"]
+    
+    async def load_user_channels(client, callback_query, ctx):
+        """Route middleware: load the user's saved destination channels into ctx"""
+        user_channels = []
+        if user_channels_col is not None:
+            saved = user_channels_col.find({"user_id": callback_query.from_user.id})
+            user_channels = [c.get("channel") for c in saved if c.get("channel")]
+        ctx["user_channels"] = user_channels
+        return True
+    
+    # Handle force subscribe verification
+    async def cb_check_joined(client, callback_query, ctx):
+        user_id = callback_query.from_user.id
+        is_joined, not_joined = await check_user_joined(client, user_id, recheck=True)
+        
+        if is_joined:
+            # Check if admin (bypass referral)
             if is_admin(user_id):
                 num_accounts = len(user_clients)
                 expected_speed = num_accounts * 30 if num_accounts else 0
@@ -2047,125 +3693,30 @@ def register_bot_handlers():
                     ]
                 ])
                 
+                # Only show account info to admins
+                if user_id in ADMIN_IDS:
+                    msg_text = (
+                        f"✅ **Verification Successful!**\n\n"
+                        f"🚀 **Telegram Forwarder Bot**\n\n"
+                        f"👥 Active accounts: {num_accounts}\n"
+                        f"⚡ Expected speed: ~{expected_speed}/min\n\n"
+                        f"Select an option below:"
+                    )
+                else:
+                    msg_text = (
+                        f"✅ **Verification Successful!**\n\n"
+                        f"🚀 **Telegram Forwarder Bot**\n\n"
+                        f"Select an option below:"
+                    )
+                
                 await safe_edit_message(
                     callback_query.message,
-                    f"✅ **Admin Access!**\n\n"
-                    f"🚀 **Telegram Forwarder Bot**\n\n"
-                    f"👥 Active accounts: {num_accounts}\n"
-                    f"⚡ Expected speed: ~{expected_speed}/min\n\n"
-                    f"Select an option below:",
+                    msg_text,
                     reply_markup=keyboard
                 )
                 await callback_query.answer()
                 return
             
-            ref_count = get_referral_count(user_id)
-            
-            if ref_count >= REQUIRED_REFERRALS:
-                # User has enough referrals - show main menu
-                num_accounts = len(user_clients)
-                expected_speed = num_accounts * 30 if num_accounts else 0
-                
-                keyboard = InlineKeyboardMarkup([
-                    [
-                        InlineKeyboardButton("📤 Forward", callback_data="forward"),
-                        InlineKeyboardButton("📢 Channel", callback_data="channel")
-                    ],
-                    [
-                        InlineKeyboardButton("🔍 Filters", callback_data="filters_menu"),
-                        InlineKeyboardButton("🛡️ Moderation", callback_data="moderation")
-                    ],
-                    [
-                        InlineKeyboardButton("🆘 @Admin", callback_data="admin"),
-                        InlineKeyboardButton("📥 Join Request", callback_data="join_request")
-                    ],
-                    [
-                        InlineKeyboardButton("📁 File Logo", callback_data="file_logo"),
-                        InlineKeyboardButton("👥 Referral", callback_data="my_referral")
-                    ],
-                    [
-                        InlineKeyboardButton("❓ Help", callback_data="help")
-                    ]
-                ])
-                
-                # Only show account info to admins (referral complete users are not admins)
-                await safe_edit_message(
-                    callback_query.message,
-                    f"✅ **Referral Complete!**\n\n"
-                    f"🚀 **Telegram Forwarder Bot**\n\n"
-                    f"Select an option below:",
-                    reply_markup=keyboard
-                )
-            else:
-                bot_info = await client.get_me()
-                ref_link = get_referral_link(bot_info.username, user_id)
-                remaining = REQUIRED_REFERRALS - ref_count
-                
-                await safe_edit_message(
-                    callback_query.message,
-                    f"👥 **Referral Required!**\n\n"
-                    f"You need to invite **{REQUIRED_REFERRALS} users** to use this bot.\n\n"
-                    f"✅ Your referrals: **{ref_count}/{REQUIRED_REFERRALS}**\n"
-                    f"❌ Remaining: **{remaining}**\n\n"
-                    f"📤 **Your Referral Link:**\n`{ref_link}`\n\n"
-                    f"Share this link with friends!",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("🔄 Check Again", callback_data="check_referrals")]
-                    ])
-                )
-            
-            await callback_query.answer()
-            return
-        
-        if data == "my_referral":
-            user_id = callback_query.from_user.id
-            bot_info = await client.get_me()
-            ref_link = get_referral_link(bot_info.username, user_id)
-            ref_count = get_referral_count(user_id)
-            
-            await safe_edit_message(
-                callback_query.message,
-                f"👥 **Your Referral Stats**\n\n"
-                f"✅ Total referrals: **{ref_count}**\n"
-                f"🎯 Required: **{REQUIRED_REFERRALS}**\n\n"
-                f"📤 **Your Referral Link:**\n`{ref_link}`\n\n"
-                f"Share this link to invite friends!",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Back", callback_data="back_main")]
-                ])
-            )
-            await callback_query.answer()
-            return
-        
-        # Helper function to verify user requirements
-        async def verify_user_access(callback_query, client):
-            """Check if user has completed force subscribe and referral requirements"""
-            user_id = callback_query.from_user.id
-            
-            # Admins bypass all checks
-            if is_admin(user_id):
-                return True
-            
-            # Check force subscribe
-            if force_subscribe_channels:
-                is_joined, not_joined = await check_user_joined(client, user_id)
-                if not is_joined:
-                    buttons = []
-                    for channel in not_joined:
-                        link = channel.get("invite_link") or f"https://t.me/{channel['channel_id'].replace('@', '').replace('-', '')}"
-                        buttons.append([InlineKeyboardButton(f"📢 Join {channel['channel_name']}", url=link)])
-                    buttons.append([InlineKeyboardButton("✅ Joined All - Verify", callback_data="check_joined")])
-                    
-                    await safe_edit_message(
-                        callback_query.message,
-                        "🔐 **Join Required!**\n\n"
-                        f"You still need to join **{len(not_joined)}** channel(s):\n\n"
-                        "👇 Click below to join, then click **Verify**:",
-                        reply_markup=InlineKeyboardMarkup(buttons)
-                    )
-                    await callback_query.answer("❌ Please join all channels first!", show_alert=True)
-                    return False
-            
             # Check referral requirement
             ref_count = get_referral_count(user_id)
             if ref_count < REQUIRED_REFERRALS:
@@ -2175,6 +3726,7 @@ def register_bot_handlers():
                 
                 await safe_edit_message(
                     callback_query.message,
+                    f"✅ **Channels Joined!**\n\n"
                     f"👥 **Referral Required!**\n\n"
                     f"You need to invite **{REQUIRED_REFERRALS} users** to use this bot.\n\n"
                     f"✅ Your referrals: **{ref_count}/{REQUIRED_REFERRALS}**\n"
@@ -2185,156 +3737,122 @@ def register_bot_handlers():
                         [InlineKeyboardButton("🔄 Check Again", callback_data="check_referrals")]
                     ])
                 )
-                await callback_query.answer("❌ Complete referrals first!", show_alert=True)
-                return False
-            
-            return True
-        
-        if data == "forward":
-            user_id = callback_query.from_user.id
-            
-            # Verify user access
-            if not await verify_user_access(callback_query, client):
-                return
-            
-            # Check if user has accounts connected
-            if not user_clients:
-                await safe_edit_message(callback_query.message, "❌ No user accounts connected!")
                 await callback_query.answer()
                 return
             
-            # Start forward wizard - Set source chat
-            forward_wizard_state[user_id] = {
-                "state": "waiting_source",
-                "source_channel": "",
-                "source_title": "",
-                "skip_number": 0,
-                "last_message_id": 0,
-                "dest_channel": "",
-                "dest_title": "",
-                "filters": {
-                    "skip_videos": False,
-                    "skip_photos": False,
-                    "skip_files": False,
-                    "skip_audio": False,
-                    "skip_stickers": False,
-                    "skip_text": False
-                }
-            }
-            
-            cancel_keyboard = InlineKeyboardMarkup([
-                [InlineKeyboardButton("❌ Cancel", callback_data="cancel_forward")],
-                [InlineKeyboardButton("🔙 Back", callback_data="back_main")]
-            ])
-            
-            await safe_edit_message(
-                callback_query.message,
-                "**( SET SOURCE CHAT )**\n\n"
-                "Forward the last message or last message link of source chat.\n"
-                "/cancel - cancel this process",
-                reply_markup=cancel_keyboard
-            )
-            await callback_query.answer()
-        elif data == "channel":
-            # Verify user access
-            if not await verify_user_access(callback_query, client):
-                return
-            
-            # Get user's saved channels
-            user_id = callback_query.from_user.id
-            user_channels = []
-            if user_channels_col is not None:
-                saved = user_channels_col.find({"user_id": user_id})
-                user_channels = [c.get("channel") for c in saved if c.get("channel")]
-            
-            channels_text = "\n".join([f"• `{ch}`" for ch in user_channels]) if user_channels else "No channels added yet"
+            # User passed all checks - show main menu
+            num_accounts = len(user_clients)
+            expected_speed = num_accounts * 30 if num_accounts else 0
             
-            channel_keyboard = InlineKeyboardMarkup([
-                [InlineKeyboardButton("➕ Add Channel ➕", callback_data="add_channel")],
-                [InlineKeyboardButton("🗑️ Remove Channel", callback_data="remove_channel")],
-                [InlineKeyboardButton("🔙 Back", callback_data="back_main")]
+            keyboard = InlineKeyboardMarkup([
+                [
+                    InlineKeyboardButton("📤 Forward", callback_data="forward"),
+                    InlineKeyboardButton("📢 Channel", callback_data="channel")
+                ],
+                [
+                    InlineKeyboardButton("🔍 Filters", callback_data="filters_menu"),
+                    InlineKeyboardButton("🛡️ Moderation", callback_data="moderation")
+                ],
+                [
+                    InlineKeyboardButton("🆘 @Admin", callback_data="admin"),
+                    InlineKeyboardButton("📥 Join Request", callback_data="join_request")
+                ],
+                [
+                    InlineKeyboardButton("📁 File Logo", callback_data="file_logo"),
+                    InlineKeyboardButton("👥 Referral", callback_data="my_referral")
+                ],
+                [
+                    InlineKeyboardButton("❓ Help", callback_data="help")
+                ]
             ])
             
-            await safe_edit_message(
-                callback_query.message,
-                f"📢 **My Channels**\n\n"
-                f"you can manage your target chats in here\n\n"
-                f"**Your Channels ({len(user_channels)}):**\n{channels_text}",
-                reply_markup=channel_keyboard
-            )
-            await callback_query.answer()
-        elif data == "add_channel":
-            # Verify user access
-            if not await verify_user_access(callback_query, client):
-                return
-            
-            user_id = callback_query.from_user.id
-            user_channel_state[user_id] = "waiting_add_channel"
+            # Only show account info to admins
+            if user_id in ADMIN_IDS:
+                msg_text = (
+                    f"✅ **Verification Successful!**\n\n"
+                    f"🚀 **Telegram Forwarder Bot**\n\n"
+                    f"👥 Active accounts: {num_accounts}\n"
+                    f"⚡ Expected speed: ~{expected_speed}/min\n\n"
+                    f"Select an option below:"
+                )
+            else:
+                msg_text = (
+                    f"✅ **Verification Successful!**\n\n"
+                    f"🚀 **Telegram Forwarder Bot**\n\n"
+                    f"Select an option below:"
+                )
             
             await safe_edit_message(
                 callback_query.message,
-                "📢 **Add Channel**\n\n"
-                "Send me the channel/chat username or link:\n\n"
-                "Examples:\n"
-                "• @channelname\n"
-                "• https://t.me/channelname\n"
-                "• -1001234567890\n\n"
-                "Just send the message below 👇",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Back", callback_data="channel")]
-                ])
+                msg_text,
+                reply_markup=keyboard
             )
-            await callback_query.answer()
-        elif data == "remove_channel":
-            # Verify user access
-            if not await verify_user_access(callback_query, client):
-                return
-            
-            user_id = callback_query.from_user.id
-            user_channels = []
-            if user_channels_col is not None:
-                saved = user_channels_col.find({"user_id": user_id})
-                user_channels = [c.get("channel") for c in saved if c.get("channel")]
-            
-            if not user_channels:
-                await safe_edit_message(
-                    callback_query.message,
-                    "❌ No channels to remove!",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("🔙 Back", callback_data="channel")]
-                    ])
-                )
-                await callback_query.answer()
-                return
+        else:
+            # Still not joined
+            buttons = []
+            for channel in not_joined:
+                link = channel.get("invite_link") or f"https://t.me/{channel['channel_id'].replace('@', '').replace('-', '')}"
+                buttons.append([InlineKeyboardButton(f"📢 Join {channel['channel_name']}", url=link)])
             
-            # Create buttons for each channel to remove
-            buttons = [[InlineKeyboardButton(f"🗑️ {ch}", callback_data=f"del_ch_{ch}")] for ch in user_channels[:10]]
-            buttons.append([InlineKeyboardButton("🔙 Back", callback_data="channel")])
+            buttons.append([InlineKeyboardButton("✅ Joined All - Verify", callback_data="check_joined")])
             
             await safe_edit_message(
                 callback_query.message,
-                "🗑️ **Remove Channel**\n\n"
-                "Select a channel to remove:",
+                "❌ **Not Joined Yet!**\n\n"
+                f"You still need to join **{len(not_joined)}** channel(s):\n\n"
+                "👇 Click below to join, then click **Verify** again:",
                 reply_markup=InlineKeyboardMarkup(buttons)
             )
-            await callback_query.answer()
-        elif data.startswith("del_ch_"):
-            channel_to_delete = data.replace("del_ch_", "")
-            user_id = callback_query.from_user.id
+        
+        await callback_query.answer()
+        return
+    
+    async def cb_check_referrals(client, callback_query, ctx):
+        user_id = callback_query.from_user.id
+        
+        # Check if admin
+        if is_admin(user_id):
+            num_accounts = len(user_clients)
+            expected_speed = num_accounts * 30 if num_accounts else 0
             
-            if user_channels_col is not None:
-                user_channels_col.delete_one({"user_id": user_id, "channel": channel_to_delete})
+            keyboard = InlineKeyboardMarkup([
+                [
+                    InlineKeyboardButton("📤 Forward", callback_data="forward"),
+                    InlineKeyboardButton("📢 Channel", callback_data="channel")
+                ],
+                [
+                    InlineKeyboardButton("🔍 Filters", callback_data="filters_menu"),
+                    InlineKeyboardButton("🛡️ Moderation", callback_data="moderation")
+                ],
+                [
+                    InlineKeyboardButton("🆘 @Admin", callback_data="admin"),
+                    InlineKeyboardButton("📥 Join Request", callback_data="join_request")
+                ],
+                [
+                    InlineKeyboardButton("📁 File Logo", callback_data="file_logo"),
+                    InlineKeyboardButton("👥 Referral", callback_data="my_referral")
+                ],
+                [
+                    InlineKeyboardButton("❓ Help", callback_data="help")
+                ]
+            ])
             
             await safe_edit_message(
                 callback_query.message,
-                f"✅ Channel `{channel_to_delete}` removed!",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Back", callback_data="channel")]
-                ])
+                f"✅ **Admin Access!**\n\n"
+                f"🚀 **Telegram Forwarder Bot**\n\n"
+                f"👥 Active accounts: {num_accounts}\n"
+                f"⚡ Expected speed: ~{expected_speed}/min\n\n"
+                f"Select an option below:",
+                reply_markup=keyboard
             )
             await callback_query.answer()
-        elif data == "back_main":
-            # Go back to main menu
+            return
+        
+        ref_count = get_referral_count(user_id)
+        
+        if ref_count >= REQUIRED_REFERRALS:
+            # User has enough referrals - show main menu
             num_accounts = len(user_clients)
             expected_speed = num_accounts * 30 if num_accounts else 0
             
@@ -2360,484 +3878,722 @@ def register_bot_handlers():
                 ]
             ])
             
-            # Only show account info to admins
-            user_id = callback_query.from_user.id
-            if user_id in ADMIN_IDS:
-                msg_text = (
-                    f"🚀 **Telegram Forwarder Bot**\n\n"
-                    f"👥 Connected accounts: {num_accounts}\n"
-                    f"⚡ Expected speed: ~{expected_speed} msg/min\n\n"
-                    "Select an option below:"
-                )
-            else:
-                msg_text = (
-                    f"🚀 **Telegram Forwarder Bot**\n\n"
-                    "Select an option below:"
-                )
-            
+            # Only show account info to admins (referral complete users are not admins)
             await safe_edit_message(
                 callback_query.message,
-                msg_text,
+                f"✅ **Referral Complete!**\n\n"
+                f"🚀 **Telegram Forwarder Bot**\n\n"
+                f"Select an option below:",
                 reply_markup=keyboard
             )
-            await callback_query.answer()
-        elif data == "moderation":
-            # Verify user access
-            if not await verify_user_access(callback_query, client):
-                return
+        else:
+            bot_info = await client.get_me()
+            ref_link = get_referral_link(bot_info.username, user_id)
+            remaining = REQUIRED_REFERRALS - ref_count
             
             await safe_edit_message(
                 callback_query.message,
-                "🛡️ **Content Moderation**\n\n"
-                "Add bot as admin in your group, then use:\n\n"
-                "**Commands (in group):**\n"
-                "/enablemod - Enable moderation\n"
-                "/disablemod - Disable moderation\n"
-                "/blockforward - Block forwarded messages\n"
-                "/blocklinks - Block links/URLs/usernames\n"
-                "/blockbadwords - 🔞 Block sex/adult content\n"
-                "/modstatus - View moderation settings\n"
-                "/warnings - Check user warnings\n"
-                "/resetwarnings - Reset user warnings (admin)\n\n"
-                "🔞 **Sex Content Filter:**\n"
-                "Use /blockbadwords to auto-delete:\n"
-                "• Sex messages (sex, porn, xxx, etc.)\n"
-                "• Adult content & Abusive words\n\n"
-                "⚠️ **Auto-Ban System:**\n"
-                "• 3 warnings = Automatic BAN\n"
-                "• Warning given on each violation\n"
-                "• Admins are exempt from all filters",
+                f"👥 **Referral Required!**\n\n"
+                f"You need to invite **{REQUIRED_REFERRALS} users** to use this bot.\n\n"
+                f"✅ Your referrals: **{ref_count}/{REQUIRED_REFERRALS}**\n"
+                f"❌ Remaining: **{remaining}**\n\n"
+                f"📤 **Your Referral Link:**\n`{ref_link}`\n\n"
+                f"Share this link with friends!",
                 reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Back", callback_data="back_main")]
+                    [InlineKeyboardButton("🔄 Check Again", callback_data="check_referrals")]
                 ])
             )
+        
+        await callback_query.answer()
+        return
+    
+    async def cb_my_referral(client, callback_query, ctx):
+        user_id = callback_query.from_user.id
+        bot_info = await client.get_me()
+        ref_link = get_referral_link(bot_info.username, user_id)
+        ref_count = get_referral_count(user_id)
+        
+        await safe_edit_message(
+            callback_query.message,
+            f"👥 **Your Referral Stats**\n\n"
+            f"✅ Total referrals: **{ref_count}**\n"
+            f"🎯 Required: **{REQUIRED_REFERRALS}**\n\n"
+            f"📤 **Your Referral Link:**\n`{ref_link}`\n\n"
+            f"Share this link to invite friends!",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Back", callback_data="back_main")]
+            ])
+        )
+        await callback_query.answer()
+        return
+    
+    async def cb_forward(client, callback_query, ctx):
+        user_id = callback_query.from_user.id
+        
+        # Check if user has accounts connected
+        if not user_clients:
+            await safe_edit_message(callback_query.message, "❌ No user accounts connected!")
             await callback_query.answer()
-        elif data == "admin":
-            # Verify user access
-            if not await verify_user_access(callback_query, client):
-                return
-            
+            return
+        
+        # Start forward wizard - Set source chat
+        forward_wizard_state[user_id] = {
+            "state": "waiting_source",
+            "source_channel": "",
+            "source_title": "",
+            "skip_number": 0,
+            "last_message_id": 0,
+            "dest_channel": "",
+            "dest_title": "",
+            "filters": {
+                "skip_videos": False,
+                "skip_photos": False,
+                "skip_files": False,
+                "skip_audio": False,
+                "skip_stickers": False,
+                "skip_text": False
+            }
+        }
+        
+        cancel_keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("❌ Cancel", callback_data="cancel_forward")],
+            [InlineKeyboardButton("🔙 Back", callback_data="back_main")]
+        ])
+        
+        await safe_edit_message(
+            callback_query.message,
+            "**( SET SOURCE CHAT )**\n\n"
+            "Forward the last message or last message link of source chat.\n"
+            "/cancel - cancel this process",
+            reply_markup=cancel_keyboard
+        )
+        await callback_query.answer()
+    
+    async def cb_channel(client, callback_query, ctx):
+        # Get user's saved channels
+        user_channels = ctx["user_channels"]
+        
+        channels_text = "\n".join([f"• `{ch}`" for ch in user_channels]) if user_channels else "No channels added yet"
+        
+        channel_keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("➕ Add Channel ➕", callback_data="add_channel")],
+            [InlineKeyboardButton("🗑️ Remove Channel", callback_data="remove_channel")],
+            [InlineKeyboardButton("🔙 Back", callback_data="back_main")]
+        ])
+        
+        await safe_edit_message(
+            callback_query.message,
+            f"📢 **My Channels**\n\n"
+            f"you can manage your target chats in here\n\n"
+            f"**Your Channels ({len(user_channels)}):**\n{channels_text}",
+            reply_markup=channel_keyboard
+        )
+        await callback_query.answer()
+    
+    async def cb_add_channel(client, callback_query, ctx):
+        user_id = callback_query.from_user.id
+        user_channel_state[user_id] = "waiting_add_channel"
+        
+        await safe_edit_message(
+            callback_query.message,
+            "📢 **Add Channel**\n\n"
+            "Send me the channel/chat username or link:\n\n"
+            "Examples:\n"
+            "• @channelname\n"
+            "• https://t.me/channelname\n"
+            "• -1001234567890\n\n"
+            "Just send the message below 👇",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Back", callback_data="channel")]
+            ])
+        )
+        await callback_query.answer()
+    
+    async def cb_remove_channel(client, callback_query, ctx):
+        user_channels = ctx["user_channels"]
+        
+        if not user_channels:
             await safe_edit_message(
                 callback_query.message,
-                "🆘 **Admin Controls**\n\n"
-                "**🔒 Force Join (New!):**\n"
-                "`/setforcejoin @channel|Name|Link` - Enable\n"
-                "`/removeforcejoin` - Disable force join\n"
-                "`/forcejoininfo` - View status\n\n"
-                "**Block @Mentions:**\n"
-                "`/blockmention` - Toggle @mention blocking\n\n"
-                "**Auto-Delete 2 min:**\n"
-                "`/autodelete2min` - Toggle auto-delete\n\n"
-                "**Other Commands (in group):**\n"
-                "`/enablemod` - Enable moderation first\n"
-                "`/modstatus` - View all settings\n\n"
-                "⚡ Force Join: Non-members के messages delete होंगे!\n"
-                "👮 Admins are exempt from filters.",
+                "❌ No channels to remove!",
                 reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Back", callback_data="back_main")]
+                    [InlineKeyboardButton("🔙 Back", callback_data="channel")]
                 ])
             )
             await callback_query.answer()
-        elif data == "join_request":
-            # Verify user access
-            if not await verify_user_access(callback_query, client):
-                return
-            
-            channels_list = "\n".join([f"• `{ch}`" for ch in auto_approve_channels]) if auto_approve_channels else "None"
-            await safe_edit_message(
-                callback_query.message,
-                "📥 **Join Request Auto-Approve**\n\n"
-                "📢 Works for both **Channels & Groups**!\n\n"
-                f"**Status:** {'🟢 Active' if auto_approve_channels else '🔴 Inactive'}\n"
-                f"**Total:** {len(auto_approve_channels)}\n"
-                f"✅ Approved: {auto_approve_stats['approved']}\n"
-                f"❌ Failed: {auto_approve_stats['failed']}\n\n"
-                f"**Active Channels/Groups:**\n{channels_list}\n\n"
-                "**Commands:**\n"
-                "/autoapprove <channel/group> - Enable\n"
-                "/stopapprove <channel/group> - Disable\n"
-                "/approveall <channel/group> - Accept all pending\n"
-                "/approvelist - Show all enabled",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Back", callback_data="back_main")]
-                ])
+            return
+        
+        # Create buttons for each channel to remove
+        buttons = [[InlineKeyboardButton(f"🗑️ {ch}", callback_data=f"del_ch_{ch}")] for ch in user_channels[:10]]
+        buttons.append([InlineKeyboardButton("🔙 Back", callback_data="channel")])
+        
+        await safe_edit_message(
+            callback_query.message,
+            "🗑️ **Remove Channel**\n\n"
+            "Select a channel to remove:",
+            reply_markup=InlineKeyboardMarkup(buttons)
+        )
+        await callback_query.answer()
+    
+    async def cb_del_ch(client, callback_query, ctx):
+        channel_to_delete = callback_query.data.replace("del_ch_", "")
+        user_id = callback_query.from_user.id
+        
+        if user_channels_col is not None:
+            user_channels_col.delete_one({"user_id": user_id, "channel": channel_to_delete})
+        
+        await safe_edit_message(
+            callback_query.message,
+            f"✅ Channel `{channel_to_delete}` removed!",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Back", callback_data="channel")]
+            ])
+        )
+        await callback_query.answer()
+    
+    async def cb_back_main(client, callback_query, ctx):
+        # Go back to main menu
+        num_accounts = len(user_clients)
+        expected_speed = num_accounts * 30 if num_accounts else 0
+        
+        keyboard = InlineKeyboardMarkup([
+            [
+                InlineKeyboardButton("📤 Forward", callback_data="forward"),
+                InlineKeyboardButton("📢 Channel", callback_data="channel")
+            ],
+            [
+                InlineKeyboardButton("🔍 Filters", callback_data="filters_menu"),
+                InlineKeyboardButton("🛡️ Moderation", callback_data="moderation")
+            ],
+            [
+                InlineKeyboardButton("🆘 @Admin", callback_data="admin"),
+                InlineKeyboardButton("📥 Join Request", callback_data="join_request")
+            ],
+            [
+                InlineKeyboardButton("📁 File Logo", callback_data="file_logo"),
+                InlineKeyboardButton("👥 Referral", callback_data="my_referral")
+            ],
+            [
+                InlineKeyboardButton("❓ Help", callback_data="help")
+            ]
+        ])
+        
+        # Only show account info to admins
+        user_id = callback_query.from_user.id
+        if user_id in ADMIN_IDS:
+            msg_text = (
+                f"🚀 **Telegram Forwarder Bot**\n\n"
+                f"👥 Connected accounts: {num_accounts}\n"
+                f"⚡ Expected speed: ~{expected_speed} msg/min\n\n"
+                "Select an option below:"
             )
-            await callback_query.answer()
-        elif data == "file_logo":
-            # Verify user access
-            if not await verify_user_access(callback_query, client):
-                return
-            
+        else:
+            msg_text = (
+                f"🚀 **Telegram Forwarder Bot**\n\n"
+                "Select an option below:"
+            )
+        
+        await safe_edit_message(
+            callback_query.message,
+            msg_text,
+            reply_markup=keyboard
+        )
+        await callback_query.answer()
+    
+    async def cb_moderation(client, callback_query, ctx):
+        await safe_edit_message(
+            callback_query.message,
+            "🛡️ **Content Moderation**\n\n"
+            "Add bot as admin in your group, then use:\n\n"
+            "**Commands (in group):**\n"
+            "/enablemod - Enable moderation\n"
+            "/disablemod - Disable moderation\n"
+            "/blockforward - Block forwarded messages\n"
+            "/blocklinks - Block links/URLs/usernames\n"
+            "/blockbadwords - 🔞 Block sex/adult content\n"
+            "/blockduplicates - Block copy-paste spam from many users\n"
+            "/addrule, /delrule, /rules - Custom rules (words, regex, domains, media)\n"
+            "/shadowmode - Test rules without deleting (/rulestats, /falsepositive)\n"
+            "/modstatus - View moderation settings\n"
+            "/warnings - Check user warnings\n"
+            "/resetwarnings - Reset user warnings (admin)\n\n"
+            "🔞 **Sex Content Filter:**\n"
+            "Use /blockbadwords to auto-delete:\n"
+            "• Sex messages (sex, porn, xxx, etc.)\n"
+            "• Adult content & Abusive words\n\n"
+            "⚠️ **Auto-Ban System:**\n"
+            "• 3 warnings = Automatic BAN\n"
+            "• Warning given on each violation\n"
+            "• Admins are exempt from all filters",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Back", callback_data="back_main")]
+            ])
+        )
+        await callback_query.answer()
+    
+    async def cb_admin(client, callback_query, ctx):
+        await safe_edit_message(
+            callback_query.message,
+            "🆘 **Admin Controls**\n\n"
+            "**🔒 Force Join (New!):**\n"
+            "`/setforcejoin @channel|Name|Link` - Enable\n"
+            "`/removeforcejoin` - Disable force join\n"
+            "`/forcejoininfo` - View status\n\n"
+            "**Block @Mentions:**\n"
+            "`/blockmention` - Toggle @mention blocking\n\n"
+            "**Auto-Delete 2 min:**\n"
+            "`/autodelete2min` - Toggle auto-delete\n\n"
+            "**Other Commands (in group):**\n"
+            "`/enablemod` - Enable moderation first\n"
+            "`/modstatus` - View all settings\n\n"
+            "⚡ Force Join: Non-members के messages delete होंगे!\n"
+            "👮 Admins are exempt from filters.",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Back", callback_data="back_main")]
+            ])
+        )
+        await callback_query.answer()
+    
+    async def cb_join_request(client, callback_query, ctx):
+        channels_list = "\n".join([
+            f"• {entry['title'] or entry['channel']} (`{chat_id}`)" for chat_id, entry in auto_approve_index.items()
+        ]) if auto_approve_index else "None"
+        await safe_edit_message(
+            callback_query.message,
+            "📥 **Join Request Auto-Approve**\n\n"
+            "📢 Works for both **Channels & Groups**!\n\n"
+            f"**Status:** {'🟢 Active' if auto_approve_channels else '🔴 Inactive'}\n"
+            f"**Total:** {len(auto_approve_channels)}\n"
+            f"✅ Approved: {auto_approve_stats['approved']}\n"
+            f"❌ Failed: {auto_approve_stats['failed']}\n\n"
+            f"**Active Channels/Groups:**\n{channels_list}\n\n"
+            "**Commands:**\n"
+            "/autoapprove <channel/group> - Enable\n"
+            "/stopapprove <channel/group> - Disable\n"
+            "/approveall <channel/group> - Accept all pending\n"
+            "/approvelist - Show all enabled",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Back", callback_data="back_main")]
+            ])
+        )
+        await callback_query.answer()
+    
+    async def cb_file_logo(client, callback_query, ctx):
+        await safe_edit_message(
+            callback_query.message,
+            "🖼️ **File Logo / Watermark**\n\n"
+            f"**Status:** {'🟢 Enabled' if logo_config.get('enabled') else '🔴 Disabled'}\n"
+            f"**Logo:** {'✅ Set' if logo_config.get('logo_file_id') else '❌ Not set'}\n"
+            f"**Text:** {logo_config.get('text') or 'Not set'}\n"
+            f"**Position:** {logo_config.get('position', 'bottom-right')}\n"
+            f"**Opacity:** {logo_config.get('opacity', 128)}/255\n"
+            f"**Size:** {logo_config.get('size', 20)}%\n\n"
+            f"📊 **Stats:**\n"
+            f"✅ Watermarked: {logo_stats['watermarked']}\n"
+            f"❌ Failed: {logo_stats['failed']}\n"
+            f"💾 Upload bytes saved: {(logo_stats['bytes_in'] - logo_stats['bytes_out']) / 1024 / 1024:.1f} MB\n\n"
+            "**Commands:**\n"
+            "/setlogo - Reply to image to set logo\n"
+            "/setlogotext <text> - Set text watermark\n"
+            "/logoposition <pos> - Set position\n"
+            "/logosize <1-50> - Set size %\n"
+            "/logoopacity <0-255> - Set opacity\n"
+            "/enablelogo - Enable watermark\n"
+            "/disablelogo - Disable watermark\n"
+            "/removelogo - Remove logo\n"
+            "/logoinfo - Show logo settings",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Back", callback_data="back_main")]
+            ])
+        )
+        await callback_query.answer()
+    
+    async def cb_help(client, callback_query, ctx):
+        user_id = callback_query.from_user.id
+        
+        # Show different help based on admin status
+        if user_id in ADMIN_IDS:
+            help_text = (
+                "❓ **Help Menu**\n\n"
+                "**📤 Forwarding:**\n"
+                "/start - Show main menu\n"
+                "/setconfig - Set channels\n"
+                "/forward - Start forwarding\n"
+                "/resume - Resume forwarding\n"
+                "/stop - Stop forwarding\n"
+                "/progress - Show progress\n"
+                "/status - Show status\n"
+                "/accounts - Show accounts\n\n"
+                "**🛡️ Moderation (in groups):**\n"
+                "/enablemod - Enable moderation\n"
+                "/blockforward - Block forwards\n"
+                "/blocklinks - Block links\n"
+                "/blockbadwords - Block bad content\n"
+                "/modstatus - View settings"
+            )
+        else:
+            help_text = (
+                "❓ **Help Menu**\n\n"
+                "**📤 Forwarding:**\n"
+                "/start - Show main menu\n"
+                "/forward - Start forwarding\n\n"
+                "**🛡️ Moderation (in groups):**\n"
+                "/enablemod - Enable moderation\n"
+                "/blockforward - Block forwards\n"
+                "/blocklinks - Block links\n"
+                "/blockbadwords - Block bad content\n"
+                "/modstatus - View settings"
+            )
+        
+        await safe_edit_message(
+            callback_query.message,
+            help_text,
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Back", callback_data="back_main")]
+            ])
+        )
+        await callback_query.answer()
+    
+    async def cb_filters_menu(client, callback_query, ctx):
+        # Show filter management menu
+        filter_keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("🎬 Video Filter", callback_data="filter_info_video")],
+            [InlineKeyboardButton("🖼️ Photo Filter", callback_data="filter_info_photo")],
+            [InlineKeyboardButton("📁 File Filter", callback_data="filter_info_file")],
+            [InlineKeyboardButton("🎵 Audio Filter", callback_data="filter_info_audio")],
+            [InlineKeyboardButton("🎭 Sticker Filter", callback_data="filter_info_sticker")],
+            [InlineKeyboardButton("📝 Text Filter", callback_data="filter_info_text")],
+            [InlineKeyboardButton("🔙 Back", callback_data="back_main")]
+        ])
+        
+        await safe_edit_message(
+            callback_query.message,
+            "🔍 **Forwarding Filters**\n\n"
+            "You can skip specific content types during forwarding:\n\n"
+            "• **🎬 Video Filter** - Skip videos, GIFs, video notes\n"
+            "• **🖼️ Photo Filter** - Skip photos/images\n"
+            "• **📁 File Filter** - Skip documents/files\n"
+            "• **🎵 Audio Filter** - Skip audio, voice messages\n"
+            "• **🎭 Sticker Filter** - Skip stickers\n"
+            "• **📝 Text Filter** - Skip text-only messages\n\n"
+            "⚡ **How to use:**\n"
+            "1. Click **📤 Forward** button\n"
+            "2. Set source channel\n"
+            "3. Enter skip number\n"
+            "4. **Select filters** to skip content types\n"
+            "5. Select destination channel\n"
+            "6. Forwarding starts!\n\n"
+            "✅ = Content will be SKIPPED\n"
+            "❌ = Content will be forwarded",
+            reply_markup=filter_keyboard
+        )
+        await callback_query.answer()
+    
+    async def cb_filter_info(client, callback_query, ctx):
+        filter_type = callback_query.data.replace("filter_info_", "")
+        
+        filter_info = {
+            "video": ("🎬 Video Filter", "Videos, GIFs (animations), Video notes/circles", "Movies, clips, animated content"),
+            "photo": ("🖼️ Photo Filter", "Photos, Images, Pictures", "All image content"),
+            "file": ("📁 File Filter", "Documents, PDFs, ZIPs, any file attachments", "All document types"),
+            "audio": ("🎵 Audio Filter", "Audio files, Voice messages, Music", "MP3, voice notes, audio content"),
+            "sticker": ("🎭 Sticker Filter", "Stickers, Animated stickers", "All sticker types"),
+            "text": ("📝 Text Filter", "Text-only messages (no media attached)", "Plain text messages")
+        }
+        
+        info = filter_info.get(filter_type, ("Unknown", "Unknown", "Unknown"))
+        
+        back_keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔙 Back to Filters", callback_data="filters_menu")]
+        ])
+        
+        await safe_edit_message(
+            callback_query.message,
+            f"**{info[0]}**\n\n"
+            f"📋 **What it filters:**\n{info[1]}\n\n"
+            f"📌 **Examples:**\n{info[2]}\n\n"
+            f"⚡ **To use this filter:**\n"
+            f"Start forwarding → Select this filter → ✅",
+            reply_markup=back_keyboard
+        )
+        await callback_query.answer()
+    
+    async def cb_cancel_forward(client, callback_query, ctx):
+        user_id = callback_query.from_user.id
+        forward_wizard_state.pop(user_id, None)
+        await safe_edit_message(
+            callback_query.message,
+            "❌ Forwarding cancelled!",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Back", callback_data="back_main")]
+            ])
+        )
+        await callback_query.answer()
+    
+    async def cb_select_dest(client, callback_query, ctx):
+        # User selected a destination channel
+        user_id = callback_query.from_user.id
+        channel_idx = int(callback_query.data.replace("select_dest_", ""))
+        
+        if user_id not in forward_wizard_state:
             await safe_edit_message(
                 callback_query.message,
-                "🖼️ **File Logo / Watermark**\n\n"
-                f"**Status:** {'🟢 Enabled' if logo_config.get('enabled') else '🔴 Disabled'}\n"
-                f"**Logo:** {'✅ Set' if logo_config.get('logo_file_id') else '❌ Not set'}\n"
-                f"**Text:** {logo_config.get('text') or 'Not set'}\n"
-                f"**Position:** {logo_config.get('position', 'bottom-right')}\n"
-                f"**Opacity:** {logo_config.get('opacity', 128)}/255\n"
-                f"**Size:** {logo_config.get('size', 20)}%\n\n"
-                f"📊 **Stats:**\n"
-                f"✅ Watermarked: {logo_stats['watermarked']}\n"
-                f"❌ Failed: {logo_stats['failed']}\n\n"
-                "**Commands:**\n"
-                "/setlogo - Reply to image to set logo\n"
-                "/setlogotext <text> - Set text watermark\n"
-                "/logoposition <pos> - Set position\n"
-                "/logosize <1-50> - Set size %\n"
-                "/logoopacity <0-255> - Set opacity\n"
-                "/enablelogo - Enable watermark\n"
-                "/disablelogo - Disable watermark\n"
-                "/removelogo - Remove logo\n"
-                "/logoinfo - Show logo settings",
+                "❌ Session expired. Please start again.",
                 reply_markup=InlineKeyboardMarkup([
                     [InlineKeyboardButton("🔙 Back", callback_data="back_main")]
                 ])
             )
             await callback_query.answer()
-        elif data == "help":
-            user_id = callback_query.from_user.id
-            
-            # Show different help based on admin status
-            if user_id in ADMIN_IDS:
-                help_text = (
-                    "❓ **Help Menu**\n\n"
-                    "**📤 Forwarding:**\n"
-                    "/start - Show main menu\n"
-                    "/setconfig - Set channels\n"
-                    "/forward - Start forwarding\n"
-                    "/resume - Resume forwarding\n"
-                    "/stop - Stop forwarding\n"
-                    "/progress - Show progress\n"
-                    "/status - Show status\n"
-                    "/accounts - Show accounts\n\n"
-                    "**🛡️ Moderation (in groups):**\n"
-                    "/enablemod - Enable moderation\n"
-                    "/blockforward - Block forwards\n"
-                    "/blocklinks - Block links\n"
-                    "/blockbadwords - Block bad content\n"
-                    "/modstatus - View settings"
-                )
-            else:
-                help_text = (
-                    "❓ **Help Menu**\n\n"
-                    "**📤 Forwarding:**\n"
-                    "/start - Show main menu\n"
-                    "/forward - Start forwarding\n\n"
-                    "**🛡️ Moderation (in groups):**\n"
-                    "/enablemod - Enable moderation\n"
-                    "/blockforward - Block forwards\n"
-                    "/blocklinks - Block links\n"
-                    "/blockbadwords - Block bad content\n"
-                    "/modstatus - View settings"
-                )
-            
+            return
+        
+        # Get user's channels
+        user_channels = ctx["user_channels"]
+        
+        if channel_idx >= len(user_channels):
             await safe_edit_message(
                 callback_query.message,
-                help_text,
+                "❌ Invalid channel!",
                 reply_markup=InlineKeyboardMarkup([
                     [InlineKeyboardButton("🔙 Back", callback_data="back_main")]
                 ])
             )
             await callback_query.answer()
-        elif data == "filters_menu":
-            # Verify user access
-            if not await verify_user_access(callback_query, client):
-                return
-            
-            # Show filter management menu
-            user_id = callback_query.from_user.id
-            
-            filter_keyboard = InlineKeyboardMarkup([
-                [InlineKeyboardButton("🎬 Video Filter", callback_data="filter_info_video")],
-                [InlineKeyboardButton("🖼️ Photo Filter", callback_data="filter_info_photo")],
-                [InlineKeyboardButton("📁 File Filter", callback_data="filter_info_file")],
-                [InlineKeyboardButton("🎵 Audio Filter", callback_data="filter_info_audio")],
-                [InlineKeyboardButton("🎭 Sticker Filter", callback_data="filter_info_sticker")],
-                [InlineKeyboardButton("📝 Text Filter", callback_data="filter_info_text")],
-                [InlineKeyboardButton("🔙 Back", callback_data="back_main")]
-            ])
-            
-            await safe_edit_message(
-                callback_query.message,
-                "🔍 **Forwarding Filters**\n\n"
-                "You can skip specific content types during forwarding:\n\n"
-                "• **🎬 Video Filter** - Skip videos, GIFs, video notes\n"
-                "• **🖼️ Photo Filter** - Skip photos/images\n"
-                "• **📁 File Filter** - Skip documents/files\n"
-                "• **🎵 Audio Filter** - Skip audio, voice messages\n"
-                "• **🎭 Sticker Filter** - Skip stickers\n"
-                "• **📝 Text Filter** - Skip text-only messages\n\n"
-                "⚡ **How to use:**\n"
-                "1. Click **📤 Forward** button\n"
-                "2. Set source channel\n"
-                "3. Enter skip number\n"
-                "4. **Select filters** to skip content types\n"
-                "5. Select destination channel\n"
-                "6. Forwarding starts!\n\n"
-                "✅ = Content will be SKIPPED\n"
-                "❌ = Content will be forwarded",
-                reply_markup=filter_keyboard
-            )
-            await callback_query.answer()
-        elif data.startswith("filter_info_"):
-            filter_type = data.replace("filter_info_", "")
-            
-            filter_info = {
-                "video": ("🎬 Video Filter", "Videos, GIFs (animations), Video notes/circles", "Movies, clips, animated content"),
-                "photo": ("🖼️ Photo Filter", "Photos, Images, Pictures", "All image content"),
-                "file": ("📁 File Filter", "Documents, PDFs, ZIPs, any file attachments", "All document types"),
-                "audio": ("🎵 Audio Filter", "Audio files, Voice messages, Music", "MP3, voice notes, audio content"),
-                "sticker": ("🎭 Sticker Filter", "Stickers, Animated stickers", "All sticker types"),
-                "text": ("📝 Text Filter", "Text-only messages (no media attached)", "Plain text messages")
-            }
-            
-            info = filter_info.get(filter_type, ("Unknown", "Unknown", "Unknown"))
-            
-            back_keyboard = InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔙 Back to Filters", callback_data="filters_menu")]
-            ])
-            
-            await safe_edit_message(
-                callback_query.message,
-                f"**{info[0]}**\n\n"
-                f"📋 **What it filters:**\n{info[1]}\n\n"
-                f"📌 **Examples:**\n{info[2]}\n\n"
-                f"⚡ **To use this filter:**\n"
-                f"Start forwarding → Select this filter → ✅",
-                reply_markup=back_keyboard
-            )
-            await callback_query.answer()
-        elif data == "cancel_forward":
-            user_id = callback_query.from_user.id
-            forward_wizard_state.pop(user_id, None)
+            return
+        
+        dest_channel = user_channels[channel_idx]
+        wizard = forward_wizard_state[user_id]
+        wizard["dest_channel"] = dest_channel
+        wizard["dest_title"] = dest_channel
+        wizard["state"] = "forwarding"
+        
+        # Initialize progress tracking for this user
+        user_forward_progress[user_id] = {
+            "fetched_msg": wizard["last_message_id"],
+            "success_fwd": 0,
+            "duplicate_msg": 0,
+            "skipped_msg": wizard["skip_number"],
+            "filtered_msg": 0,
+            "status": "Starting",
+            "percentage": 0,
+            "elapsed": 0,
+            "eta": "Calculating...",
+            "is_active": True,
+            "started_at": time.time(),
+            "status_message_id": None
+        }
+        
+        # Send initial status message
+        cancel_keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("• CANCEL", callback_data="cancel_fwd_active")]
+        ])
+        
+        status_msg = await callback_query.message.reply(
+            format_forward_status(user_id),
+            reply_markup=cancel_keyboard
+        )
+        
+        user_forward_progress[user_id]["status_message_id"] = status_msg.id
+        user_forward_progress[user_id]["chat_id"] = callback_query.message.chat.id
+        
+        # Start forwarding in background
+        asyncio.create_task(wizard_forward_messages(
+            user_id,
+            wizard["source_channel"],
+            dest_channel,
+            wizard["skip_number"],
+            wizard["last_message_id"],
+            wizard.get("filters", {}),
+            client
+        ))
+    
+    async def cb_toggle_filter(client, callback_query, ctx):
+        # Toggle a filter option
+        user_id = callback_query.from_user.id
+        filter_name = callback_query.data.replace("toggle_filter_", "")
+        
+        if user_id not in forward_wizard_state:
             await safe_edit_message(
                 callback_query.message,
-                "❌ Forwarding cancelled!",
+                "❌ Session expired. Please start again.",
                 reply_markup=InlineKeyboardMarkup([
                     [InlineKeyboardButton("🔙 Back", callback_data="back_main")]
                 ])
             )
             await callback_query.answer()
-        elif data.startswith("select_dest_"):
-            # User selected a destination channel
-            user_id = callback_query.from_user.id
-            channel_idx = int(data.replace("select_dest_", ""))
-            
-            if user_id not in forward_wizard_state:
-                await safe_edit_message(
-                    callback_query.message,
-                    "❌ Session expired. Please start again.",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("🔙 Back", callback_data="back_main")]
-                    ])
-                )
-                await callback_query.answer()
-                return
-            
-            # Get user's channels
-            user_channels = []
-            if user_channels_col is not None:
-                saved = user_channels_col.find({"user_id": user_id})
-                user_channels = [c.get("channel") for c in saved if c.get("channel")]
-            
-            if channel_idx >= len(user_channels):
-                await safe_edit_message(
-                    callback_query.message,
-                    "❌ Invalid channel!",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("🔙 Back", callback_data="back_main")]
-                    ])
-                )
-                await callback_query.answer()
-                return
-            
-            dest_channel = user_channels[channel_idx]
-            wizard = forward_wizard_state[user_id]
-            wizard["dest_channel"] = dest_channel
-            wizard["dest_title"] = dest_channel
-            wizard["state"] = "forwarding"
-            
-            # Initialize progress tracking for this user
-            user_forward_progress[user_id] = {
-                "fetched_msg": wizard["last_message_id"],
-                "success_fwd": 0,
-                "duplicate_msg": 0,
-                "skipped_msg": wizard["skip_number"],
-                "filtered_msg": 0,
-                "status": "Starting",
-                "percentage": 0,
-                "elapsed": 0,
-                "eta": "Calculating...",
-                "is_active": True,
-                "started_at": time.time(),
-                "status_message_id": None
+            return
+        
+        wizard = forward_wizard_state[user_id]
+        if "filters" not in wizard:
+            wizard["filters"] = {
+                "skip_videos": False,
+                "skip_photos": False,
+                "skip_files": False,
+                "skip_audio": False,
+                "skip_stickers": False,
+                "skip_text": False
             }
-            
-            # Send initial status message
-            cancel_keyboard = InlineKeyboardMarkup([
-                [InlineKeyboardButton("• CANCEL", callback_data="cancel_fwd_active")]
-            ])
-            
-            status_msg = await callback_query.message.reply(
-                format_forward_status(user_id),
-                reply_markup=cancel_keyboard
-            )
-            
-            user_forward_progress[user_id]["status_message_id"] = status_msg.id
-            user_forward_progress[user_id]["chat_id"] = callback_query.message.chat.id
-            
-            # Start forwarding in background
-            asyncio.create_task(wizard_forward_messages(
-                user_id,
-                wizard["source_channel"],
-                dest_channel,
-                wizard["skip_number"],
-                wizard["last_message_id"],
-                wizard.get("filters", {}),
-                client
-            ))
-        elif data.startswith("toggle_filter_"):
-            # Toggle a filter option
-            user_id = callback_query.from_user.id
-            filter_name = data.replace("toggle_filter_", "")
-            
-            if user_id not in forward_wizard_state:
-                await safe_edit_message(
-                    callback_query.message,
-                    "❌ Session expired. Please start again.",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("🔙 Back", callback_data="back_main")]
-                    ])
-                )
-                await callback_query.answer()
-                return
-            
-            wizard = forward_wizard_state[user_id]
-            if "filters" not in wizard:
-                wizard["filters"] = {
-                    "skip_videos": False,
-                    "skip_photos": False,
-                    "skip_files": False,
-                    "skip_audio": False,
-                    "skip_stickers": False,
-                    "skip_text": False
-                }
-            
-            # Toggle the filter
-            wizard["filters"][filter_name] = not wizard["filters"].get(filter_name, False)
-            
-            # Update the filter selection message
-            filters = wizard["filters"]
-            filter_buttons = [
-                [
-                    InlineKeyboardButton(
-                        f"{'✅' if filters.get('skip_videos') else '❌'} Skip Videos",
-                        callback_data="toggle_filter_skip_videos"
-                    ),
-                    InlineKeyboardButton(
-                        f"{'✅' if filters.get('skip_photos') else '❌'} Skip Photos",
-                        callback_data="toggle_filter_skip_photos"
-                    )
-                ],
-                [
-                    InlineKeyboardButton(
-                        f"{'✅' if filters.get('skip_files') else '❌'} Skip Files",
-                        callback_data="toggle_filter_skip_files"
-                    ),
-                    InlineKeyboardButton(
-                        f"{'✅' if filters.get('skip_audio') else '❌'} Skip Audio",
-                        callback_data="toggle_filter_skip_audio"
-                    )
-                ],
-                [
-                    InlineKeyboardButton(
-                        f"{'✅' if filters.get('skip_stickers') else '❌'} Skip Stickers",
-                        callback_data="toggle_filter_skip_stickers"
-                    ),
-                    InlineKeyboardButton(
-                        f"{'✅' if filters.get('skip_text') else '❌'} Skip Text Only",
-                        callback_data="toggle_filter_skip_text"
-                    )
-                ],
-                [InlineKeyboardButton("✅ Continue", callback_data="filters_done")],
-                [InlineKeyboardButton("❌ Cancel", callback_data="cancel_forward")]
-            ]
-            
-            try:
-                await callback_query.message.edit_reply_markup(
-                    reply_markup=InlineKeyboardMarkup(filter_buttons)
+        
+        # Toggle the filter
+        wizard["filters"][filter_name] = not wizard["filters"].get(filter_name, False)
+        
+        # Update the filter selection message
+        filters = wizard["filters"]
+        filter_buttons = [
+            [
+                InlineKeyboardButton(
+                    f"{'✅' if filters.get('skip_videos') else '❌'} Skip Videos",
+                    callback_data="toggle_filter_skip_videos"
+                ),
+                InlineKeyboardButton(
+                    f"{'✅' if filters.get('skip_photos') else '❌'} Skip Photos",
+                    callback_data="toggle_filter_skip_photos"
                 )
-            except:
-                pass
-            await callback_query.answer()
-        elif data == "filters_done":
-            # User finished selecting filters, show destination channels
-            user_id = callback_query.from_user.id
-            
-            if user_id not in forward_wizard_state:
-                await safe_edit_message(
-                    callback_query.message,
-                    "❌ Session expired. Please start again.",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("🔙 Back", callback_data="back_main")]
-                    ])
+            ],
+            [
+                InlineKeyboardButton(
+                    f"{'✅' if filters.get('skip_files') else '❌'} Skip Files",
+                    callback_data="toggle_filter_skip_files"
+                ),
+                InlineKeyboardButton(
+                    f"{'✅' if filters.get('skip_audio') else '❌'} Skip Audio",
+                    callback_data="toggle_filter_skip_audio"
                 )
-                await callback_query.answer()
-                return
-            
-            wizard = forward_wizard_state[user_id]
-            wizard["state"] = "waiting_dest"
-            
-            # Get user's saved channels
-            user_channels = []
-            if user_channels_col is not None:
-                saved = user_channels_col.find({"user_id": user_id})
-                user_channels = [c.get("channel") for c in saved if c.get("channel")]
-            
-            if not user_channels:
-                await safe_edit_message(
-                    callback_query.message,
-                    "❌ No destination channels saved!\n\n"
-                    "Please add channels first using:\n"
-                    "/start → 📢 Channel → Add Channel",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("📢 Add Channel", callback_data="add_channel")],
-                        [InlineKeyboardButton("🔙 Back", callback_data="back_main")]
-                    ])
+            ],
+            [
+                InlineKeyboardButton(
+                    f"{'✅' if filters.get('skip_stickers') else '❌'} Skip Stickers",
+                    callback_data="toggle_filter_skip_stickers"
+                ),
+                InlineKeyboardButton(
+                    f"{'✅' if filters.get('skip_text') else '❌'} Skip Text Only",
+                    callback_data="toggle_filter_skip_text"
                 )
-                forward_wizard_state.pop(user_id, None)
-                await callback_query.answer()
-                return
-            
-            # Create buttons for each channel
-            buttons = [[InlineKeyboardButton(f"📁 {ch}", callback_data=f"select_dest_{i}")] for i, ch in enumerate(user_channels[:10])]
-            buttons.append([InlineKeyboardButton("❌ Cancel", callback_data="cancel_forward")])
-            
+            ],
+            [InlineKeyboardButton("✅ Continue", callback_data="filters_done")],
+            [InlineKeyboardButton("❌ Cancel", callback_data="cancel_forward")]
+        ]
+        
+        try:
+            await callback_query.message.edit_reply_markup(
+                reply_markup=InlineKeyboardMarkup(filter_buttons)
+            )
+        except:
+            pass
+        await callback_query.answer()
+    
+    async def cb_filters_done(client, callback_query, ctx):
+        # User finished selecting filters, show destination channels
+        user_id = callback_query.from_user.id
+        
+        if user_id not in forward_wizard_state:
             await safe_edit_message(
                 callback_query.message,
-                f"**( SELECT DESTINATION CHAT )**\n\n"
-                f"Select a channel from your saved channels:",
-                reply_markup=InlineKeyboardMarkup(buttons)
+                "❌ Session expired. Please start again.",
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton("🔙 Back", callback_data="back_main")]
+                ])
             )
             await callback_query.answer()
-        elif data == "cancel_fwd_active":
-            user_id = callback_query.from_user.id
-            if user_id in user_forward_progress:
-                user_forward_progress[user_id]["is_active"] = False
-                user_forward_progress[user_id]["status"] = "Cancelled"
-            forward_wizard_state.pop(user_id, None)
+            return
+        
+        wizard = forward_wizard_state[user_id]
+        wizard["state"] = "waiting_dest"
+        
+        # Get user's saved channels
+        user_channels = ctx["user_channels"]
+        
+        if not user_channels:
             await safe_edit_message(
                 callback_query.message,
-                "🛑 Forwarding cancelled!",
+                "❌ No destination channels saved!\n\n"
+                "Please add channels first using:\n"
+                "/start → 📢 Channel → Add Channel",
                 reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton("📢 Add Channel", callback_data="add_channel")],
                     [InlineKeyboardButton("🔙 Back", callback_data="back_main")]
                 ])
             )
+            forward_wizard_state.pop(user_id, None)
             await callback_query.answer()
+            return
         
+        # Create buttons for each channel
+        buttons = [[InlineKeyboardButton(f"📁 {ch}", callback_data=f"select_dest_{i}")] for i, ch in enumerate(user_channels[:10])]
+        buttons.append([InlineKeyboardButton("❌ Cancel", callback_data="cancel_forward")])
+        
+        await safe_edit_message(
+            callback_query.message,
+            f"**( SELECT DESTINATION CHAT )**\n\n"
+            f"Select a channel from your saved channels:",
+            reply_markup=InlineKeyboardMarkup(buttons)
+        )
+        await callback_query.answer()
+    
+    async def cb_cancel_fwd_active(client, callback_query, ctx):
+        user_id = callback_query.from_user.id
+        if user_id in user_forward_progress:
+            user_forward_progress[user_id]["is_active"] = False
+            user_forward_progress[user_id]["status"] = "Cancelled"
+        forward_wizard_state.pop(user_id, None)
+        await safe_edit_message(
+            callback_query.message,
+            "🛑 Forwarding cancelled!",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Back", callback_data="back_main")]
+            ])
+        )
         await callback_query.answer()
     
+    # callback_data -> (handler, middleware). Exact matches first, then prefixes.
+    # Middleware runs in order and may stop the route by returning False (it answers the query itself).
+    callback_routes = {
+        "check_joined": (cb_check_joined, ()),
+        "check_referrals": (cb_check_referrals, ()),
+        "my_referral": (cb_my_referral, ()),
+        "forward": (cb_forward, (require_access,)),
+        "channel": (cb_channel, (require_access, load_user_channels)),
+        "add_channel": (cb_add_channel, (require_access,)),
+        "remove_channel": (cb_remove_channel, (require_access, load_user_channels)),
+        "back_main": (cb_back_main, ()),
+        "moderation": (cb_moderation, (require_access,)),
+        "admin": (cb_admin, (require_access,)),
+        "join_request": (cb_join_request, (require_access,)),
+        "file_logo": (cb_file_logo, (require_access,)),
+        "help": (cb_help, ()),
+        "filters_menu": (cb_filters_menu, (require_access,)),
+        "cancel_forward": (cb_cancel_forward, ()),
+        "filters_done": (cb_filters_done, (load_user_channels,)),
+        "cancel_fwd_active": (cb_cancel_fwd_active, ()),
+    }
+    callback_prefix_routes = {
+        "del_ch_": (cb_del_ch, ()),
+        "filter_info_": (cb_filter_info, ()),
+        "select_dest_": (cb_select_dest, (load_user_channels,)),
+        "toggle_filter_": (cb_toggle_filter, ()),
+    }
+    
+    @bot_client.on_callback_query()
+    async def callback_handler(client, callback_query):
+        """Dispatch a button press to its route"""
+        data = callback_query.data or ""
+        route = callback_routes.get(data)
+        if route is None:
+            for prefix, prefix_route in callback_prefix_routes.items():
+                if data.startswith(prefix):
+                    route = prefix_route
+                    break
+        
+        if route is None:
+            await callback_query.answer()
+            return
+        
+        handler, middleware = route
+        ctx = {}
+        for step in middleware:
+            if not await step(client, callback_query, ctx):
+                return
+        await handler(client, callback_query, ctx)
+    
     @bot_client.on_message(filters.command("accounts"))
     async def accounts_handler(client, message):
         # Admin only command
@@ -2997,7 +4753,8 @@ def register_bot_handlers():
                 f"⚡ Speed: {current_progress['speed']}/min\n"
                 f"👥 Accounts: {current_progress.get('active_accounts', 1)}\n"
                 f"🔄 Active: {'Yes' if current_progress['is_active'] else 'No'}\n"
-                f"⚠️ Rate limits: {current_progress['rate_limit_hits']}"
+                f"⚠️ Rate limits: {current_progress['rate_limit_hits']}\n"
+                f"🔒 Re-uploaded (protected): {protected_stats['reuploaded']} | ❌ {protected_stats['failed']}"
             )
         else:
             await message.reply(
@@ -3106,12 +4863,14 @@ def register_bot_handlers():
                     "• top-right\n"
                     "• bottom-left\n"
                     "• bottom-right\n"
-                    "• center"
+                    "• center\n"
+                    "• auto (least busy corner)\n"
+                    "• auto-contrast (corner with most contrast)"
                 )
                 return
             
             position = parts[1].lower()
-            valid_positions = ["top-left", "top-right", "bottom-left", "bottom-right", "center"]
+            valid_positions = ["top-left", "top-right", "bottom-left", "bottom-right", "center"] + AUTO_POSITIONS
             
             if position not in valid_positions:
                 await message.reply(f"❌ Invalid position. Use: {', '.join(valid_positions)}")
@@ -3222,7 +4981,8 @@ def register_bot_handlers():
             f"**Size:** {logo_config.get('size', 20)}%\n\n"
             f"📊 **Stats:**\n"
             f"✅ Watermarked: {logo_stats['watermarked']}\n"
-            f"❌ Failed: {logo_stats['failed']}"
+            f"❌ Failed: {logo_stats['failed']}\n"
+            f"💾 Upload bytes saved: {(logo_stats['bytes_in'] - logo_stats['bytes_out']) / 1024 / 1024:.1f} MB"
         )
     
     # ============ CONTENT MODERATION HANDLERS ============
@@ -3456,7 +5216,7 @@ def register_bot_handlers():
     @bot_client.on_message(filters.command("autodelete2min") & GROUP_CHAT)
     async def autodelete2min_handler(client, message):
         """Toggle auto-delete messages after 2 minutes"""
-        global moderation_config, auto_delete_queue
+        global moderation_config
         
         chat_id = message.chat.id
         user_id = message.from_user.id if message.from_user else None
@@ -3486,43 +5246,11 @@ def register_bot_handlers():
         moderation_config[chat_id]["enabled"] = True
         save_moderation_config(chat_id)
         
-        # Initialize queue for this chat if enabling
-        if not current:
-            auto_delete_queue[chat_id] = []
-        
         status = "🟢 ON" if not current else "🔴 OFF"
         await message.reply(f"🗑️ **Auto-Delete 2min:** {status}\n\nAll messages in this group will be deleted after 2 minutes!")
     
     # ============ FORCE JOIN HANDLERS ============
     
-    def load_group_forcejoin(chat_id):
-        """Load force join config for a group from database"""
-        global group_forcejoin_config
-        if group_forcejoin_col is not None:
-            saved = group_forcejoin_col.find_one({"chat_id": chat_id})
-            if saved:
-                group_forcejoin_config[chat_id] = {
-                    "enabled": saved.get("enabled", False),
-                    "channel_id": saved.get("channel_id"),
-                    "channel_name": saved.get("channel_name", "Channel"),
-                    "invite_link": saved.get("invite_link", "")
-                }
-                return group_forcejoin_config[chat_id]
-        return {"enabled": False, "channel_id": None, "channel_name": "", "invite_link": ""}
-    
-    def save_group_forcejoin(chat_id):
-        """Save force join config for a group to database"""
-        if group_forcejoin_col is not None and chat_id in group_forcejoin_config:
-            group_forcejoin_col.update_one(
-                {"chat_id": chat_id},
-                {"$set": {
-                    **group_forcejoin_config[chat_id],
-                    "chat_id": chat_id,
-                    "updated_at": datetime.utcnow()
-                }},
-                upsert=True
-            )
-    
     @bot_client.on_message(filters.command("setforcejoin") & GROUP_CHAT)
     async def setforcejoin_handler(client, message):
         """Set force join channel for this group"""
@@ -3623,13 +5351,9 @@ def register_bot_handlers():
             await message.reply("❌ Only admins can remove force join!")
             return
         
-        # Disable force join
-        if chat_id in group_forcejoin_config:
-            group_forcejoin_config[chat_id]["enabled"] = False
-            save_group_forcejoin(chat_id)
-        
-        if group_forcejoin_col is not None:
-            group_forcejoin_col.delete_one({"chat_id": chat_id})
+        # Disable force join (a disabled document lets other instances pick up the change)
+        group_forcejoin_config[chat_id] = default_forcejoin_config()
+        save_group_forcejoin(chat_id)
         
         await message.reply("🔴 **Force Join Disabled!**\n\nAll users can now send messages without joining any channel.")
     
@@ -3661,34 +5385,17 @@ def register_bot_handlers():
     
     # ============ FORCE JOIN MESSAGE FILTER ============
     
-    @bot_client.on_message(GROUP_CHAT & ~filters.command(["setforcejoin", "removeforcejoin", "forcejoininfo", "enablemod", "disablemod", "blockforward", "blocklinks", "blockbadwords", "blockmention", "autodelete2min", "modstatus", "warnings", "resetwarnings"]), group=1)
-    async def forcejoin_filter_handler(client, message):
-        """Delete messages from users who haven't joined the force join channel"""
-        global group_forcejoin_config
-        
+    async def forcejoin_filter_handler(client, message, config):
+        """Delete messages from users who haven't joined the force join channel. Returns True if deleted"""
         chat_id = message.chat.id
         user_id = message.from_user.id if message.from_user else None
         
         if not user_id:
-            return
-        
-        # Load config if not in memory
-        if chat_id not in group_forcejoin_config:
-            group_forcejoin_config[chat_id] = load_group_forcejoin(chat_id)
-        
-        config = group_forcejoin_config.get(chat_id, {})
-        
-        # Skip if force join is disabled
-        if not config.get("enabled") or not config.get("channel_id"):
-            return
+            return False
         
         # Skip if user is admin
-        try:
-            member = await client.get_chat_member(chat_id, user_id)
-            if member.status in [ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]:
-                return
-        except:
-            pass
+        if await is_chat_admin(client, chat_id, user_id):
+            return False
         
         # Check if user has joined the channel
         channel_id = config.get("channel_id")
@@ -3700,13 +5407,11 @@ def register_bot_handlers():
             else:
                 check_chat_id = "@" + channel_id
             
-            channel_member = await client.get_chat_member(check_chat_id, user_id)
-            if channel_member.status not in [ChatMemberStatus.LEFT, ChatMemberStatus.BANNED]:
+            if await is_channel_member(client, check_chat_id, user_id):
                 # User has joined, allow message
-                return
+                return False
         except Exception as e:
-            # If we can't check (user not found in channel), assume not joined
-            pass
+            print(f"⚠️ Force join check failed: {e}")
         
         # User hasn't joined - delete message and send join button
         try:
@@ -3724,23 +5429,47 @@ def register_bot_handlers():
             [InlineKeyboardButton("✅ I've Joined", callback_data=f"check_forcejoin_{chat_id}_{user_id}")]
         ])
         
-        try:
-            warn_msg = await client.send_message(
-                chat_id,
-                f"👋 **{user_name}**, आप यहाँ message नहीं भेज सकते!\n\n"
-                f"📢 पहले **{channel_name}** join करो, फिर message करो!\n\n"
-                f"⬇️ नीचे button पर click करके join करो:",
-                reply_markup=join_button
-            )
-            # Auto-delete warning after 30 seconds
-            asyncio.create_task(auto_delete_message(warn_msg, 30))
-        except Exception as e:
-            print(f"Failed to send force join warning: {e}")
+        # Queued through the outbox (one pending prompt per user); auto-deleted after 30 seconds
+        outbox_send(
+            chat_id,
+            f"👋 **{user_name}**, आप यहाँ message नहीं भेज सकते!\n\n"
+            f"📢 पहले **{channel_name}** join करो, फिर message करो!\n\n"
+            f"⬇️ नीचे button पर click करके join करो:",
+            key=("forcejoin", user_id),
+            ttl=30,
+            auto_delete=30,
+            reply_markup=join_button
+        )
+        return True
+    
+    # ============ CHAT MEMBER UPDATES ============
+    
+    @bot_client.on_chat_member_updated()
+    async def chat_member_updated_handler(client, update):
+        """Keep the group admin and channel membership caches in sync with member updates"""
+        member = update.new_chat_member or update.old_chat_member
+        if not member or not member.user:
+            return
+        chat = update.chat
+        user_id = member.user.id
+        
+        was_admin = bool(update.old_chat_member and update.old_chat_member.status in ADMIN_STATUSES)
+        is_admin_now = bool(update.new_chat_member and update.new_chat_member.status in ADMIN_STATUSES)
+        if was_admin != is_admin_now:
+            update_group_admin_cache(chat.id, user_id, is_admin_now)
+        
+        # Join/leave: overwrite cached membership (by id and by @username)
+        joined = bool(
+            update.new_chat_member
+            and update.new_chat_member.status not in (ChatMemberStatus.LEFT, ChatMemberStatus.BANNED)
+        )
+        set_membership(chat.id, user_id, joined)
+        if chat.username:
+            set_membership(chat.username, user_id, joined)
     
     # ============ FORCE JOIN CALLBACK HANDLER ============
     
-    @bot_client.on_callback_query(filters.regex(r"^check_forcejoin_"))
-    async def check_forcejoin_callback(client, callback_query):
+    async def check_forcejoin_callback(client, callback_query, ctx):
         """Handle 'I've Joined' button click"""
         data = callback_query.data
         parts = data.split("_")
@@ -3782,8 +5511,7 @@ def register_bot_handlers():
             else:
                 check_chat_id = "@" + channel_id
             
-            channel_member = await client.get_chat_member(check_chat_id, clicker_user_id)
-            if channel_member.status not in [ChatMemberStatus.LEFT, ChatMemberStatus.BANNED]:
+            if await is_channel_member(client, check_chat_id, clicker_user_id, recheck_negative=True):
                 # User has joined!
                 await callback_query.answer("✅ धन्यवाद! अब आप message भेज सकते हैं!", show_alert=True)
                 try:
@@ -3797,36 +5525,14 @@ def register_bot_handlers():
         # Still not joined
         await callback_query.answer("❌ आपने अभी तक channel join नहीं किया! पहले join करो!", show_alert=True)
     
+    callback_prefix_routes["check_forcejoin_"] = (check_forcejoin_callback, ())
+    
     # ============ AUTO-DELETE 2MIN MESSAGE HANDLER ============
     
-    @bot_client.on_message(GROUP_CHAT & ~filters.command(["setforcejoin", "removeforcejoin", "forcejoininfo", "enablemod", "disablemod", "blockforward", "blocklinks", "blockbadwords", "blockmention", "autodelete2min", "modstatus", "warnings", "resetwarnings"]), group=99)
-    async def auto_delete_message_handler(client, message):
+    async def auto_delete_message_handler(client, message, config):
         """Queue messages for auto-deletion after 2 minutes"""
-        global auto_delete_queue
-        
-        chat_id = message.chat.id
-        
-        # Check if auto-delete is enabled for this chat
-        if chat_id not in moderation_config:
-            moderation_config[chat_id] = load_moderation_config(chat_id)
-        
-        config = moderation_config.get(chat_id, {})
-        if not config.get("auto_delete_2min"):
-            return
-        
-        # Queue the message for deletion
-        message_id = message.id
-        
-        # Create task to delete after 2 minutes
-        async def delete_after_2min():
-            try:
-                await asyncio.sleep(120)  # 2 minutes = 120 seconds
-                await client.delete_messages(chat_id, message_id)
-                moderation_stats["auto_deleted"] += 1
-            except Exception as e:
-                print(f"Failed to auto-delete message {message_id}: {e}")
-        
-        asyncio.create_task(delete_after_2min())
+        schedule_auto_delete(message.chat.id, message.id, 120, counted=True)
+        return False
     
     @bot_client.on_message(filters.command("modstatus") & GROUP_CHAT)
     async def modstatus_handler(client, message):
@@ -3845,12 +5551,16 @@ def register_bot_handlers():
             f"**Block Links:** {'🟢 ON' if config.get('block_links') else '🔴 OFF'}\n"
             f"**Block Bad Words:** {'🟢 ON' if config.get('block_badwords') else '🔴 OFF'}\n"
             f"**Block @Mentions:** {'🟢 ON' if config.get('block_mentions') else '🔴 OFF'}\n"
+            f"**Block Copy-Paste Spam:** {'🟢 ON' if config.get('block_duplicates') else '🔴 OFF'}\n"
+            f"**Shadow Mode:** {'👻 ON' if config.get('shadow_mode') else '🔴 OFF'}\n"
             f"**Auto-Delete 2min:** {'🟢 ON' if config.get('auto_delete_2min') else '🔴 OFF'}\n\n"
             f"📊 **Stats:**\n"
             f"📨 Deleted forwards: {moderation_stats['deleted_forward']}\n"
             f"🔗 Deleted links: {moderation_stats['deleted_links']}\n"
             f"🚫 Deleted bad words: {moderation_stats['deleted_badwords']}\n"
             f"📛 Deleted mentions: {moderation_stats['deleted_mentions']}\n"
+            f"📋 Deleted copy-paste spam: {moderation_stats['deleted_duplicates']}\n"
+            f"📜 Deleted by custom rules: {moderation_stats['deleted_rules']}\n"
             f"🗑️ Auto-deleted: {moderation_stats['auto_deleted']}\n"
             f"⚠️ Total warnings: {moderation_stats['warnings']}\n"
             f"🔨 Auto-bans: {moderation_stats['bans']}"
@@ -4034,21 +5744,10 @@ def register_bot_handlers():
         else:
             await message.reply("No active process to cancel.")
     
-    # ============ AUTO DELETE HELPER ============
-    
-    async def auto_delete_message(msg, delay_seconds=10):
-        """Delete a message after specified delay"""
-        try:
-            await asyncio.sleep(delay_seconds)
-            await msg.delete()
-        except Exception as e:
-            print(f"Failed to auto-delete message: {e}")
-    
     # ============ CONTENT MODERATION MESSAGE FILTER ============
     
-    @bot_client.on_message(GROUP_CHAT & ~filters.command(["setforcejoin", "removeforcejoin", "forcejoininfo", "enablemod", "disablemod", "blockforward", "blocklinks", "blockbadwords", "blockmention", "modstatus", "warnings", "resetwarnings"]))
-    async def moderation_filter_handler(client, message):
-        """Filter and delete inappropriate messages with warning system"""
+    async def moderation_filter_handler(client, message, config):
+        """Filter and delete inappropriate messages with warning system. Returns True if deleted"""
         global moderation_stats, user_warnings
         
         chat_id = message.chat.id
@@ -4056,71 +5755,26 @@ def register_bot_handlers():
         # If message is sent via sender_chat (anonymous admin / channel identity), skip moderation
         # Admins/owners can post as the group/channel; treating these as exempt avoids false warnings.
         if getattr(message, "sender_chat", None) is not None:
-            return
+            return False
 
         # If we can't identify a user, do not moderate
         if message.from_user is None:
-            return
+            return False
 
         user_id = message.from_user.id
         
-        # Load config if not in memory
-        if chat_id not in moderation_config:
-            moderation_config[chat_id] = load_moderation_config(chat_id)
-        
-        config = moderation_config.get(chat_id, {})
-        
-        # Skip if moderation is disabled
-        if not config.get("enabled"):
-            return
-        
         # Skip if user is a bot admin first
-        if user_id in ADMIN_IDS:
-            return
-        
-        # Skip if user is admin/owner (admins are exempt from moderation)
-        try:
-            member = await client.get_chat_member(chat_id, user_id)
-            
-            # Check if user is admin or owner using multiple methods
-            is_admin_or_owner = False
-            
-            # Method 1: Check class name (ChatMemberOwner, ChatMemberAdministrator)
-            cls_name = member.__class__.__name__ if member else ""
-            if "Owner" in cls_name or "Administrator" in cls_name or "Admin" in cls_name:
-                is_admin_or_owner = True
-            
-            # Method 2: Check if privileges exist (admins have this)
-            if not is_admin_or_owner and hasattr(member, "privileges") and member.privileges is not None:
-                is_admin_or_owner = True
-            
-            # Method 3: Check status attribute (covers various Pyrogram versions)
-            if not is_admin_or_owner and hasattr(member, "status"):
-                status = member.status
-                # Handle both enum and string status
-                status_str = str(status.value if hasattr(status, "value") else status).lower()
-                if any(x in status_str for x in ["creator", "owner", "admin", "administrator"]):
-                    is_admin_or_owner = True
-            
-            # Method 4: Direct ChatMember type check using pyrogram types
-            if not is_admin_or_owner:
-                try:
-                    from pyrogram.types import ChatMemberOwner, ChatMemberAdministrator
-                    if isinstance(member, (ChatMemberOwner, ChatMemberAdministrator)):
-                        is_admin_or_owner = True
-                except ImportError:
-                    pass
-            
-            if is_admin_or_owner:
-                return
-            
-            # Debug log for non-exempt users
-            print(f"[DEBUG] moderation: user_id={user_id} cls={cls_name} is_admin={is_admin_or_owner}", flush=True)
-            
-        except Exception as e:
+        if user_id in ADMIN_IDS:
+            return False
+        
+        # Skip if user is admin/owner (admins are exempt from moderation)
+        user_is_admin = await is_chat_admin(client, chat_id, user_id)
+        if user_is_admin:
+            return False
+        if user_is_admin is None:
             # If we can't verify role, skip moderation to avoid false warnings
-            print(f"[DEBUG] Cannot verify admin status for {user_id}: {e}", flush=True)
-            return
+            print(f"[DEBUG] Cannot verify admin status for {user_id}", flush=True)
+            return False
         
         async def add_warning_and_check_ban(reason):
             """Add warning to user and ban if exceeded limit"""
@@ -4128,13 +5782,8 @@ def register_bot_handlers():
             
             key = (chat_id, user_id)
             
-            # Load from DB if not in memory
-            if key not in user_warnings and warnings_col is not None:
-                saved = warnings_col.find_one({"chat_id": chat_id, "user_id": user_id})
-                user_warnings[key] = saved.get("count", 0) if saved else 0
-            
-            # Increment warning
-            user_warnings[key] = user_warnings.get(key, 0) + 1
+            # Increment warning (loaded from DB if not in memory)
+            user_warnings[key] = user_warnings[key] + 1
             current_warnings = user_warnings[key]
             moderation_stats["warnings"] += 1
             
@@ -4153,14 +5802,15 @@ def register_bot_handlers():
                 try:
                     await client.ban_chat_member(chat_id, user_id)
                     moderation_stats["bans"] += 1
-                    ban_msg = await client.send_message(
+                    # Auto-delete ban message after 10 seconds
+                    outbox_send(
                         chat_id,
                         f"🚫 **Auto-Ban:** {user_name}\n"
                         f"Reason: {MAX_WARNINGS} warnings exceeded\n"
-                        f"Last violation: {reason}"
+                        f"Last violation: {reason}",
+                        key=("ban", user_id),
+                        auto_delete=10
                     )
-                    # Auto-delete ban message after 10 seconds
-                    asyncio.create_task(auto_delete_message(ban_msg, 10))
                     # Reset warnings after ban
                     user_warnings[key] = 0
                     if warnings_col is not None:
@@ -4174,49 +5824,155 @@ def register_bot_handlers():
             else:
                 # Send warning message
                 remaining = MAX_WARNINGS - current_warnings
-                warn_msg = await client.send_message(
+                # A still-queued warning for the same user is replaced by this one; auto-deleted after 10 seconds
+                outbox_send(
                     chat_id,
                     f"⚠️ **Warning {current_warnings}/{MAX_WARNINGS}:** {user_name}\n"
                     f"Reason: {reason}\n"
-                    f"⛔ {remaining} more warning{'s' if remaining > 1 else ''} = Auto-Ban!"
+                    f"⛔ {remaining} more warning{'s' if remaining > 1 else ''} = Auto-Ban!",
+                    key=("warn", user_id),
+                    ttl=30,
+                    auto_delete=10
                 )
-                # Auto-delete warning message after 10 seconds
-                asyncio.create_task(auto_delete_message(warn_msg, 10))
         
+        shadow = config.get("shadow_mode")
+        
+        async def apply_rule(rule_id, started, hit, stat_key, reason, flag_id=None):
+            """Record a rule evaluation; on a hit remove the message, or only flag it (as flag_id) in shadow mode"""
+            # Timed before any await, so deletes/warnings/DB writes don't count as evaluation time
+            elapsed = time.perf_counter() - started
+            chat_stats["eval_time"] += elapsed
+            record_rule_eval(chat_id, rule_id, elapsed, hit)
+            if not hit:
+                return False
+            if shadow:
+                record_shadow_flag(chat_id, message.id, flag_id or rule_id)
+                return False
+            return await handle_violation(stat_key, reason)
+        
+        async def handle_violation(stat_key, reason):
+            """Remove a violating message; during a raid deletes/bans are batched and warnings skipped"""
+            raid_active, user_hits = record_raid_hit(client, chat_id, user_id)
+            if raid_active:
+                schedule_auto_delete(chat_id, message.id, 0, persist=False)
+                raid_state[chat_id]["deleted"] += 1
+                moderation_stats[stat_key] += 1
+                if user_hits >= RAID_USER_HITS:
+                    queue_raid_ban(chat_id, user_id)
+                return True
+            
+            await message.delete()
+            # Counted only once the message is actually gone
+            moderation_stats[stat_key] += 1
+            await add_warning_and_check_ban(reason)
+            return True
+        
+        chat_stats = get_chat_rule_stats(chat_id)
+        chat_stats["messages"] += 1
         try:
             # Check for forwarded messages
-            if config.get("block_forward") and message.forward_date:
-                await message.delete()
-                moderation_stats["deleted_forward"] += 1
-                await add_warning_and_check_ban("Forwarded message")
-                return
+            if config.get("block_forward"):
+                started = time.perf_counter()
+                if await apply_rule("forward", started, bool(message.forward_date), "deleted_forward", "Forwarded message"):
+                    return True
             
-            # Get message text
+            # Get message text and scan links/mentions once (entities first)
             text = message.text or message.caption or ""
-            
-            # Check for links
-            if config.get("block_links") and text and contains_link(text):
-                await message.delete()
-                moderation_stats["deleted_links"] += 1
-                await add_warning_and_check_ban("Link/URL not allowed")
-                return
+            entities = message.entities or message.caption_entities
+            started = time.perf_counter()
+            has_link, has_mention = False, False
+            if text and (config.get("block_links") or config.get("block_mentions")):
+                has_link, has_mention = scan_links_and_mentions(text, entities)
+            
+            # Custom rules for this chat (compiled once, cached)
+            rule_matcher = get_chat_rule_matcher(chat_id, config)
+            normalized = normalize_moderation_text(text) if text and (
+                config.get("block_badwords") or (rule_matcher and rule_matcher["words"] is not None)
+            ) else ""
+            # Shared scanning counts towards the chat's evaluation time only
+            chat_stats["eval_time"] += time.perf_counter() - started
+            
+            # Check for links (domains on the chat's allow list are fine)
+            if config.get("block_links"):
+                started = time.perf_counter()
+                blocked = has_link
+                if has_link and rule_matcher and rule_matcher["allowed_domains"]:
+                    allowed = rule_matcher["allowed_domains"]
+                    blocked = not all(is_domain_allowed(d, allowed) for d in extract_link_domains(text, entities))
+                if await apply_rule("links", started, blocked, "deleted_links", "Link/URL not allowed"):
+                    return True
             
             # Check for bad words
-            if config.get("block_badwords") and text and contains_bad_words(text):
-                await message.delete()
-                moderation_stats["deleted_badwords"] += 1
-                await add_warning_and_check_ban("Inappropriate/sexual content")
-                return
+            if config.get("block_badwords"):
+                started = time.perf_counter()
+                hit = bool(text) and bool(find_words(BAD_WORDS_AUTOMATON, normalized, first_only=True))
+                if await apply_rule("badwords", started, hit, "deleted_badwords", "Inappropriate/sexual content"):
+                    return True
             
             # Check for @mentions
-            if config.get("block_mentions") and text and contains_mention(text):
-                await message.delete()
-                moderation_stats["deleted_mentions"] += 1
-                await add_warning_and_check_ban("@mentions not allowed")
-                return
+            if config.get("block_mentions"):
+                if await apply_rule("mentions", time.perf_counter(), has_mention, "deleted_mentions", "@mentions not allowed"):
+                    return True
+            
+            # Check custom rules (one matcher; hits are also counted per individual rule, which is
+            # the one flagged in shadow mode)
+            if rule_matcher:
+                started = time.perf_counter()
+                hit = match_chat_rules(rule_matcher, message, text, normalized)
+                if hit:
+                    record_rule_hit(chat_id, hit[0])
+                if await apply_rule(
+                    "custom", started, hit is not None, "deleted_rules", hit[1] if hit else "", flag_id=hit and hit[0]
+                ):
+                    return True
+            
+            # Check for copy-paste spam (same text/media from another user recently)
+            if config.get("block_duplicates"):
+                started = time.perf_counter()
+                hit = is_duplicate_spam(chat_id, user_id, text, get_media_unique_id(message))
+                if await apply_rule("duplicates", started, hit, "deleted_duplicates", "Copy-paste spam"):
+                    return True
                 
         except Exception as e:
             print(f"Moderation error: {e}")
+        return False
+    
+    # ============ GROUP MESSAGE PIPELINE ============
+    
+    def resolve_group_stages(chat_id):
+        """Build the list of enabled stages for a chat from its moderation + force join config"""
+        if chat_id not in moderation_config:
+            moderation_config[chat_id] = load_moderation_config(chat_id)
+        if chat_id not in group_forcejoin_config:
+            group_forcejoin_config[chat_id] = load_group_forcejoin(chat_id)
+        mod_config = moderation_config[chat_id]
+        fj_config = group_forcejoin_config[chat_id]
+        
+        stages = []
+        if mod_config.get("enabled") and (any(
+            mod_config.get(key) for key in ("block_forward", "block_links", "block_badwords", "block_mentions", "block_duplicates")
+        ) or has_custom_rules(mod_config.get("rules"))):
+            stages.append((moderation_filter_handler, mod_config))
+        if fj_config.get("enabled") and fj_config.get("channel_id"):
+            stages.append((forcejoin_filter_handler, fj_config))
+        if mod_config.get("auto_delete_2min"):
+            stages.append((auto_delete_message_handler, mod_config))
+        
+        group_pipeline_stages[chat_id] = tuple(stages)
+        return group_pipeline_stages[chat_id]
+    
+    async def run_group_pipeline(client, message):
+        """Run moderation -> force join -> auto-delete for one group message, stopping once it is deleted"""
+        stages = group_pipeline_stages.get(message.chat.id)
+        if stages is None:
+            stages = resolve_group_stages(message.chat.id)
+        
+        for stage, config in stages:
+            try:
+                if await stage(client, message, config):
+                    return
+            except Exception as e:
+                print(f"⚠️ Group pipeline stage {stage.__name__} failed: {e}")
     
     @bot_client.on_message(filters.command("warnings") & GROUP_CHAT)
     async def check_warnings_handler(client, message):
@@ -4231,12 +5987,8 @@ def register_bot_handlers():
         
         key = (chat_id, target_user.id)
         
-        # Load from DB
-        if key not in user_warnings and warnings_col is not None:
-            saved = warnings_col.find_one({"chat_id": chat_id, "user_id": target_user.id})
-            user_warnings[key] = saved.get("count", 0) if saved else 0
-        
-        count = user_warnings.get(key, 0)
+        # Loaded from DB if not in memory
+        count = user_warnings[key]
         await message.reply(
             f"⚠️ **Warnings for {target_user.first_name}:** {count}/{MAX_WARNINGS}\n"
             f"{'🔴 Next violation = BAN!' if count == MAX_WARNINGS - 1 else ''}"
@@ -4291,18 +6043,20 @@ def register_bot_handlers():
                 return
             
             channel = parts[1]
-            auto_approve_channels.add(channel)
             
-            # Save to database
-            if autoapprove_col is not None:
-                autoapprove_col.update_one(
-                    {"channel": channel},
-                    {"$set": {"channel": channel, "enabled": True, "updated_at": datetime.utcnow()}},
-                    upsert=True
+            # Resolve to the numeric chat ID once; join requests are matched on it
+            try:
+                chat_id, title, username = await resolve_chat_id(client, channel)
+            except Exception as e:
+                await message.reply(
+                    f"❌ Cannot find {channel}: {e}\n\n"
+                    "Add the bot to the channel/group as admin first, or use the -100... ID."
                 )
+                return
+            enable_auto_approve(chat_id, channel, title, username)
             
             await message.reply(
-                f"✅ Auto-approve enabled for: {channel}\n\n"
+                f"✅ Auto-approve enabled for: {title or channel} (`{chat_id}`)\n\n"
                 f"📢 Works for both Channels & Groups!\n"
                 f"All join requests will be automatically approved!\n"
                 f"Use /stopapprove {channel} to disable."
@@ -4320,12 +6074,19 @@ def register_bot_handlers():
                 return
             
             channel = parts[1]
-            auto_approve_channels.discard(channel)
+            chat_id = find_auto_approve_chat(channel)
+            if chat_id is None and channel not in auto_approve_unresolved:
+                await message.reply(f"❌ {channel} is not in the auto-approve list. See /approvelist")
+                return
+            
+            auto_approve_channels.discard(chat_id)
+            auto_approve_index.pop(chat_id, None)
+            auto_approve_unresolved.discard(channel)
             
             # Update database
             if autoapprove_col is not None:
-                autoapprove_col.update_one(
-                    {"channel": channel},
+                autoapprove_col.update_many(
+                    {"$or": [{"chat_id": chat_id}, {"channel": channel}]} if chat_id is not None else {"channel": channel},
                     {"$set": {"enabled": False, "updated_at": datetime.utcnow()}}
                 )
             
@@ -4340,7 +6101,9 @@ def register_bot_handlers():
             await message.reply("📥 No auto-approve channels/groups configured.\n\nUse /autoapprove <channel/group> to enable.")
             return
         
-        channels_list = "\n".join([f"• {ch}" for ch in auto_approve_channels])
+        channels_list = "\n".join([
+            f"• {entry['title'] or entry['channel']} (`{chat_id}`)" for chat_id, entry in auto_approve_index.items()
+        ])
         await message.reply(
             f"📥 **Auto-Approve Channels/Groups ({len(auto_approve_channels)})**\n\n"
             f"{channels_list}\n\n"
@@ -4352,7 +6115,6 @@ def register_bot_handlers():
     async def debugjoin_handler(client, message):
         """Debug join-request approval access for a channel/group"""
         import re
-        import aiohttp
 
         try:
             text = (message.text or "").strip()
@@ -4372,77 +6134,66 @@ def register_bot_handlers():
                 await message.reply("❌ BOT_TOKEN / TELEGRAM_BOT_TOKEN missing in environment.")
                 return
 
-            base_url = f"https://api.telegram.org/bot{BOT_TOKEN}"
-
-            async with aiohttp.ClientSession() as session:
-                async def _get(path: str, params: dict | None = None):
-                    async with session.get(f"{base_url}/{path}", params=params) as resp:
-                        try:
-                            data = await resp.json()
-                        except Exception:
-                            data = {"ok": False, "error_code": resp.status, "description": "Non-JSON response"}
-                        return resp.status, data
-
-                status_code, me = await _get("getMe")
-                if not me.get("ok"):
-                    await message.reply(f"❌ getMe failed ({status_code}): {me.get('description')}")
-                    return
+            status_code, me = await bot_api_call("getMe")
+            if not me.get("ok"):
+                await message.reply(f"❌ getMe failed ({status_code}): {me.get('description')}")
+                return
 
-                bot_id = (me.get("result") or {}).get("id")
+            bot_id = (me.get("result") or {}).get("id")
 
-                # Resolve chat_id
-                chat_id = None
-                if isinstance(arg, str) and arg.lstrip("-").isdigit():
-                    # Many users paste channel id without the leading "-".
-                    # Supergroup/channel ids are negative in Bot API (usually start with -100...).
-                    if not arg.startswith("-") and len(arg) >= 10:
-                        chat_id = -int(arg)
-                    else:
-                        chat_id = int(arg)
-
-                    # getChat needs bot to already be in the chat
-                    _, chat = await _get("getChat", {"chat_id": chat_id})
-                    if not chat.get("ok"):
-                        await message.reply(
-                            "❌ getChat failed: "
-                            f"{chat.get('description')} (code: {chat.get('error_code')})\n\n"
-                            "Ye usually tab hota hai jab bot chat me add nahi hai / access nahi hai."
-                        )
-                        return
-                    chat_id = (chat.get("result") or {}).get("id")
+            # Resolve chat_id
+            chat_id = None
+            if isinstance(arg, str) and arg.lstrip("-").isdigit():
+                # Many users paste channel id without the leading "-".
+                # Supergroup/channel ids are negative in Bot API (usually start with -100...).
+                if not arg.startswith("-") and len(arg) >= 10:
+                    chat_id = -int(arg)
                 else:
-                    # Resolve username / invite link style
-                    _, chat = await _get("getChat", {"chat_id": arg})
-                    if not chat.get("ok"):
-                        await message.reply(
-                            "❌ getChat failed: "
-                            f"{chat.get('description')} (code: {chat.get('error_code')})\n\n"
-                            "Ye usually tab hota hai jab bot chat me add nahi hai / access nahi hai."
-                        )
-                        return
-                    chat_id = (chat.get("result") or {}).get("id")
+                    chat_id = int(arg)
 
+                # getChat needs bot to already be in the chat
+                _, chat = await bot_api_call("getChat", {"chat_id": chat_id})
+                if not chat.get("ok"):
+                    await message.reply(
+                        "❌ getChat failed: "
+                        f"{chat.get('description')} (code: {chat.get('error_code')})\n\n"
+                        "Ye usually tab hota hai jab bot chat me add nahi hai / access nahi hai."
+                    )
+                    return
+                chat_id = (chat.get("result") or {}).get("id")
+            else:
+                # Resolve username / invite link style
+                _, chat = await bot_api_call("getChat", {"chat_id": arg})
+                if not chat.get("ok"):
+                    await message.reply(
+                        "❌ getChat failed: "
+                        f"{chat.get('description')} (code: {chat.get('error_code')})\n\n"
+                        "Ye usually tab hota hai jab bot chat me add nahi hai / access nahi hai."
+                    )
+                    return
+                chat_id = (chat.get("result") or {}).get("id")
 
-                # Check bot membership/rights in that chat
-                _, member = await _get("getChatMember", {"chat_id": chat_id, "user_id": bot_id})
 
-                # Check join request visibility
-                _, jr = await _get("getChatJoinRequests", {"chat_id": chat_id, "limit": 1})
+            # Check bot membership/rights in that chat
+            _, member = await bot_api_call("getChatMember", {"chat_id": chat_id, "user_id": bot_id})
 
-                def fmt(x):
-                    if not x or not isinstance(x, dict):
-                        return "(no response)"
-                    if x.get("ok"):
-                        return "ok"
-                    return f"{x.get('description')} (code: {x.get('error_code')})"
+            # Check join request visibility
+            _, jr = await bot_api_call("getChatJoinRequests", {"chat_id": chat_id, "limit": 1})
 
-                await message.reply(
-                    "🧪 **Join Request Debug**\n\n"
-                    f"Chat: `{arg}` → `{chat_id}`\n"
-                    f"Bot member: {fmt(member)}\n"
-                    f"JoinRequests: {fmt(jr)}\n\n"
-                    "Agar JoinRequests me error aa raha hai to usi error se exact reason pata chalega."
-                )
+            def fmt(x):
+                if not x or not isinstance(x, dict):
+                    return "(no response)"
+                if x.get("ok"):
+                    return "ok"
+                return f"{x.get('description')} (code: {x.get('error_code')})"
+
+            await message.reply(
+                "🧪 **Join Request Debug**\n\n"
+                f"Chat: `{arg}` → `{chat_id}`\n"
+                f"Bot member: {fmt(member)}\n"
+                f"JoinRequests: {fmt(jr)}\n\n"
+                "Agar JoinRequests me error aa raha hai to usi error se exact reason pata chalega."
+            )
 
         except Exception as e:
             await message.reply(f"❌ debug error: {e}")
@@ -4573,49 +6324,30 @@ def register_bot_handlers():
                 # BATCH SIZE for parallel processing
                 BATCH_SIZE = 20
                 
-                # METHOD 1: Try USERBOT client (SESSION_STRING) - only user accounts can list join requests
+                # METHOD 1: USERBOT clients (SESSION_STRING) - only user accounts can list join requests.
+                # Requests are approved while still being listed, spread over every user account.
                 userbot_worked = False
                 if user_clients:
-                    userbot_name, userbot = user_clients[0]  # Use first userbot
                     try:
-                        await status_msg.edit(f"🔄 Method 1: Userbot ({userbot_name})...\n{channel}\n⚡ Batch mode: {BATCH_SIZE} at once")
+                        await status_msg.edit(f"🔄 Method 1: Userbot x{len(user_clients)}...\n{channel}\n⚡ Approving while listing")
                         
-                        # Collect all pending requests first
-                        pending_users = []
-                        async for join_request in userbot.get_chat_join_requests(chat_id):
-                            pending_users.append(join_request.user.id)
-
-                        found_userbot = len(pending_users)
-                        if pending_users:
-                            await status_msg.edit(f"🔄 Found {len(pending_users)} pending requests\n⚡ Processing in batches of {BATCH_SIZE}...")
-                            
-                            # Process in batches
-                            async def approve_user(uid):
-                                try:
-                                    await userbot.approve_chat_join_request(chat_id, uid)
-                                    return ("success", uid)
-                                except Exception as e:
-                                    return ("failed", uid, str(e))
-                            
-                            for i in range(0, len(pending_users), BATCH_SIZE):
-                                batch = pending_users[i:i + BATCH_SIZE]
-                                results = await asyncio.gather(*[approve_user(uid) for uid in batch], return_exceptions=True)
-                                
-                                for r in results:
-                                    if isinstance(r, tuple) and r[0] == "success":
-                                        approved += 1
-                                        auto_approve_stats["approved"] += 1
-                                    else:
-                                        failed += 1
-                                        auto_approve_stats["failed"] += 1
-                                
-                                try:
-                                    await status_msg.edit(f"🔄 Approving (Userbot)...\n✅ {approved} | ❌ {failed}\n📊 {approved + failed}/{len(pending_users)}")
-                                except:
-                                    pass
-                                await asyncio.sleep(0.5)  # Small delay between batches to avoid rate limits
+                        async def report_progress(progress):
+                            try:
+                                await status_msg.edit(
+                                    f"🔄 Approving (Userbot x{len(user_clients)})...\n"
+                                    f"✅ {progress['approved']} | ❌ {progress['failed']}\n"
+                                    f"📊 {progress['approved'] + progress['failed']}/{progress['listed']} listed"
+                                )
+                            except Exception:
+                                pass
                         
-                        userbot_worked = True
+                        streamed = await stream_approve_join_requests(chat_id, report_progress)
+                        if streamed is not None:
+                            found_userbot = streamed["listed"]
+                            approved += streamed["approved"]
+                            failed += streamed["failed"]
+                            userbot_worked = True
+                            print(f"✅ /approveall {chat_id}: {streamed['approved']} approved by {streamed['accounts']}")
                     except Exception as e:
                         print(f"Userbot get_chat_join_requests failed: {e}")
                 else:
@@ -4623,82 +6355,71 @@ def register_bot_handlers():
 
                 # METHOD 2: If Pyrogram didn't work or found nothing, try raw Bot API
                 if not userbot_worked or (approved == 0 and failed == 0):
-                    import aiohttp
-                    bot_token = BOT_TOKEN
-                    if bot_token:
-                        base_url = f"https://api.telegram.org/bot{bot_token}"
+                    if BOT_TOKEN:
                         try:
                             await status_msg.edit(f"🔄 Method 2: Bot API...\n{channel}\n⚡ Batch mode: {BATCH_SIZE} at once")
-                            async with aiohttp.ClientSession() as session:
-                                # First collect all pending user IDs
-                                all_pending_users = []
-                                offset_date = None
-                                offset_user_id = None
-                                api_worked = False
-
-                                while True:
-                                    params = {"chat_id": chat_id, "limit": 100}
-                                    if offset_date:
-                                        params["offset_date"] = offset_date
-                                    if offset_user_id:
-                                        params["offset_user_id"] = offset_user_id
-
-                                    async with session.get(f"{base_url}/getChatJoinRequests", params=params) as resp:
-                                        data = await resp.json()
-                                        if not data.get("ok"):
-                                            break  # API not available, try fallback
-                                        
-                                        api_worked = True
-                                        requests = data.get("result") or []
-                                        if not requests:
-                                            break
-
-                                        for req in requests:
-                                            uid = req.get("user", {}).get("id")
-                                            if uid:
-                                                all_pending_users.append(uid)
-
-                                        if len(requests) < 100:
-                                            break
-                                        last_req = requests[-1]
-                                        offset_date = last_req.get("date")
-                                        offset_user_id = (last_req.get("user") or {}).get("id")
-
-                                found_api = len(all_pending_users) if api_worked else None
-
-                                if api_worked and all_pending_users:
-                                    await status_msg.edit(f"🔄 Found {len(all_pending_users)} pending requests\n⚡ Processing in batches of {BATCH_SIZE}...")
+                            # First collect all pending user IDs
+                            all_pending_users = []
+                            offset_date = None
+                            offset_user_id = None
+                            api_worked = False
+
+                            while True:
+                                params = {"chat_id": chat_id, "limit": 100}
+                                if offset_date:
+                                    params["offset_date"] = offset_date
+                                if offset_user_id:
+                                    params["offset_user_id"] = offset_user_id
+
+                                _, data = await bot_api_call("getChatJoinRequests", params)
+                                if not data.get("ok"):
+                                    break  # API not available, try fallback
+                                
+                                api_worked = True
+                                requests = data.get("result") or []
+                                if not requests:
+                                    break
+
+                                for req in requests:
+                                    uid = req.get("user", {}).get("id")
+                                    if uid:
+                                        all_pending_users.append(uid)
+
+                                if len(requests) < 100:
+                                    break
+                                last_req = requests[-1]
+                                offset_date = last_req.get("date")
+                                offset_user_id = (last_req.get("user") or {}).get("id")
+
+                            found_api = len(all_pending_users) if api_worked else None
+
+                            if api_worked and all_pending_users:
+                                await status_msg.edit(f"🔄 Found {len(all_pending_users)} pending requests\n⚡ Processing in batches of {BATCH_SIZE}...")
+                                
+                                # Process in batches
+                                async def approve_user_api(uid):
+                                    # 429 retry_after is waited out inside bot_api_call
+                                    _, ad = await bot_api_call("approveChatJoinRequest", {"chat_id": chat_id, "user_id": uid}, post=True)
+                                    return ("success", uid) if ad.get("ok") else ("failed", uid)
+                                
+                                for i in range(0, len(all_pending_users), BATCH_SIZE):
+                                    batch = all_pending_users[i:i + BATCH_SIZE]
+                                    results = await asyncio.gather(*[approve_user_api(uid) for uid in batch], return_exceptions=True)
                                     
-                                    # Process in batches
-                                    async def approve_user_api(uid):
-                                        try:
-                                            async with session.post(f"{base_url}/approveChatJoinRequest", data={"chat_id": chat_id, "user_id": uid}) as ar:
-                                                ad = await ar.json()
-                                                if ad.get("ok"):
-                                                    return ("success", uid)
-                                                return ("failed", uid)
-                                        except:
-                                            return ("failed", uid)
+                                    for r in results:
+                                        if isinstance(r, tuple) and r[0] == "success":
+                                            approved += 1
+                                            auto_approve_stats["approved"] += 1
+                                        else:
+                                            failed += 1
                                     
-                                    for i in range(0, len(all_pending_users), BATCH_SIZE):
-                                        batch = all_pending_users[i:i + BATCH_SIZE]
-                                        results = await asyncio.gather(*[approve_user_api(uid) for uid in batch], return_exceptions=True)
-                                        
-                                        for r in results:
-                                            if isinstance(r, tuple) and r[0] == "success":
-                                                approved += 1
-                                                auto_approve_stats["approved"] += 1
-                                            else:
-                                                failed += 1
-                                        
-                                        try:
-                                            await status_msg.edit(f"🔄 Approving (API)...\n✅ {approved} | ❌ {failed}\n📊 {approved + failed}/{len(all_pending_users)}")
-                                        except:
-                                            pass
-                                        await asyncio.sleep(0.5)  # Small delay between batches
-
-                                if not api_worked:
-                                    raise Exception("Bot API getChatJoinRequests not available")
+                                    try:
+                                        await status_msg.edit(f"🔄 Approving (API)...\n✅ {approved} | ❌ {failed}\n📊 {approved + failed}/{len(all_pending_users)}")
+                                    except:
+                                        pass
+
+                            if not api_worked:
+                                raise Exception("Bot API getChatJoinRequests not available")
                         except Exception as e:
                             print(f"Bot API method failed: {e}")
 
@@ -4706,10 +6427,10 @@ def register_bot_handlers():
                 if approved == 0 and failed == 0 and pending_join_requests_col is not None:
                     try:
                         await status_msg.edit(f"🔄 Method 3: DB fallback...\n{channel}\n⚡ Batch mode: {BATCH_SIZE} at once")
-                        pending = list(pending_join_requests_col.find({"chat_id": str(chat_id), "approved": False}).limit(500))
-                        found_db = len(pending)
-                        if pending:
-                            await status_msg.edit(f"🔄 Found {len(pending)} pending requests in DB\n⚡ Processing in batches of {BATCH_SIZE}...")
+                        pending_query = {"chat_id": str(chat_id), "approved": False}
+                        found_db = pending_join_requests_col.count_documents(pending_query)
+                        if found_db:
+                            await status_msg.edit(f"🔄 Found {found_db} pending requests in DB\n⚡ Processing in batches of {BATCH_SIZE}...")
                             
                             async def approve_user_db(doc):
                                 uid = doc.get("user_id")
@@ -4729,8 +6450,12 @@ def register_bot_handlers():
                                     )
                                     return ("failed", uid)
                             
-                            for i in range(0, len(pending), BATCH_SIZE):
-                                batch = pending[i:i + BATCH_SIZE]
+                            # Stream the cursor in batches (no cap, nothing held beyond one batch)
+                            cursor = pending_join_requests_col.find(pending_query, {"user_id": 1})
+                            while True:
+                                batch = list(itertools.islice(cursor, BATCH_SIZE))
+                                if not batch:
+                                    break
                                 results = await asyncio.gather(*[approve_user_db(doc) for doc in batch], return_exceptions=True)
                                 
                                 for r in results:
@@ -4743,7 +6468,7 @@ def register_bot_handlers():
                                             auto_approve_stats["failed"] += 1
                                 
                                 try:
-                                    await status_msg.edit(f"🔄 Approving (DB)...\n✅ {approved} | ❌ {failed}\n📊 {approved + failed}/{len(pending)}")
+                                    await status_msg.edit(f"🔄 Approving (DB)...\n✅ {approved} | ❌ {failed}\n📊 {approved + failed}/{found_db}")
                                 except:
                                     pass
                                 await asyncio.sleep(0.5)
@@ -4796,205 +6521,1046 @@ def register_bot_handlers():
                     "4) Phir /approveall -100... dobara chalao"
                 )
                 return
-            await message.reply(f"❌ Error: {e}")
+            await message.reply(f"❌ Error: {e}")
+    
+    # ============ CHAT JOIN REQUEST HANDLER (Auto-approve) ============
+    
+    @bot_client.on_chat_join_request()
+    async def join_request_handler(client, chat_join_request):
+        """Automatically approve join requests for enabled channels"""
+        # Check if auto-approve is enabled for this channel (IDs resolved by /autoapprove)
+        if chat_join_request.chat.id not in auto_approve_channels:
+            return
+        
+        # Approved by auto_approve_worker (all accounts, bulk approve-all for large backlogs)
+        queue_auto_approve(chat_join_request)
+
+    @bot_client.on_message(filters.command("rawtest"))
+    async def rawtest_handler(client, message):
+        """Raw API test for debugging - shows exact responses"""
+        try:
+            parts = (message.text or "").split()
+            if len(parts) < 2:
+                await message.reply("Usage: /rawtest <chat_id>\nExample: /rawtest -1002926855756")
+                return
+
+            chat_id = parts[1]
+            if not BOT_TOKEN:
+                await message.reply("❌ BOT_TOKEN missing!")
+                return
+
+            results = []
+
+            # 1. getMe
+            me_status, me_data = await bot_api_call("getMe")
+            results.append(f"**1. getMe** (status={me_status}):\n```{str(me_data)[:300]}```")
+
+            bot_id = (me_data.get("result") or {}).get("id")
+
+            # 2. getChat
+            gc_status, gc_data = await bot_api_call("getChat", {"chat_id": chat_id})
+            results.append(f"**2. getChat** (status={gc_status}):\n```{str(gc_data)[:400]}```")
+
+            # 3. getChatMember (bot)
+            if bot_id:
+                gm_status, gm_data = await bot_api_call("getChatMember", {"chat_id": chat_id, "user_id": bot_id})
+                results.append(f"**3. getChatMember(bot)** (status={gm_status}):\n```{str(gm_data)[:400]}```")
+
+            # 4. getChatJoinRequests
+            jr_status, jr_data = await bot_api_call("getChatJoinRequests", {"chat_id": chat_id, "limit": 5})
+            results.append(f"**4. getChatJoinRequests** (status={jr_status}):\n```{str(jr_data)[:400]}```")
+
+            await message.reply("🔬 Raw API Test Results\n\n" + "\n\n".join(results))
+
+        except Exception as e:
+            await message.reply(f"❌ rawtest error: {e}")
+
+    @bot_client.on_message(filters.command("version"))
+    async def version_handler(client, message):
+        """Print running build/version to confirm deployment"""
+        from datetime import datetime
+        try:
+            await message.reply(
+                "✅ Running build is updated.\n"
+                f"Build time: {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')} UTC\n"
+                "Commands: /version /rawtest /debugjoin"
+            )
+        except Exception as e:
+            await message.reply(f"❌ version error: {e}")
+
+
+# Flask routes for health checks
+@flask_app.route("/")
+def home():
+    num_accounts = len(user_clients)
+    return jsonify({
+        "status": "ok",
+        "message": "Telegram Forwarder Bot (Multi-Account MTProto)",
+        "accounts": num_accounts,
+        "expected_speed": f"{num_accounts * 30}/min"
+    })
+
+
+@flask_app.route("/webhook", methods=["GET", "POST"])
+@flask_app.route("/webhook/", methods=["GET", "POST"])
+def webhook():
+    """Handle Telegram webhook requests (we use polling, so just acknowledge)."""
+    try:
+        # Helpful for Koyeb logs: shows if Telegram (or anything) is still hitting webhook
+        print(f"🌐 /webhook hit: method={request.method} content_type={request.content_type}")
+    except Exception:
+        pass
+
+    # We use Pyrogram polling, not webhook mode.
+    # This route exists to prevent 404 errors if webhook is accidentally set.
+    return jsonify({"ok": True, "message": "Bot uses polling mode, not webhook"})
+
+
+@flask_app.route("/health")
+def health():
+    return jsonify({
+        "status": "healthy",
+        "user_clients": len(user_clients),
+        "bot_client": bot_client is not None,
+        "is_forwarding": is_forwarding
+    })
+
+
+@flask_app.route("/state")
+def get_state():
+    return jsonify(state_store_metrics())
+
+
+@flask_app.route("/progress")
+def get_progress():
+    load_progress()
+    return jsonify(current_progress)
+
+
+@flask_app.route("/accounts")
+def get_accounts():
+    return jsonify({
+        "count": len(user_clients),
+        "accounts": [name for name, _ in user_clients],
+        "expected_speed": f"{len(user_clients) * 30}/min"
+    })
+
+
+def run_flask():
+    """Run Flask in a separate thread"""
+    port = int(os.getenv("PORT", 8000))
+    flask_app.run(host="0.0.0.0", port=port, debug=False)
+
+
+# ============ AUTO-DELETE SCHEDULER ============
+
+def schedule_auto_delete(chat_id, message_id, delay_seconds, counted=False, persist=True):
+    """Schedule a message for deletion; picked up by auto_delete_worker.
+    
+    persist=False skips saving to DB (for near-immediate bulk deletes, e.g. during a raid).
+    """
+    entry = (time.time() + delay_seconds, chat_id, message_id, counted)
+    heapq.heappush(auto_delete_queue, entry)
+    if persist:
+        auto_delete_pending_writes.append(entry)
+
+
+def flush_auto_delete_writes():
+    """Persist newly scheduled deletions in one insert"""
+    if not auto_delete_pending_writes:
+        return
+    entries = auto_delete_pending_writes[:]
+    auto_delete_pending_writes.clear()
+    if auto_delete_col is None:
+        return
+    try:
+        auto_delete_col.insert_many([
+            {"due_at": due_at, "chat_id": chat_id, "message_id": message_id, "counted": counted}
+            for due_at, chat_id, message_id, counted in entries
+        ], ordered=False)
+    except Exception as e:
+        print(f"⚠️ Could not save auto-delete queue: {e}")
+
+
+def ensure_auto_delete_indexes():
+    """Index for removing deleted messages from the saved queue (one delete_many per batch)"""
+    if auto_delete_col is None:
+        return
+    try:
+        auto_delete_col.create_index([("chat_id", 1), ("message_id", 1)])
+    except Exception as e:
+        print(f"⚠️ Auto-delete index creation failed: {e}")
+
+
+def load_auto_delete_queue():
+    """Restore scheduled deletions saved before a restart"""
+    if auto_delete_col is None:
+        return
+    try:
+        restored = [
+            (doc["due_at"], doc["chat_id"], doc["message_id"], doc.get("counted", False))
+            for doc in auto_delete_col.find({})
+        ]
+        auto_delete_queue.extend(restored)
+        heapq.heapify(auto_delete_queue)
+        if restored:
+            print(f"🗑️ Restored {len(restored)} scheduled auto-deletes")
+    except Exception as e:
+        print(f"⚠️ Could not load auto-delete queue: {e}")
+
+
+async def delete_due_messages(chat_id, entries):
+    """Delete one chat's due messages, up to AUTO_DELETE_BATCH IDs per call"""
+    for i in range(0, len(entries), AUTO_DELETE_BATCH):
+        chunk = entries[i:i + AUTO_DELETE_BATCH]
+        message_ids = [message_id for _, message_id, _ in chunk]
+        try:
+            await bot_client.delete_messages(chat_id, message_ids)
+            moderation_stats["auto_deleted"] += sum(1 for _, _, counted in chunk if counted)
+        except FloodWait as e:
+            # Put the rest back and retry once the wait is over
+            retry_at = time.time() + e.value
+            for _, message_id, counted in entries[i:]:
+                heapq.heappush(auto_delete_queue, (retry_at, chat_id, message_id, counted))
+            print(f"⏳ Auto-delete FloodWait {e.value}s in {chat_id}")
+            return
+        except Exception as e:
+            print(f"Failed to auto-delete {len(message_ids)} message(s) in {chat_id}: {e}")
+        
+        if auto_delete_col is not None:
+            try:
+                auto_delete_col.delete_many({"chat_id": chat_id, "message_id": {"$in": message_ids}})
+            except Exception:
+                pass
+
+
+async def auto_delete_worker():
+    """Single scheduler for all timed deletions, grouped per chat into bulk deletes"""
+    while True:
+        try:
+            flush_auto_delete_writes()
+            
+            now = time.time()
+            due = {}  # {chat_id: [(due_at, message_id, counted), ...]}
+            while auto_delete_queue and auto_delete_queue[0][0] <= now:
+                due_at, chat_id, message_id, counted = heapq.heappop(auto_delete_queue)
+                due.setdefault(chat_id, []).append((due_at, message_id, counted))
+            
+            if due and bot_client is not None:
+                await asyncio.gather(*[delete_due_messages(chat_id, entries) for chat_id, entries in due.items()])
+        except Exception as e:
+            print(f"⚠️ auto_delete_worker error: {e}")
+        
+        # Wake for the next due entry, but at least once a second to persist new ones
+        next_due = auto_delete_queue[0][0] - time.time() if auto_delete_queue else 1
+        await asyncio.sleep(min(max(next_due, 0.05), 1))
+
+
+# ============ RAID DETECTION ============
+# Sliding windows of moderation hits per chat and per user. When a chat gets RAID_CHAT_HITS
+# violations within RAID_WINDOW seconds it switches to raid mode: spam is bulk-deleted through
+# the auto-delete scheduler, repeat offenders are banned in batches, per-message warnings are
+# suppressed and slow mode is enabled until RAID_COOLDOWN seconds pass without a new hit.
+RAID_WINDOW = int(os.getenv("RAID_WINDOW", "30"))
+RAID_CHAT_HITS = int(os.getenv("RAID_CHAT_HITS", "10"))
+RAID_USER_HITS = int(os.getenv("RAID_USER_HITS", "2"))  # Violations by one user during a raid before ban
+RAID_COOLDOWN = int(os.getenv("RAID_COOLDOWN", "60"))
+RAID_SLOW_MODE = int(os.getenv("RAID_SLOW_MODE", "30"))  # Telegram accepts 10, 30, 60, 300, 900, 3600
+RAID_BAN_CONCURRENCY = 5
+RAID_FINAL_FLUSH_ATTEMPTS = 3  # Ban rounds after a raid for users re-queued by a FloodWait
+# A chat without hits for RAID_WINDOW seconds has empty windows; chats in raid mode are kept
+raid_state = StateStore(
+    "raid_state", STATE_MAX_CHATS, RAID_WINDOW, keep=lambda state: state["active"]
+)  # {chat_id: {"hits": deque, "users": {user_id: deque}, "active": bool, "active_until": ts, "bans": set, "deleted": n, "banned": n, "task": raid_watch task or None}}
+
+
+def _prune_window(window, now):
+    """Drop timestamps older than RAID_WINDOW from a deque"""
+    while window and window[0] <= now - RAID_WINDOW:
+        window.popleft()
+
+
+def record_raid_hit(client, chat_id, user_id):
+    """Count a moderation hit. Returns (raid_active, user_hits_in_window)"""
+    now = time.time()
+    state = raid_state.setdefault(chat_id, {
+        "hits": deque(), "users": {}, "active": False, "active_until": 0, "bans": set(), "deleted": 0, "banned": 0, "task": None
+    })
+    state["hits"].append(now)
+    _prune_window(state["hits"], now)
+    user_hits = state["users"].setdefault(user_id, deque())
+    user_hits.append(now)
+    _prune_window(user_hits, now)
+    
+    if state["active"]:
+        state["active_until"] = now + RAID_COOLDOWN
+    elif len(state["hits"]) >= RAID_CHAT_HITS:
+        state["active"] = True
+        state["active_until"] = now + RAID_COOLDOWN
+        state["deleted"] = state["banned"] = 0
+        # Held in the state so the task can't be garbage-collected (and is cancelled on shutdown)
+        state["task"] = asyncio.create_task(raid_watch(client, chat_id))
+    return state["active"], len(user_hits)
+
+
+def queue_raid_ban(chat_id, user_id):
+    """Queue a user for the next batched ban in a raiding chat"""
+    raid_state[chat_id]["bans"].add(user_id)
+
+
+async def _flush_raid_bans(client, chat_id, state):
+    """Ban queued raiders concurrently"""
+    if not state["bans"]:
+        return
+    user_ids = list(state["bans"])
+    state["bans"].clear()
+    semaphore = asyncio.Semaphore(RAID_BAN_CONCURRENCY)
+    
+    async def ban(user_id):
+        async with semaphore:
+            try:
+                await client.ban_chat_member(chat_id, user_id)
+                return True
+            except FloodWait as e:
+                await asyncio.sleep(e.value)
+                state["bans"].add(user_id)
+            except Exception as e:
+                print(f"⚠️ Raid ban failed for {user_id} in {chat_id}: {e}")
+            return False
+    
+    banned = sum(await asyncio.gather(*[ban(user_id) for user_id in user_ids]))
+    state["banned"] += banned
+    moderation_stats["bans"] += banned
+
+
+async def get_slow_mode_delay(chat_id):
+    """A chat's current slow mode delay in seconds (0 = off), or None if it can't be read"""
+    # Pyrogram's Chat doesn't expose it; the Bot API getChat does
+    _, data = await bot_api_call("getChat", {"chat_id": chat_id})
+    if not data.get("ok"):
+        return None
+    return data["result"].get("slow_mode_delay") or 0
+
+
+async def stop_raid_watches():
+    """Cancel running raid watches and let them restore slow mode / post their summary"""
+    tasks = []
+    for chat_id in raid_state:
+        state = raid_state.get(chat_id)
+        task = state and state.get("task")
+        if task is not None and not task.done():
+            task.cancel()
+            tasks.append(task)
+    if tasks:
+        await asyncio.wait(tasks, timeout=10)
+
+
+async def raid_watch(client, chat_id):
+    """Run a chat's raid mode: slow mode on, batched bans, the chat's own slow mode back once quiet"""
+    state = raid_state[chat_id]
+    print(f"🚨 Raid detected in {chat_id}: {len(state['hits'])} violations in {RAID_WINDOW}s")
+    # Remember the admins' setting; slow mode is only raised, never lowered or left unrestorable
+    previous_slow_mode = await get_slow_mode_delay(chat_id)
+    slow_mode_set = False
+    if previous_slow_mode is None:
+        print(f"⚠️ Could not read slow mode in {chat_id}, leaving it unchanged")
+    elif previous_slow_mode < RAID_SLOW_MODE:
+        try:
+            await client.set_slow_mode(chat_id, RAID_SLOW_MODE)
+            slow_mode_set = True
+        except Exception as e:
+            print(f"⚠️ Could not enable slow mode in {chat_id}: {e}")
+    outbox_send(
+        chat_id,
+        "🚨 **Raid detected!**\n\nSpam is being removed automatically"
+        + (f" and slow mode is on ({RAID_SLOW_MODE}s)." if slow_mode_set else "."),
+        key=("raid",)
+    )
+    
+    try:
+        while time.time() < state["active_until"]:
+            await asyncio.sleep(1)
+            await _flush_raid_bans(client, chat_id, state)
+    finally:
+        # A FloodWait during a flush puts users back in the queue: keep flushing until it is empty
+        for _ in range(RAID_FINAL_FLUSH_ATTEMPTS):
+            if not state["bans"]:
+                break
+            await _flush_raid_bans(client, chat_id, state)
+        if state["bans"]:
+            print(f"⚠️ {len(state['bans'])} raid bans left undone in {chat_id}")
+            state["bans"].clear()
+        state["active"] = False
+        state["users"].clear()
+        if slow_mode_set:
+            try:
+                await client.set_slow_mode(chat_id, previous_slow_mode or None)
+            except Exception as e:
+                print(f"⚠️ Could not restore slow mode in {chat_id}: {e}")
+        print(f"✅ Raid over in {chat_id}: {state['deleted']} deleted, {state['banned']} banned")
+        outbox_send(
+            chat_id,
+            f"✅ **Raid over.**\n\n🗑️ Deleted: {state['deleted']}\n🔨 Banned: {state['banned']}"
+            + ("\nSlow mode is back to its previous setting." if slow_mode_set else ""),
+            key=("raid",),
+            auto_delete=60
+        )
+
+
+# ============ OUTBOX ============
+# Bot notices (warnings, ban notices, force join prompts, status edits) are queued here and paced
+# to Telegram's limits: ~30 messages/s overall, ~20/min per group, ~1/s per private chat.
+# Items queued with a key replace a still-pending item with the same key in that chat;
+# items with a ttl are low priority: dropped once expired or when a chat's queue is full.
+OUTBOX_GLOBAL_PER_SECOND = int(os.getenv("OUTBOX_GLOBAL_PER_SECOND", "25"))
+OUTBOX_GROUP_INTERVAL = float(os.getenv("OUTBOX_GROUP_INTERVAL", "3"))
+OUTBOX_PRIVATE_INTERVAL = 1.0
+OUTBOX_MAX_PER_CHAT = 20
+outbox_queues = {}  # {chat_id: [item, ...]} oldest first
+outbox_next_send = {}  # {chat_id: timestamp the chat may be sent to again}
+outbox_sent_times = deque()  # Send timestamps within the last second (global rate)
+outbox_wakeup = None  # asyncio.Event set when items are queued
+outbox_task = None  # Background sender task
+outbox_deliveries = set()  # In-flight _outbox_deliver tasks (referenced so they aren't garbage-collected)
+outbox_stats = {"sent": 0, "coalesced": 0, "expired": 0, "dropped": 0}
+
+
+def _outbox_put(item):
+    """Queue an item, replacing a pending one with the same key"""
+    queue = outbox_queues.setdefault(item["chat_id"], [])
+    if item["key"] is not None:
+        for i, queued in enumerate(queue):
+            if queued["key"] == item["key"]:
+                queue[i] = item
+                outbox_stats["coalesced"] += 1
+                return
     
-    # ============ CHAT JOIN REQUEST HANDLER (Auto-approve) ============
+    if len(queue) >= OUTBOX_MAX_PER_CHAT:
+        # Make room by dropping the oldest low-priority item
+        for i, queued in enumerate(queue):
+            if queued["expires_at"] is not None:
+                del queue[i]
+                outbox_stats["dropped"] += 1
+                break
+        else:
+            if item["expires_at"] is not None:
+                outbox_stats["dropped"] += 1
+                return
     
-    @bot_client.on_chat_join_request()
-    async def join_request_handler(client, chat_join_request):
-        """Automatically approve join requests for enabled channels"""
-        global auto_approve_stats
-        
-        chat_id = str(chat_join_request.chat.id)
-        chat_username = f"@{chat_join_request.chat.username}" if chat_join_request.chat.username else chat_id
-        
-        # Check if auto-approve is enabled for this channel
-        should_approve = (
-            chat_id in auto_approve_channels or
-            chat_username in auto_approve_channels or
-            chat_join_request.chat.username in auto_approve_channels
-        )
-        
-        if not should_approve:
-            return
-        
-        try:
-            # Save request so /approveall can work even if Telegram doesn't allow listing join requests
-            if pending_join_requests_col is not None:
-                pending_join_requests_col.update_one(
-                    {"chat_id": str(chat_join_request.chat.id), "user_id": chat_join_request.from_user.id},
-                    {
-                        "$set": {
-                            "chat_id": str(chat_join_request.chat.id),
-                            "chat_username": chat_join_request.chat.username,
-                            "user_id": chat_join_request.from_user.id,
-                            "user_name": chat_join_request.from_user.first_name,
-                            "requested_at": datetime.utcnow(),
-                            "approved": False,
-                        }
-                    },
-                    upsert=True,
-                )
+    queue.append(item)
+    if outbox_wakeup is not None:
+        outbox_wakeup.set()
 
-            # Use user client if available, otherwise bot client
-            if user_clients:
-                user_client = user_clients[0][1]
-                await user_client.approve_chat_join_request(
-                    chat_join_request.chat.id,
-                    chat_join_request.from_user.id
-                )
-            else:
-                await client.approve_chat_join_request(
-                    chat_join_request.chat.id,
-                    chat_join_request.from_user.id
-                )
 
-            if pending_join_requests_col is not None:
-                pending_join_requests_col.update_one(
-                    {"chat_id": str(chat_join_request.chat.id), "user_id": chat_join_request.from_user.id},
-                    {"$set": {"approved": True, "approved_at": datetime.utcnow()}},
-                )
+def outbox_send(chat_id, text, key=None, ttl=None, auto_delete=None, **kwargs):
+    """Queue a send_message. auto_delete schedules deletion of the sent message after N seconds"""
+    _outbox_put({
+        "kind": "send", "chat_id": chat_id, "message_id": None, "text": text, "kwargs": kwargs,
+        "key": key, "expires_at": time.time() + ttl if ttl else None, "auto_delete": auto_delete
+    })
 
-            auto_approve_stats["approved"] += 1
-            print(f"✅ Auto-approved: {chat_join_request.from_user.first_name} for {chat_username}")
-        
+
+def outbox_edit(chat_id, message_id, text, ttl=None, **kwargs):
+    """Queue an edit_message_text; only the newest pending edit of a message is kept"""
+    if not chat_id or not message_id:
+        return
+    _outbox_put({
+        "kind": "edit", "chat_id": chat_id, "message_id": message_id, "text": text, "kwargs": kwargs,
+        "key": ("edit", message_id), "expires_at": time.time() + ttl if ttl else None, "auto_delete": None
+    })
+
+
+async def _outbox_deliver(item):
+    """Send one outbox item, pushing it back if Telegram asks us to wait"""
+    chat_id = item["chat_id"]
+    try:
+        if item["kind"] == "send":
+            sent = await bot_client.send_message(chat_id, item["text"], **item["kwargs"])
+            if item["auto_delete"]:
+                schedule_auto_delete(chat_id, sent.id, item["auto_delete"])
+        else:
+            await bot_client.edit_message_text(chat_id, item["message_id"], item["text"], **item["kwargs"])
+        outbox_stats["sent"] += 1
+    except (FloodWait, SlowmodeWait) as e:
+        outbox_next_send[chat_id] = time.time() + e.value
+        print(f"⏳ Outbox {type(e).__name__} {e.value}s in {chat_id}")
+        # Retry unless a newer item with the same key is already waiting
+        queue = outbox_queues.setdefault(chat_id, [])
+        if item["key"] is None or all(queued["key"] != item["key"] for queued in queue):
+            queue.insert(0, item)
+        # The worker may be sleeping without a timeout (queues were empty on its last pass)
+        if outbox_wakeup is not None:
+            outbox_wakeup.set()
+    except MessageNotModified:
+        pass
+    except Exception as e:
+        print(f"⚠️ Outbox {item['kind']} failed in {chat_id}: {e}")
+
+
+async def outbox_worker():
+    """Pace queued notices per chat and globally"""
+    global outbox_wakeup
+    outbox_wakeup = asyncio.Event()
+    
+    while True:
+        try:
+            now = time.time()
+            while outbox_sent_times and outbox_sent_times[0] <= now - 1:
+                outbox_sent_times.popleft()
+            
+            ready = []
+            for chat_id, queue in list(outbox_queues.items()):
+                expired = [item for item in queue if item["expires_at"] is not None and item["expires_at"] <= now]
+                if expired:
+                    queue[:] = [item for item in queue if item not in expired]
+                    outbox_stats["expired"] += len(expired)
+                if not queue:
+                    del outbox_queues[chat_id]
+                elif outbox_next_send.get(chat_id, 0) <= now:
+                    ready.append(chat_id)
+            
+            # Chats that have waited longest go first
+            ready.sort(key=lambda c: outbox_next_send.get(c, 0))
+            for chat_id in ready:
+                if bot_client is None or len(outbox_sent_times) >= OUTBOX_GLOBAL_PER_SECOND:
+                    break
+                item = outbox_queues[chat_id].pop(0)
+                outbox_sent_times.append(now)
+                outbox_next_send[chat_id] = now + (OUTBOX_GROUP_INTERVAL if chat_id < 0 else OUTBOX_PRIVATE_INTERVAL)
+                task = asyncio.create_task(_outbox_deliver(item))
+                outbox_deliveries.add(task)
+                task.add_done_callback(outbox_deliveries.discard)
+            
+            # Forget pacing for chats that are idle again
+            for chat_id in [c for c, t in outbox_next_send.items() if t <= now and c not in outbox_queues]:
+                del outbox_next_send[chat_id]
         except Exception as e:
-            auto_approve_stats["failed"] += 1
-            print(f"❌ Failed to auto-approve: {e}")
+            print(f"⚠️ outbox_worker error: {e}")
+        
+        # Sleep until a chat becomes ready, new items arrive, or the global window moves
+        timeout = None
+        if outbox_queues:
+            next_ready = min(outbox_next_send.get(c, 0) for c in outbox_queues)
+            timeout = min(max(next_ready - time.time(), 0.05), 1.0)
+        outbox_wakeup.clear()
+        try:
+            await asyncio.wait_for(outbox_wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
 
-    @bot_client.on_message(filters.command("rawtest"))
-    async def rawtest_handler(client, message):
-        """Raw API test for debugging - shows exact responses"""
-        import aiohttp
+
+# ============ BOT API CLIENT ============
+# Raw Bot API calls (used where Pyrogram has no equivalent, e.g. /debugjoin, /rawtest) share one
+# keep-alive aiohttp session created at startup, so TLS setup to api.telegram.org is paid once.
+BOT_API_URL = "https://api.telegram.org/bot{token}/{method}"
+BOT_API_CONNECTIONS = int(os.getenv("BOT_API_CONNECTIONS", "20"))  # Pooled connections to api.telegram.org
+BOT_API_MAX_RETRIES = 3  # Retries on 429 (after retry_after), 5xx and network errors
+bot_api_session = None  # Shared aiohttp.ClientSession
+
+
+def get_bot_api_session():
+    """Shared Bot API session (created on first use inside the event loop)"""
+    global bot_api_session
+    if bot_api_session is None or bot_api_session.closed:
+        connector = aiohttp.TCPConnector(limit_per_host=BOT_API_CONNECTIONS, keepalive_timeout=60, ttl_dns_cache=300)
+        bot_api_session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=30))
+    return bot_api_session
+
+
+async def close_bot_api_session():
+    """Close the shared Bot API session"""
+    global bot_api_session
+    if bot_api_session is not None and not bot_api_session.closed:
+        await bot_api_session.close()
+    bot_api_session = None
+
+
+async def bot_api_call(method, params=None, post=False):
+    """Call a Bot API method; returns (http_status, data). 429s are retried after retry_after"""
+    if not BOT_TOKEN:
+        return 0, {"ok": False, "description": "BOT_TOKEN missing"}
+    url = BOT_API_URL.format(token=BOT_TOKEN, method=method)
+    
+    for attempt in range(BOT_API_MAX_RETRIES + 1):
+        last_attempt = attempt == BOT_API_MAX_RETRIES
         try:
-            parts = (message.text or "").split()
-            if len(parts) < 2:
-                await message.reply("Usage: /rawtest <chat_id>\nExample: /rawtest -1002926855756")
-                return
+            session = get_bot_api_session()
+            if post:
+                request_ctx = session.post(url, data=params)
+            else:
+                request_ctx = session.get(url, params=params)
+            async with request_ctx as resp:
+                status = resp.status
+                try:
+                    data = await resp.json(content_type=None)
+                except Exception:
+                    data = {"ok": False, "error_code": status, "description": "Non-JSON response", "raw": (await resp.text())[:200]}
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if last_attempt:
+                return 0, {"ok": False, "description": f"{type(e).__name__}: {e}"}
+            await asyncio.sleep(2 ** attempt)
+            continue
+        
+        if status == 429 and not last_attempt:
+            retry_after = (data.get("parameters") or {}).get("retry_after", 2 ** attempt)
+            print(f"⏳ Bot API {method}: 429, retrying in {retry_after}s")
+            await asyncio.sleep(retry_after)
+            continue
+        if status >= 500 and not last_attempt:
+            await asyncio.sleep(2 ** attempt)
+            continue
+        return status, data
 
-            chat_id = parts[1]
-            if not BOT_TOKEN:
-                await message.reply("❌ BOT_TOKEN missing!")
-                return
 
-            base_url = f"https://api.telegram.org/bot{BOT_TOKEN}"
-            results = []
+# ============ STREAMING JOIN-REQUEST APPROVER ============
+# /approveall lists pending requests with one user account and feeds them through a bounded queue,
+# so approving starts with the first page. Every user account approves in parallel; each one runs
+# more approvals at once while calls succeed and halves (and pauses) on FloodWait.
+APPROVE_START_CONCURRENCY = int(os.getenv("APPROVE_START_CONCURRENCY", "4"))  # Parallel approvals per account at start
+APPROVE_MAX_CONCURRENCY = int(os.getenv("APPROVE_MAX_CONCURRENCY", "20"))  # Upper bound per account
+APPROVE_GROW_EVERY = 25  # Successful approvals before an account runs one more in parallel
+APPROVE_QUEUE_SIZE = 2000  # Listed-but-not-yet-approved user ids held in memory
+APPROVE_STATUS_INTERVAL = 5  # Seconds between progress callbacks
 
-            async with aiohttp.ClientSession() as session:
-                # 1. getMe
-                async with session.get(f"{base_url}/getMe") as r:
-                    me_status = r.status
+
+async def stream_approve_join_requests(chat_id, on_progress=None):
+    """Approve every pending join request of a chat with all user accounts while still listing them.
+    
+    Returns {"listed", "approved", "failed", "lister", "accounts": {name: approved}}, or None if
+    no account could list the chat's join requests.
+    """
+    result = {"listed": 0, "approved": 0, "failed": 0, "lister": None, "accounts": {}}
+    accounts = {
+        name: {"client": c, "limit": APPROVE_START_CONCURRENCY, "streak": 0, "paused_until": 0, "retired": False}
+        for name, c in user_clients
+    }
+    queue = asyncio.Queue(maxsize=APPROVE_QUEUE_SIZE)
+    retry = deque()  # Ids handed back after a FloodWait / retired account (taken before the queue)
+    listing_done = asyncio.Event()
+    
+    async def produce():
+        seen = set()
+        try:
+            for name, account in accounts.items():
+                while True:
                     try:
-                        me_data = await r.json()
-                    except:
-                        me_data = {"raw": (await r.text())[:200]}
-                results.append(f"**1. getMe** (status={me_status}):\n```{str(me_data)[:300]}```")
+                        async for join_request in account["client"].get_chat_join_requests(chat_id):
+                            result["lister"] = name
+                            uid = join_request.user.id
+                            if uid not in seen:
+                                seen.add(uid)
+                                result["listed"] += 1
+                                await queue.put(uid)
+                        result["lister"] = name
+                        return
+                    except FloodWait as e:
+                        # Restart the listing after the wait; ids already queued are skipped
+                        print(f"⏳ {name} FloodWait {e.value}s while listing join requests")
+                        await asyncio.sleep(e.value)
+                    except Exception as e:
+                        print(f"⚠️ {name} cannot list join requests for {chat_id}: {e}")
+                        break
+        finally:
+            listing_done.set()
+    
+    def drained():
+        return listing_done.is_set() and queue.empty() and not retry
+    
+    async def approve_worker(name, account, slot):
+        client = account["client"]
+        while not account["retired"]:
+            if slot >= account["limit"] or account["paused_until"] > time.time():
+                if drained():
+                    return
+                await asyncio.sleep(0.5)
+                continue
+            if retry:
+                uid = retry.popleft()
+            else:
+                try:
+                    uid = await asyncio.wait_for(queue.get(), 1)
+                except asyncio.TimeoutError:
+                    if drained():
+                        return
+                    continue
+            try:
+                await client.approve_chat_join_request(chat_id, uid)
+                result["approved"] += 1
+                result["accounts"][name] = result["accounts"].get(name, 0) + 1
+                auto_approve_stats["approved"] += 1
+                account["streak"] += 1
+                if account["streak"] >= APPROVE_GROW_EVERY and account["limit"] < APPROVE_MAX_CONCURRENCY:
+                    account["limit"] += 1
+                    account["streak"] = 0
+            except FloodWait as e:
+                retry.append(uid)
+                account["paused_until"] = time.time() + e.value
+                account["limit"] = max(1, account["limit"] // 2)
+                account["streak"] = 0
+                print(f"⏳ {name} FloodWait {e.value}s approving (now {account['limit']} at once)")
+            except Exception as e:
+                if isinstance(e, ChatAdminRequired) or "CHAT_ADMIN_REQUIRED" in str(e):
+                    # This account is not an admin of the chat; the others carry on
+                    retry.append(uid)
+                    if not account["retired"]:
+                        account["retired"] = True
+                        print(f"⚠️ {name} is not admin in {chat_id}, skipping this account")
+                else:
+                    result["failed"] += 1
+                    auto_approve_stats["failed"] += 1
+    
+    async def report():
+        while True:
+            await asyncio.sleep(APPROVE_STATUS_INTERVAL)
+            await on_progress(result)
+    
+    producer = asyncio.create_task(produce())
+    reporter = asyncio.create_task(report()) if on_progress else None
+    workers = [
+        asyncio.create_task(approve_worker(name, account, slot))
+        for name, account in accounts.items()
+        for slot in range(APPROVE_MAX_CONCURRENCY)
+    ]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        # All workers exit once listing is done and nothing is left, or every account was retired
+        producer.cancel()
+        if reporter is not None:
+            reporter.cancel()
+        for task in workers:
+            task.cancel()
+    
+    # Listed ids no account could approve (every account lacked admin rights)
+    result["failed"] += queue.qsize() + len(retry)
+    if result["lister"] is None:
+        return None
+    return result
 
-                bot_id = (me_data.get("result") or {}).get("id") if isinstance(me_data, dict) else None
 
-                # 2. getChat
-                async with session.get(f"{base_url}/getChat", params={"chat_id": chat_id}) as r:
-                    gc_status = r.status
-                    try:
-                        gc_data = await r.json()
-                    except:
-                        gc_data = {"raw": (await r.text())[:200]}
-                results.append(f"**2. getChat** (status={gc_status}):\n```{str(gc_data)[:400]}```")
-
-                # 3. getChatMember (bot)
-                if bot_id:
-                    async with session.get(f"{base_url}/getChatMember", params={"chat_id": chat_id, "user_id": bot_id}) as r:
-                        gm_status = r.status
-                        try:
-                            gm_data = await r.json()
-                        except:
-                            gm_data = {"raw": (await r.text())[:200]}
-                    results.append(f"**3. getChatMember(bot)** (status={gm_status}):\n```{str(gm_data)[:400]}```")
-
-                # 4. getChatJoinRequests
-                async with session.get(f"{base_url}/getChatJoinRequests", params={"chat_id": chat_id, "limit": 5}) as r:
-                    jr_status = r.status
-                    try:
-                        jr_data = await r.json()
-                    except:
-                        jr_data = {"raw": (await r.text())[:200]}
-                results.append(f"**4. getChatJoinRequests** (status={jr_status}):\n```{str(jr_data)[:400]}```")
+# ============ AUTO-APPROVE CHANNEL INDEX ============
+# /autoapprove resolves what was typed (@username, link, -100...) to the numeric chat ID once; the
+# ID is stored with the entry, so renames don't break matching. auto_approve_refresh_worker
+# re-resolves entries in the background (titles/usernames, and older entries saved without an ID).
+AUTO_APPROVE_REFRESH_INTERVAL = int(os.getenv("AUTO_APPROVE_REFRESH_INTERVAL", "21600"))  # Seconds between refreshes
+auto_approve_refresh_task = None  # Background resolver
 
-            await message.reply("🔬 Raw API Test Results\n\n" + "\n\n".join(results))
 
-        except Exception as e:
-            await message.reply(f"❌ rawtest error: {e}")
+def load_auto_approve_channels():
+    """Load enabled auto-approve entries from database into the chat ID index"""
+    auto_approve_channels.clear()
+    auto_approve_index.clear()
+    auto_approve_unresolved.clear()
+    if autoapprove_col is None:
+        return
+    for doc in autoapprove_col.find({"enabled": True}):
+        chat_id = doc.get("chat_id")
+        if chat_id is None and str(doc.get("channel", "")).lstrip("-").isdigit():
+            chat_id = int(doc["channel"])
+        if chat_id is None:
+            auto_approve_unresolved.add(doc["channel"])
+            continue
+        auto_approve_channels.add(chat_id)
+        auto_approve_index[chat_id] = {
+            "channel": doc.get("channel", str(chat_id)),
+            "title": doc.get("title", ""),
+            "username": doc.get("username", ""),
+        }
+    print(f"📥 Loaded {len(auto_approve_channels)} auto-approve channels"
+          + (f" ({len(auto_approve_unresolved)} to resolve)" if auto_approve_unresolved else ""))
 
-    @bot_client.on_message(filters.command("version"))
-    async def version_handler(client, message):
-        """Print running build/version to confirm deployment"""
-        from datetime import datetime
+
+def normalize_chat_input(channel):
+    """Turn -100..., @username, t.me/username or a bare username into something get_chat accepts"""
+    channel = channel.strip()
+    if channel.lstrip("-").isdigit():
+        return int(channel)
+    for prefix in ("https://t.me/", "http://t.me/", "t.me/"):
+        if channel.startswith(prefix):
+            channel = channel[len(prefix):].split("/")[0]
+    return channel if channel.startswith("@") else "@" + channel
+
+
+async def resolve_chat_id(client, channel):
+    """Resolve a channel/group input to (chat_id, title, username); raises if the chat can't be seen"""
+    chat = await client.get_chat(normalize_chat_input(channel))
+    return chat.id, chat.title or "", chat.username or ""
+
+
+def enable_auto_approve(chat_id, channel, title="", username=""):
+    """Add a resolved chat to the index and save it"""
+    auto_approve_channels.add(chat_id)
+    auto_approve_index[chat_id] = {"channel": channel, "title": title, "username": username}
+    auto_approve_unresolved.discard(channel)
+    if autoapprove_col is not None:
+        autoapprove_col.update_many(
+            {"$or": [{"chat_id": chat_id}, {"channel": channel}]},
+            {"$set": {
+                "channel": channel, "chat_id": chat_id, "title": title, "username": username,
+                "enabled": True, "resolved_at": datetime.utcnow(), "updated_at": datetime.utcnow()
+            }},
+            upsert=True
+        )
+
+
+def find_auto_approve_chat(channel):
+    """Chat ID of an indexed entry matching what a user typed (ID, @username or original input)"""
+    target = normalize_chat_input(channel)
+    if isinstance(target, int):
+        return target if target in auto_approve_index else None
+    name = target.lstrip("@").lower()
+    for chat_id, entry in auto_approve_index.items():
+        if name in (entry["username"].lower(), entry["channel"].lstrip("@").lower()):
+            return chat_id
+    return None
+
+
+async def refresh_auto_approve_index():
+    """Re-resolve indexed chats (title/username) and entries saved without a chat ID"""
+    client = bot_client or (user_clients[0][1] if user_clients else None)
+    if client is None:
+        return
+    for channel in list(auto_approve_unresolved):
         try:
-            await message.reply(
-                "✅ Running build is updated.\n"
-                f"Build time: {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')} UTC\n"
-                "Commands: /version /rawtest /debugjoin"
-            )
+            chat_id, title, username = await resolve_chat_id(client, channel)
+            enable_auto_approve(chat_id, channel, title, username)
+            print(f"📥 Auto-approve {channel} resolved to {chat_id}")
+        except FloodWait as e:
+            await asyncio.sleep(e.value)
         except Exception as e:
-            await message.reply(f"❌ version error: {e}")
+            print(f"⚠️ Cannot resolve auto-approve {channel}: {e}")
+    for chat_id, entry in list(auto_approve_index.items()):
+        try:
+            _, title, username = await resolve_chat_id(client, str(chat_id))
+        except FloodWait as e:
+            await asyncio.sleep(e.value)
+            continue
+        except Exception:
+            continue  # Keep the entry; the ID is what matters for matching
+        if (title, username) != (entry["title"], entry["username"]) and chat_id in auto_approve_index:
+            enable_auto_approve(chat_id, entry["channel"], title, username)
 
 
-# Flask routes for health checks
-@flask_app.route("/")
-def home():
-    num_accounts = len(user_clients)
-    return jsonify({
-        "status": "ok",
-        "message": "Telegram Forwarder Bot (Multi-Account MTProto)",
-        "accounts": num_accounts,
-        "expected_speed": f"{num_accounts * 30}/min"
-    })
+async def auto_approve_refresh_worker():
+    """Refresh the auto-approve index now and then every AUTO_APPROVE_REFRESH_INTERVAL seconds"""
+    while True:
+        try:
+            await refresh_auto_approve_index()
+        except Exception as e:
+            print(f"⚠️ Auto-approve refresh error: {e}")
+        await asyncio.sleep(AUTO_APPROVE_REFRESH_INTERVAL)
+
+
+# ============ AUTO-APPROVE QUEUE ============
+# join_request_handler only queues; auto_approve_worker drains the queue in rounds spread over every
+# user account (FloodWait pauses just that account). While a round runs, new requests pile up, and a
+# chat/invite link with a big backlog is cleared with one approve-all call. DB writes are batched.
+AUTO_APPROVE_WORKERS = int(os.getenv("AUTO_APPROVE_WORKERS", "4"))  # Parallel approvals per account
+AUTO_APPROVE_BULK_THRESHOLD = int(os.getenv("AUTO_APPROVE_BULK_THRESHOLD", "100"))  # Backlog per chat/link for approve-all
+AUTO_APPROVE_FLUSH_SECONDS = 2  # Max delay before queued DB writes are flushed
+AUTO_APPROVE_SKIP_SECONDS = 3600  # How long an account that isn't admin in a chat is left out for it
+auto_approve_queue = deque()  # (chat_id, user_id, invite_link) waiting for approval
+auto_approve_queued = set()  # (chat_id, user_id) currently queued (Telegram may resend a request)
+auto_approve_paused_until = {}  # {account name: time} after a FloodWait
+auto_approve_skipped = {}  # {(chat_id, account name): time} account lacks admin rights there until then
+auto_approve_writes = []  # UpdateOne ops for pending_join_requests_col, flushed with one bulk_write
+auto_approve_wakeup = None  # asyncio.Event set when requests are queued
+auto_approve_task = None  # Background auto-approve worker
+
+
+def queue_auto_approve(chat_join_request):
+    """Queue a join request for auto_approve_worker and its pending record for the next bulk write"""
+    chat_id = chat_join_request.chat.id
+    user_id = chat_join_request.from_user.id
+    key = (chat_id, user_id)
+    
+    # Saved so /approveall can work even if Telegram doesn't allow listing join requests
+    if pending_join_requests_col is not None:
+        auto_approve_writes.append(UpdateOne(
+            {"chat_id": str(chat_id), "user_id": user_id},
+            {"$set": {
+                "chat_id": str(chat_id),
+                "chat_username": chat_join_request.chat.username,
+                "user_id": user_id,
+                "user_name": chat_join_request.from_user.first_name,
+                "requested_at": datetime.utcnow(),
+                "approved": False,
+            }},
+            upsert=True
+        ))
+    
+    if key in auto_approve_queued:
+        return
+    invite = getattr(chat_join_request, "invite_link", None)
+    auto_approve_queued.add(key)
+    auto_approve_queue.append((chat_id, user_id, invite.invite_link if invite else None))
+    if auto_approve_wakeup is not None:
+        auto_approve_wakeup.set()
+
+
+def mark_auto_approved(chat_id, user_id):
+    """Count an approval and queue its DB update"""
+    auto_approve_queued.discard((chat_id, user_id))
+    auto_approve_stats["approved"] += 1
+    if pending_join_requests_col is not None:
+        auto_approve_writes.append(UpdateOne(
+            {"chat_id": str(chat_id), "user_id": user_id},
+            {"$set": {"approved": True, "approved_at": datetime.utcnow()}}
+        ))
 
 
-@flask_app.route("/webhook", methods=["GET", "POST"])
-@flask_app.route("/webhook/", methods=["GET", "POST"])
-def webhook():
-    """Handle Telegram webhook requests (we use polling, so just acknowledge)."""
+def flush_auto_approve_writes():
+    """Write queued pending/approved records in one ordered bulk_write"""
+    if not auto_approve_writes or pending_join_requests_col is None:
+        auto_approve_writes.clear()
+        return
+    ops = auto_approve_writes[:]
+    auto_approve_writes.clear()
     try:
-        # Helpful for Koyeb logs: shows if Telegram (or anything) is still hitting webhook
-        print(f"🌐 /webhook hit: method={request.method} content_type={request.content_type}")
-    except Exception:
-        pass
+        pending_join_requests_col.bulk_write(ops, ordered=True)
+    except Exception as e:
+        print(f"⚠️ Auto-approve bulk write failed ({len(ops)} ops): {e}")
 
-    # We use Pyrogram polling, not webhook mode.
-    # This route exists to prevent 404 errors if webhook is accidentally set.
-    return jsonify({"ok": True, "message": "Bot uses polling mode, not webhook"})
 
+def auto_approve_accounts():
+    """(name, client) pairs that may approve now: user accounts not in a FloodWait, else the bot"""
+    accounts = user_clients or ([("bot", bot_client)] if bot_client is not None else [])
+    now = time.time()
+    return [(name, c) for name, c in accounts if auto_approve_paused_until.get(name, 0) <= now]
 
-@flask_app.route("/health")
-def health():
-    return jsonify({
-        "status": "healthy",
-        "user_clients": len(user_clients),
-        "bot_client": bot_client is not None,
-        "is_forwarding": is_forwarding
-    })
 
+def auto_approve_can_take(name, chat_id):
+    """An account may approve in chat_id; the bot only steps in once every user account was refused there"""
+    now = time.time()
+    if auto_approve_skipped.get((chat_id, name), 0) > now:
+        return False
+    if name == "bot" and user_clients:
+        return all(auto_approve_skipped.get((chat_id, n), 0) > now for n, _ in user_clients)
+    return True
 
-@flask_app.route("/progress")
-def get_progress():
-    load_progress()
-    return jsonify(current_progress)
 
+def skip_auto_approve_account(chat_id, name):
+    """Leave an account out of chat_id's approvals after ChatAdminRequired"""
+    auto_approve_skipped[(chat_id, name)] = time.time() + AUTO_APPROVE_SKIP_SECONDS
+    print(f"⚠️ Auto-approve: {name} is not admin in {chat_id}, using other accounts there")
 
-@flask_app.route("/accounts")
-def get_accounts():
-    return jsonify({
-        "count": len(user_clients),
-        "accounts": [name for name, _ in user_clients],
-        "expected_speed": f"{len(user_clients) * 30}/min"
-    })
 
+async def approve_all_backlog(chat_id, invite_link, items):
+    """Approve a large backlog for one chat/invite link with a single call. Returns True on success"""
+    for name, client in auto_approve_accounts():
+        if client is bot_client:
+            break  # approve-all is only available to user accounts
+        if not auto_approve_can_take(name, chat_id):
+            continue
+        try:
+            await client.approve_all_chat_join_requests(chat_id, invite_link=invite_link)
+        except FloodWait as e:
+            auto_approve_paused_until[name] = time.time() + e.value
+            continue
+        except Exception as e:
+            if isinstance(e, ChatAdminRequired) or "CHAT_ADMIN_REQUIRED" in str(e):
+                skip_auto_approve_account(chat_id, name)
+            else:
+                print(f"⚠️ Approve-all failed for {chat_id} via {name}: {e}")
+            continue
+        for item_chat_id, user_id, _link in items:
+            mark_auto_approved(item_chat_id, user_id)
+        print(f"✅ Auto-approved {len(items)} requests for {chat_id} at once ({name})")
+        return True
+    return False
 
-def run_flask():
-    """Run Flask in a separate thread"""
-    port = int(os.getenv("PORT", 8000))
-    flask_app.run(host="0.0.0.0", port=port, debug=False)
+
+async def drain_auto_approve_queue():
+    """Approve everything queued so far, spread over all available accounts"""
+    batch = [auto_approve_queue.popleft() for _ in range(len(auto_approve_queue))]
+    now = time.time()
+    for key in [key for key, until in auto_approve_skipped.items() if until <= now]:
+        del auto_approve_skipped[key]
+    
+    # A big backlog for one chat/invite link goes through one approve-all call
+    groups = {}
+    for item in batch:
+        groups.setdefault((item[0], item[2]), []).append(item)
+    pending = {}  # {chat_id: deque of items}, so each account only picks chats it can approve in
+    for (chat_id, invite_link), items in groups.items():
+        if len(items) >= AUTO_APPROVE_BULK_THRESHOLD and await approve_all_backlog(chat_id, invite_link, items):
+            continue
+        pending.setdefault(chat_id, deque()).extend(items)
+    
+    async def account_worker(name, client):
+        while auto_approve_paused_until.get(name, 0) <= time.time():
+            chat_id = next((c for c, items in pending.items() if items and auto_approve_can_take(name, c)), None)
+            if chat_id is None:
+                return
+            item = pending[chat_id].popleft()
+            user_id = item[1]
+            try:
+                await client.approve_chat_join_request(chat_id, user_id)
+                mark_auto_approved(chat_id, user_id)
+            except FloodWait as e:
+                auto_approve_paused_until[name] = time.time() + e.value
+                pending[chat_id].appendleft(item)
+                print(f"⏳ Auto-approve: {name} FloodWait {e.value}s")
+            except Exception as e:
+                if isinstance(e, ChatAdminRequired) or "CHAT_ADMIN_REQUIRED" in str(e):
+                    # Handed to another account (or the bot) on the next pick
+                    skip_auto_approve_account(chat_id, name)
+                    pending[chat_id].appendleft(item)
+                    continue
+                auto_approve_queued.discard((chat_id, user_id))
+                auto_approve_stats["failed"] += 1
+                print(f"❌ Failed to auto-approve {user_id} in {chat_id}: {e}")
+    
+    # The bot joins in as a fallback for chats where no user account is admin
+    candidates = list(user_clients) + ([("bot", bot_client)] if bot_client is not None else [])
+    while True:
+        ready = [(name, c) for name, c in candidates if auto_approve_paused_until.get(name, 0) <= time.time()]
+        if not any(items and auto_approve_can_take(name, c) for c, items in pending.items() for name, _ in ready):
+            break
+        await asyncio.gather(*[
+            account_worker(name, client)
+            for name, client in ready
+            for _ in range(AUTO_APPROVE_WORKERS)
+        ])
+    
+    for chat_id, items in pending.items():
+        if items and not any(auto_approve_can_take(name, chat_id) for name, _ in candidates):
+            # No account may approve here at all
+            for _chat_id, user_id, _link in items:
+                auto_approve_queued.discard((chat_id, user_id))
+            auto_approve_stats["failed"] += len(items)
+            print(f"❌ Auto-approve: no account is admin in {chat_id}, dropped {len(items)} requests")
+            items.clear()
+    # Accounts that may approve the rest are waiting out a FloodWait: it goes first in the next round
+    auto_approve_queue.extendleft(reversed([item for items in pending.values() for item in items]))
+
+
+async def auto_approve_worker():
+    """Drain the auto-approve queue and flush its DB writes"""
+    global auto_approve_wakeup
+    auto_approve_wakeup = asyncio.Event()
+    
+    while True:
+        auto_approve_wakeup.clear()
+        try:
+            if auto_approve_queue and auto_approve_accounts():
+                await drain_auto_approve_queue()
+            flush_auto_approve_writes()
+        except Exception as e:
+            print(f"⚠️ auto_approve_worker error: {e}")
+        
+        # Sleep until new requests arrive, an account's FloodWait ends, or it is time to flush
+        timeout = AUTO_APPROVE_FLUSH_SECONDS
+        if auto_approve_queue and not auto_approve_accounts():
+            next_ready = min(auto_approve_paused_until.values(), default=time.time() + AUTO_APPROVE_FLUSH_SECONDS)
+            timeout = max(next_ready - time.time(), 0.1)
+        elif auto_approve_queue:
+            timeout = 0
+        if timeout:
+            try:
+                await asyncio.wait_for(auto_approve_wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
 
 
 async def bot_watchdog():
@@ -5048,9 +7614,12 @@ async def bot_watchdog():
 
 async def shutdown_clients():
     """Gracefully stop all clients (prevents AUTH_KEY_DUPLICATED on quick redeploys)."""
-    global user_clients, bot_client, bot_watchdog_task
+    global user_clients, bot_client, bot_watchdog_task, auto_delete_task, outbox_task, settings_sync_task, auto_approve_task, auto_approve_refresh_task, referral_reconcile_task
+
+    # End raid modes while the clients can still restore slow mode
+    await stop_raid_watches()
 
-    # Stop watchdog first
+    # Stop watchdog
     if bot_watchdog_task is not None:
         try:
             bot_watchdog_task.cancel()
@@ -5058,6 +7627,57 @@ async def shutdown_clients():
             pass
         bot_watchdog_task = None
 
+    # Stop settings sync
+    if settings_sync_task is not None:
+        try:
+            settings_sync_task.cancel()
+        except Exception:
+            pass
+        settings_sync_task = None
+
+    # Stop referral counter catch-up
+    if referral_reconcile_task is not None:
+        try:
+            referral_reconcile_task.cancel()
+        except Exception:
+            pass
+        referral_reconcile_task = None
+
+    # Stop auto-approve worker (queued DB writes are flushed)
+    if auto_approve_task is not None:
+        try:
+            auto_approve_task.cancel()
+        except Exception:
+            pass
+        auto_approve_task = None
+    flush_auto_approve_writes()
+    if auto_approve_refresh_task is not None:
+        try:
+            auto_approve_refresh_task.cancel()
+        except Exception:
+            pass
+        auto_approve_refresh_task = None
+
+    # Close the shared Bot API session
+    await close_bot_api_session()
+
+    # Stop outbox sender
+    if outbox_task is not None:
+        try:
+            outbox_task.cancel()
+        except Exception:
+            pass
+        outbox_task = None
+
+    # Stop auto-delete scheduler (pending entries stay in DB for the next start)
+    if auto_delete_task is not None:
+        try:
+            auto_delete_task.cancel()
+        except Exception:
+            pass
+        auto_delete_task = None
+    flush_auto_delete_writes()
+
     # Stop user clients
     for name, c in list(user_clients):
         try:
@@ -5097,6 +7717,16 @@ async def main():
     # Load saved progress
     load_progress()
 
+    # Bulk-load chat settings so group messages never wait on a per-chat query
+    ensure_settings_indexes()
+    warm_settings_cache()
+
+    # Referral counter indexes (existing referrals are counted by referral_reconcile_worker)
+    ensure_referral_indexes()
+
+    # Auto-delete queue index (every deletion batch removes its entries by chat_id + message_id)
+    ensure_auto_delete_indexes()
+
     # Initialize clients (this can take time, but Flask is already up)
     await init_clients()
 
@@ -5106,6 +7736,41 @@ async def main():
         bot_watchdog_task = asyncio.create_task(bot_watchdog())
         print("🛡️ Bot watchdog enabled")
 
+    # Start auto-delete scheduler (restores deletions scheduled before a restart)
+    global auto_delete_task
+    if bot_client is not None and auto_delete_task is None:
+        load_auto_delete_queue()
+        auto_delete_task = asyncio.create_task(auto_delete_worker())
+
+    # Start outbox sender (paced warnings / notices / status edits)
+    global outbox_task
+    if bot_client is not None and outbox_task is None:
+        outbox_task = asyncio.create_task(outbox_worker())
+
+    # Start auto-approve worker (join requests are queued by join_request_handler)
+    global auto_approve_task
+    if bot_client is not None and auto_approve_task is None:
+        auto_approve_task = asyncio.create_task(auto_approve_worker())
+
+    # Start auto-approve index refresh (resolves entries saved before chat IDs were stored)
+    global auto_approve_refresh_task
+    if auto_approve_refresh_task is None and (bot_client is not None or user_clients):
+        auto_approve_refresh_task = asyncio.create_task(auto_approve_refresh_worker())
+
+    # Start settings sync (picks up config saved by other instances)
+    global settings_sync_task
+    if settings_sync_task is None:
+        settings_sync_task = asyncio.create_task(settings_sync_worker())
+
+    # Start referral counter catch-up (referrals saved by older versions or before counters existed)
+    global referral_reconcile_task
+    if referral_reconcile_task is None and referrals_col is not None:
+        referral_reconcile_task = asyncio.create_task(referral_reconcile_worker())
+
+    # Open the shared Bot API session (keep-alive pool for raw Bot API calls)
+    if BOT_TOKEN:
+        get_bot_api_session()
+
     # Webhook clearing is handled via bot_client.delete_webhook() during init_clients()
     # (keeps dependencies minimal and avoids silent failures)
 